@@ -1,12 +1,39 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response
 from flask_cors import CORS
 import pandas as pd
 import numpy as np
 from datetime import datetime
+import copy
+import gzip
+import hashlib
 import json
 import os
+import pickle
+import re
+import shutil
+import stat
 from typing import Dict, List, Any
 import logging
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field, replace
+
+# fcntl есть только на POSIX; без него межпроцессная блокировка общего каталога не выполняется
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# pyarrow необязателен - нужен только для выгрузки /export/csv в parquet/arrow
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -15,37 +42,568 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
-# Глобальные переменные для хранения данных
-clients_data = None
-transactions_data = None
-transfers_data = None
-merged_data = None
-
-# Счетчики для отображения общего количества данных
-data_counts = {
-    'clients': 0,
-    'transactions': 0,
-    'transfers': 0
+# Глобальные переменные для хранения данных: загруженные входные данные (UploadedInputs)
+# и опубликованный снимок обработанных данных (DatasetSnapshot). Оба объекта неизменяемы
+# и заменяются целиком одним присваиванием, поэтому читатели работают без блокировок
+uploaded_inputs = None
+current_snapshot = None
+
+# Загрузки заменяют uploaded_inputs по очереди, чтобы не потерять соседнюю загрузку
+uploads_lock = threading.Lock()
+# Дозагрузки (mode=append) выполняются по одной
+appends_lock = threading.Lock()
+# Порции онлайн-событий (/events) применяются по одной; еще не перенесенные в загрузки
+# порции (вид данных, агрегаты, sha256 тела запроса) ждут следующего /process.
+# При общем каталоге данных порции вместо этого пишутся в общий журнал (EventLog)
+events_lock = threading.Lock()
+pending_events = []
+# Время последней проверки общего журнала событий этим процессом (time.monotonic)
+events_checked_at = 0.0
+
+# Фоновые задачи /process по job_id и блокировка запуска (одновременно идет не больше одной)
+processing_jobs = {}
+processing_jobs_lock = threading.Lock()
+
+# Количество топ-категорий трат клиента (TOP3_m и шаблон кредитной карты)
+TOP_K = 3
+
+# Признаки категорий трат для TRAVEL_m и ONLINE_m (подстрока в названии категории)
+TRAVEL_CATEGORY_MARKERS = ('Такси', 'Путешествия', 'Отели')
+ONLINE_CATEGORY_MARKERS = ('Играем дома', 'Смотрим дома', 'Едим дома')
+
+# Месячные метрики, которые считаются из трат и переводов (остальные колонки *_m - траты по категориям)
+MONTHLY_METRIC_COLUMNS = ('TRAVEL_m', 'ONLINE_m', 'TOP3_m', 'TOTAL_m', 'INFLOWS_m', 'OUTFLOWS_m')
+
+# Месячная метрика для направления перевода
+TRANSFER_FLOW_COLUMNS = {'in': 'INFLOWS_m', 'out': 'OUTFLOWS_m'}
+
+# Доступные движки расчета выгоды: построчный (DataFrame.apply) и векторный (NumPy)
+BENEFIT_ENGINES = ('vectorized', 'rowwise')
+
+# Названия месяцев в предложном падеже для текстов уведомлений ("в октябре")
+MONTHS_PREPOSITIONAL = (
+    'январе', 'феврале', 'марте', 'апреле', 'мае', 'июне',
+    'июле', 'августе', 'сентябре', 'октябре', 'ноябре', 'декабре'
+)
+
+
+def _no_progress(stage: str, rows: int):
+    """Колбэк прогресса по умолчанию для process_data/calculate_benefits"""
+
+
+def _column(frame, name, default):
+    """Колонка в виде numpy-массива; значение по умолчанию, если колонки нет (аналог row.get)"""
+    if name in frame:
+        return np.asarray(frame[name])
+    return np.full(len(frame), default)
+
+
+def _py_min(a, b):
+    """Поэлементный аналог встроенного min(a, b), включая поведение с NaN"""
+    return np.where(b < a, b, a)
+
+
+def _py_max(a, b):
+    """Поэлементный аналог встроенного max(a, b), включая поведение с NaN"""
+    return np.where(b > a, b, a)
+
+
+def _month_prepositional() -> str:
+    """Текущий месяц по-русски в предложном падеже (не зависит от локали сервера)"""
+    return MONTHS_PREPOSITIONAL[datetime.now().month - 1]
+
+
+def _format_amounts(values) -> List[str]:
+    """Пакетный аналог f"{x:,.0f}": округление до целого (к четному, как format) и разряды через запятую"""
+    values = np.asarray(values, dtype=np.float64)
+    rounded = np.rint(values)
+    # Целые форматируются быстрее float; inf/nan, огромные суммы и "-0" отдаем обычному format
+    exact = np.isfinite(rounded) & (np.abs(rounded) < 2.0 ** 62) & ~((rounded == 0) & np.signbit(values))
+    
+    if exact.all():
+        return [f"{amount:,}" for amount in rounded.astype(np.int64).tolist()]
+    return [
+        f"{int(amount):,}" if is_exact else f"{value:,.0f}"
+        for amount, value, is_exact in zip(rounded.tolist(), values.tolist(), exact.tolist())
+    ]
+
+
+def _contains_token(values, token):
+    """Поэлементная проверка `token in value` для строковой колонки"""
+    values = np.asarray(values, dtype=object)
+    return np.fromiter((isinstance(v, str) and token in v for v in values), dtype=bool, count=len(values))
+
+
+# Операторы предикатов для правил флагов: (оператор, значение)
+FLAG_PREDICATES = {
+    '==': lambda series, value: series == value,
+    '!=': lambda series, value: series != value,
+    'isin': lambda series, value: series.isin(value),
+    'contains': lambda series, value: series.fillna('').astype(str).str.contains(value, na=False)
+}
+
+# Те же операторы для одного значения: флаги одного клиента считаются без pandas
+SCALAR_FLAG_PREDICATES = {
+    '==': lambda item, value: item == value,
+    '!=': lambda item, value: item != value,
+    'isin': lambda item, value: item in value,
+    'contains': lambda item, value: re.search(value, '' if item is None else str(item)) is not None
+}
+
+
+def _has_marker(name: str, markers: tuple) -> bool:
+    """Содержит ли название категории один из признаков markers"""
+    return any(marker in name for marker in markers)
+
+
+def _matches_predicate(item, predicate) -> bool:
+    """Удовлетворяет ли одно значение предикату (оператор, значение) или функции - как _evaluate_predicate"""
+    if callable(predicate):
+        return bool(predicate(pd.Series([item], dtype=object))[0])
+    op, value = predicate
+    if op not in SCALAR_FLAG_PREDICATES:
+        raise ValueError(f"Неизвестный оператор флага: {op}")
+    return bool(SCALAR_FLAG_PREDICATES[op](item, value))
+
+
+def _evaluate_predicate(series: pd.Series, predicate) -> np.ndarray:
+    """Булева маска строк series, удовлетворяющих предикату (оператор, значение) или функции"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Для категориальной колонки предикат считается один раз на категорию (и на пропуск)
+        categories = pd.Series(np.append(np.asarray(series.cat.categories, dtype=object), np.nan), dtype=object)
+        lookup = _evaluate_predicate(categories, predicate)
+        return lookup[series.cat.codes.to_numpy()]
+    if callable(predicate):
+        return np.asarray(predicate(series), dtype=bool)
+    op, value = predicate
+    if op not in FLAG_PREDICATES:
+        raise ValueError(f"Неизвестный оператор флага: {op}")
+    return np.asarray(FLAG_PREDICATES[op](series, value), dtype=bool)
+
+
+# Ключ агрегации сумм по клиенту для каждого вида загружаемых данных
+AGGREGATE_KEYS = {
+    'transactions': 'category',
+    'transfers': 'direction'
+}
+
+# Режимы загрузки транзакций и переводов
+UPLOAD_MODES = ('frame', 'stream', 'append')
+
+# Для скольких предыдущих загрузок агрегаты в режиме append помнят затронутых с тех пор клиентов
+APPEND_LINEAGE_DEPTH = 16
+
+# Размер куска CSV при потоковой загрузке (строк)
+INGEST_CHUNK_SIZE = 200000
+
+# Сколько разобранных загрузок держать в кеше по хешу содержимого
+UPLOAD_CACHE_SIZE = int(os.environ.get('UPLOAD_CACHE_SIZE', 6))
+
+# Версия конвейера расчета: увеличивается при изменении формул, чтобы не брать из кеша старые результаты /process
+PIPELINE_VERSION = 1
+
+
+class ClientAggregates:
+    """Агрегаты транзакций или переводов по клиентам
+    
+    Каждый кусок данных сразу сворачивается в суммы amount по (client_code, ключ) и в коды
+    клиентов для флагов, поэтому память зависит от числа клиентов, а не от числа строк.
+    """
+
+    def __init__(self, kind: str, flag_rules: Dict[str, tuple]):
+        self.kind = kind
+        self.key_column = AGGREGATE_KEYS[kind]
+        self.flag_rules = {flag: (column, predicate) for flag, (source, column, predicate) in flag_rules.items() if source == kind}
+        self.sums = None
+        self.flag_codes = {flag: np.array([], dtype=np.int64) for flag in self.flag_rules}
+        self.rows = 0
+        self.columns = []
+        self.sample = []
+        # {отпечаток предыдущей загрузки: коды клиентов, затронутых дозагрузками после нее}
+        self.lineage = {}
+        # sha256 порций, добавленных дозагрузками после полной загрузки (по ним повтор порции не добавляется)
+        self.applied = ()
+
+    def update(self, chunk: pd.DataFrame, warn_missing: bool = True) -> 'ClientAggregates':
+        """Добавление куска исходных строк в агрегаты
+        
+        warn_missing=False - отсутствие колонки флага пишется в журнал только на уровне DEBUG: у порций
+        онлайн-событий необязательных колонок (currency, product) часто нет, и это не ошибка загрузки.
+        """
+        if self.sums is None:
+            self.columns = list(chunk.columns)
+            self.sample = chunk.head().to_dict('records')
+        self.rows += len(chunk)
+        
+        # Суммы считаются в float64 независимо от сжатого типа amount; уровень ключа - обычные строки,
+        # чтобы куски с разными наборами категорий складывались без приведения категорий
+        amounts = chunk['amount'].astype(np.float64)
+        chunk_sums = amounts.groupby([chunk['client_code'], chunk[self.key_column]], observed=True).sum()
+        chunk_sums.index = chunk_sums.index.set_levels(chunk_sums.index.levels[1].astype(object), level=1)
+        self.sums = chunk_sums if self.sums is None else self.sums.add(chunk_sums, fill_value=0)
+        
+        for flag, (column, predicate) in self.flag_rules.items():
+            if column not in chunk:
+                if warn_missing:
+                    logger.warning(f"Колонка {column} отсутствует, флаг {flag} будет ложным для всех клиентов")
+                else:
+                    logger.debug(f"Колонка {column} отсутствует в порции, флаг {flag} по ней не ставится")
+                continue
+            mask = _evaluate_predicate(chunk[column], predicate)
+            self.flag_codes[flag] = np.union1d(self.flag_codes[flag], chunk.loc[mask, 'client_code'].unique())
+        return self
+
+    def appended(self, delta: 'ClientAggregates', parent: str, delta_sha256: str = None) -> 'ClientAggregates':
+        """Новые агрегаты с добавленной порцией delta; сам объект не меняется - его читают текущие данные
+        
+        parent - отпечаток загрузки, к которой добавляется порция. В lineage для нее и для предыдущих
+        загрузок копятся коды затронутых клиентов: по ним /process пересчитывает только этих клиентов.
+        delta_sha256 - хеш порции, он добавляется в applied.
+        """
+        combined = copy.copy(self)
+        if delta.sums is not None:
+            combined.sums = delta.sums if self.sums is None else self.sums.add(delta.sums, fill_value=0)
+        combined.flag_codes = {
+            flag: np.union1d(codes, delta.flag_codes.get(flag, codes[:0])) for flag, codes in self.flag_codes.items()
+        }
+        combined.rows = self.rows + delta.rows
+        if not self.columns:
+            combined.columns, combined.sample = delta.columns, delta.sample
+        
+        touched = delta.client_codes()
+        lineage = {ancestor: np.union1d(codes, touched) for ancestor, codes in self.lineage.items()}
+        if parent is not None:
+            lineage[parent] = touched
+        combined.lineage = dict(list(lineage.items())[-APPEND_LINEAGE_DEPTH:])
+        if delta_sha256 is not None:
+            combined.applied = (*self.applied_deltas(), delta_sha256)
+        return combined
+
+    def applied_deltas(self) -> tuple:
+        """sha256 порций, добавленных дозагрузками (у агрегатов, сохраненных до появления applied, - пусто)"""
+        return getattr(self, 'applied', ())
+
+    def client_codes(self) -> np.ndarray:
+        """Коды всех клиентов, встречающихся в суммах и флагах"""
+        codes = list(self.flag_codes.values())
+        if self.sums is not None:
+            codes.append(self.sums.index.get_level_values(0).unique().to_numpy())
+        return np.unique(np.concatenate(codes)) if codes else np.array([], dtype=np.int64)
+
+    def subset(self, client_codes) -> 'ClientAggregates':
+        """Агрегаты только указанных клиентов"""
+        part = copy.copy(self)
+        if self.sums is not None:
+            part.sums = self.sums[self.sums.index.get_level_values(0).isin(client_codes)]
+        part.flag_codes = {flag: codes[np.isin(codes, client_codes)] for flag, codes in self.flag_codes.items()}
+        part.lineage = {}
+        return part
+
+    def memory_usage(self) -> int:
+        """Память агрегатов в байтах"""
+        sums_bytes = 0 if self.sums is None else int(self.sums.memory_usage(index=True, deep=True))
+        return sums_bytes + sum(int(codes.nbytes) for codes in self.flag_codes.values())
+
+    def totals(self) -> pd.DataFrame:
+        """Суммы в виде таблицы client_code, ключ, amount"""
+        if self.sums is None:
+            return pd.DataFrame({'client_code': [], self.key_column: [], 'amount': []})
+        return self.sums.rename('amount').reset_index()
+
+
+# Схемы загружаемых файлов: только используемые пайплайном колонки и их компактные типы.
+# number - сужение числа до минимального типа без потерь, category - низкокардинальные строки
+INGEST_SCHEMAS = {
+    'clients': {
+        'client_code': 'number',
+        'name': 'object',
+        'status': 'category',
+        'age': 'number',
+        'city': 'category',
+        'avg_monthly_balance_KZT': 'number'
+    },
+    'transactions': {
+        'client_code': 'number',
+        'category': 'category',
+        'amount': 'number',
+        'currency': 'category',
+        'product': 'category'
+    },
+    'transfers': {
+        'client_code': 'number',
+        'type': 'category',
+        'direction': 'category',
+        'amount': 'number'
+    }
 }
 
+
+def _input_rows(data) -> int:
+    """Число исходных строк: у DataFrame - длина, у ClientAggregates - сколько строк в нее вошло"""
+    return data.rows if isinstance(data, ClientAggregates) else len(data)
+
+
+def _narrow_numeric(series: pd.Series) -> pd.Series:
+    """Сужение числовой колонки: целые - до минимального целого типа, дробные - до float32, если без потерь"""
+    if series.dtype.kind == 'i':
+        return pd.to_numeric(series, downcast='integer')
+    if series.dtype.kind == 'f':
+        narrowed = series.astype(np.float32)
+        if np.array_equal(narrowed.to_numpy(dtype=np.float64), series.to_numpy(), equal_nan=True):
+            return narrowed
+    return series
+
+
+def apply_ingest_schema(df: pd.DataFrame, kind: str) -> pd.DataFrame:
+    """Приведение загруженного DataFrame к компактной схеме INGEST_SCHEMAS[kind]"""
+    schema = INGEST_SCHEMAS[kind]
+    df = df[[col for col in df.columns if col in schema]]
+    columns = {}
+    for col in df.columns:
+        if schema[col] == 'category':
+            columns[col] = df[col].astype('category')
+        elif schema[col] == 'number':
+            columns[col] = _narrow_numeric(df[col])
+        else:
+            columns[col] = df[col]
+    return pd.DataFrame(columns, index=df.index)
+
+
+def ingest_read_options(kind: str, header: list = None) -> Dict[str, Any]:
+    """Параметры pd.read_csv по схеме INGEST_SCHEMAS[kind]: читаются только колонки схемы, категории - сразу категориями
+    
+    header - если задан, в него записываются все колонки заголовка файла (и пропущенные тоже).
+    """
+    schema = INGEST_SCHEMAS[kind]
+    
+    def usecols(col):
+        if header is not None:
+            header.append(col)
+        return col in schema
+    return {"usecols": usecols, "dtype": {col: 'category' for col, kind_ in schema.items() if kind_ == 'category'}}
+
+
+def default_memory(series: pd.Series) -> int:
+    """Оценка памяти колонки в типах pd.read_csv по умолчанию без построения такой колонки
+    
+    Числа - 8 байт на значение (int64/float64). У категорий память строковой колонки складывается
+    из значений, поэтому считается по одному значению каждой категории и числу его повторов.
+    """
+    if series.dtype.kind in 'iuf':
+        return 8 * len(series)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = series.cat.categories
+        if len(categories) == 0:
+            # Колонка из одних пропусков читается как float64
+            return 8 * len(series)
+        counts = np.bincount(series.cat.codes.to_numpy().astype(np.int64) + 1, minlength=len(categories) + 1)
+        costs = [pd.Series([np.nan], dtype='str').memory_usage(index=False, deep=True)]
+        costs += [pd.Series([value]).memory_usage(index=False, deep=True) for value in categories]
+        return int(np.dot(counts, costs))
+    return int(series.memory_usage(index=False, deep=True))
+
+
+def memory_report(compact: pd.DataFrame, header: list) -> Dict[str, Any]:
+    """Память по колонкам до и после сжатия (байты)
+    
+    "до" - оценка default_memory для типов pd.read_csv по умолчанию; колонки файла вне схемы не читаются:
+    у них "до" неизвестно (None), "после" - 0.
+    """
+    after_usage = compact.memory_usage(index=False, deep=True)
+    columns = {}
+    for col in header:
+        if col in compact.columns:
+            columns[col] = {"before": default_memory(compact[col]), "after": int(after_usage[col])}
+        else:
+            columns[col] = {"before": None, "after": 0}
+    return {
+        "columns": columns,
+        "total_before": sum(column["before"] for column in columns.values() if column["before"] is not None),
+        "total_after": int(after_usage.sum())
+    }
+
+
+def read_csv_compact(file, kind: str):
+    """Чтение CSV целиком сразу в компактной схеме; возвращает (DataFrame, отчет о памяти)
+    
+    Колонки вне схемы не читаются, категории строятся при разборе, числа сужаются по одной колонке,
+    поэтому DataFrame всего файла в типах по умолчанию не создается.
+    """
+    header = []
+    try:
+        raw = pd.read_csv(file, **ingest_read_options(kind, header))
+    except (ValueError, TypeError):
+        # Значения, которые не разбираются в типы схемы: используемые колонки читаются в типах по умолчанию
+        file.seek(0)
+        header.clear()
+        raw = pd.read_csv(file, usecols=ingest_read_options(kind, header)["usecols"])
+    compact = apply_ingest_schema(raw, kind)
+    return compact, memory_report(compact, header)
+
+
+def content_hash(stream, block_size: int = 1 << 20) -> str:
+    """sha256 содержимого загруженного файла; поток возвращается в начало для чтения CSV"""
+    digest = hashlib.sha256()
+    for block in iter(lambda: stream.read(block_size), b''):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class UploadCache:
+    """Кеш разобранных загрузок по (вид данных, режим, sha256 содержимого)
+    
+    Повторная загрузка побайтно того же файла не разбирается заново: возвращается тот же
+    компактный DataFrame или ClientAggregates. Вытесняются давно не использованные записи.
+    """
+
+    def __init__(self, max_entries: int = UPLOAD_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_or_parse(self, key: tuple, parse):
+        """(результат, True) из кеша или (parse(), False); разбор идет вне блокировки"""
+        with self._lock:
+            if key in self._entries:
+                # Переставляем запись в конец словаря - самые старые вытесняются первыми
+                value = self._entries[key] = self._entries.pop(key)
+                return value, True
+        
+        value = parse()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+        return value, False
+
+
+def read_csv_aggregates(file, kind: str, service: 'BankingMLService', chunksize: int = INGEST_CHUNK_SIZE) -> ClientAggregates:
+    """Потоковое чтение CSV кусками со сверткой каждого куска в агрегаты по клиентам"""
+    aggregates = ClientAggregates(kind, service.flag_rules)
+    reader = pd.read_csv(file, chunksize=chunksize, **ingest_read_options(kind))
+    for chunk in reader:
+        aggregates.update(apply_ingest_schema(chunk, kind))
+    return aggregates
+
+
+def _splitmix64(x):
+    """Перемешивающая функция SplitMix64 над массивом uint64 (переполнение - по модулю 2**64)"""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _splitmix64_int(x: int) -> int:
+    """_splitmix64 для одного числа на целых Python (для одного клиента быстрее массивов numpy)"""
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+def _stable_key(value) -> int:
+    """Стабильный между процессами 32-битный ключ значения (в отличие от hash())"""
+    return zlib.crc32(str(value).encode('utf-8'))
+
+
+class CounterNoise:
+    """Счетчиковый генератор случайных чисел
+    
+    Число для клиента - чистая функция от (client_code, продукт, версия датасета), поэтому
+    результат не зависит от порядка строк, от размера выборки и от других запросов:
+    любое подмножество клиентов в любом процессе получает те же значения.
+    
+    Версия датасета - метка выпуска данных, которую задает оператор (DATASET_VERSION), а не версия
+    снимка /process: иначе каждый /process менял бы выгоды всех клиентов, и не работали бы готовый
+    результат по ключу входных данных, пересчет только затронутых клиентов после дозагрузки и
+    совпадение /score с /process. Новая метка меняет config_fingerprint и требует полного расчета.
+    """
+
+    def __init__(self, dataset_version=1):
+        self.dataset_version = dataset_version
+        self._version_key = _splitmix64(np.array([_stable_key(dataset_version)], dtype=np.uint64))
+        self._product_seeds = {}
+
+    def _client_keys(self, client_codes) -> np.ndarray:
+        codes = np.asarray(client_codes)
+        if codes.dtype.kind == 'f' and np.all(np.mod(codes, 1) == 0):
+            codes = codes.astype(np.int64)
+        if codes.dtype.kind in 'iub':
+            return codes.astype(np.int64).view(np.uint64)
+        return np.fromiter((_stable_key(code) for code in codes), dtype=np.uint64, count=len(codes))
+
+    def _product_seed(self, product: str) -> np.uint64:
+        seed = self._product_seeds.get(product)
+        if seed is None:
+            seed = self._product_seeds[product] = _splitmix64(self._version_key ^ np.uint64(_stable_key(product)))[0]
+        return seed
+
+    def uniform(self, client_codes, product: str) -> np.ndarray:
+        """Вектор равномерных чисел в [0, 1) для client_codes по продукту"""
+        bits = _splitmix64(self._client_keys(client_codes) ^ self._product_seed(product))
+        return (bits >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+    def value(self, client_code, product: str) -> float:
+        """То же число, что uniform([client_code], product)[0], без массивов numpy"""
+        if isinstance(client_code, float) and client_code.is_integer():
+            client_code = int(client_code)
+        if isinstance(client_code, (int, np.integer)):
+            key = int(client_code) & _MASK64
+        else:
+            key = _stable_key(client_code)
+        bits = _splitmix64_int(key ^ int(self._product_seed(product)))
+        return (bits >> 11) * (1.0 / (1 << 53))
+
+
 class BankingMLService:
     """Сервис для ML анализа банковских данных и рекомендаций продуктов"""
     
-    def __init__(self):
+    def __init__(self, benefit_engine: str = 'vectorized', dataset_version=1):
+        if benefit_engine not in BENEFIT_ENGINES:
+            raise ValueError(f"Неизвестный движок расчета выгоды: {benefit_engine}")
+        self.benefit_engine = benefit_engine
+        
         # Улучшенные формулы с более реалистичными расчетами и разнообразием
         self.benefit_formulas = {
-            'Депозит Сберегательный': lambda row: self._calculate_deposit_benefit(row, 0.165, 50000, 200000),
+            'Депозит Сберегательный': lambda row: self._calculate_deposit_benefit(row, 'Депозит Сберегательный', 0.165, 50000, 200000),
             'Кредит наличными': lambda row: self._calculate_credit_benefit(row),
             'Карта для путешествий': lambda row: self._calculate_travel_card_benefit(row),
             'Кредитная карта': lambda row: self._calculate_credit_card_benefit(row),
             'Премиальная карта': lambda row: self._calculate_premium_card_benefit(row),
             'Мультивалютный счет': lambda row: self._calculate_fx_account_benefit(row),
-            'Депозит Накопительный': lambda row: self._calculate_deposit_benefit(row, 0.155, 30000, 150000),
-            'Депозит Мультивалютный': lambda row: self._calculate_deposit_benefit(row, 0.145, 40000, 180000),
+            'Депозит Накопительный': lambda row: self._calculate_deposit_benefit(row, 'Депозит Накопительный', 0.155, 30000, 150000),
+            'Депозит Мультивалютный': lambda row: self._calculate_deposit_benefit(row, 'Депозит Мультивалютный', 0.145, 40000, 180000),
             'Инвестиции': lambda row: self._calculate_investment_benefit(row),
             'Золотые слитки': lambda row: self._calculate_gold_benefit(row)
         }
         
+        # Те же формулы в векторном виде: считают колонку выгоды сразу для всех клиентов
+        self.vectorized_benefit_formulas = {
+            'Депозит Сберегательный': lambda df: self._vectorized_deposit_benefit(df, 'Депозит Сберегательный', 0.165, 50000, 200000),
+            'Кредит наличными': lambda df: self._vectorized_credit_benefit(df),
+            'Карта для путешествий': lambda df: self._vectorized_travel_card_benefit(df),
+            'Кредитная карта': lambda df: self._vectorized_credit_card_benefit(df),
+            'Премиальная карта': lambda df: self._vectorized_premium_card_benefit(df),
+            'Мультивалютный счет': lambda df: self._vectorized_fx_account_benefit(df),
+            'Депозит Накопительный': lambda df: self._vectorized_deposit_benefit(df, 'Депозит Накопительный', 0.155, 30000, 150000),
+            'Депозит Мультивалютный': lambda df: self._vectorized_deposit_benefit(df, 'Депозит Мультивалютный', 0.145, 40000, 180000),
+            'Инвестиции': lambda df: self._vectorized_investment_benefit(df),
+            'Золотые слитки': lambda df: self._vectorized_gold_benefit(df)
+        }
+        
+        # Флаги клиентов: имя -> (источник, колонка, предикат (оператор, значение)).
+        # Клиент получает флаг, если хотя бы одна его строка источника удовлетворяет предикату.
+        self.flag_rules = {
+            'HAS_FX': ('transactions', 'currency', ('!=', 'KZT')),
+            'HAS_CC': ('transactions', 'product', ('contains', 'Кредит')),
+            'HAS_ATM_P2P': ('transfers', 'type', ('contains', 'atm|p2p'))
+        }
+        
         self.benefit_caps = {
             'Депозит Сберегательный': 100000,  # Максимум 100k в месяц
             'Кредит наличными': 200000,  # Максимум 200k в месяц
@@ -59,9 +617,25 @@ class BankingMLService:
             'Золотые слитки': 100000  # Максимум 100k потенциального дохода
         }
         
-        # Инициализация генератора случайных чисел для разнообразия
-        import random
-        self.random = random.Random(42)  # Фиксированное seed для воспроизводимости
+        # Группируем продукты по типам
+        self.product_groups = {
+            'deposits': ['Депозит Сберегательный', 'Депозит Накопительный', 'Депозит Мультивалютный'],
+            'cards': ['Кредитная карта', 'Премиальная карта', 'Карта для путешествий'],
+            'investments': ['Инвестиции', 'Золотые слитки'],
+            'other': ['Кредит наличными', 'Мультивалютный счет']
+        }
+        
+        # Целевое распределение (в процентах) - более сбалансированное
+        self.target_distribution = {
+            'deposits': 0.30,  # 30% депозиты
+            'cards': 0.40,     # 40% карты
+            'investments': 0.20, # 20% инвестиции
+            'other': 0.10      # 10% прочее
+        }
+        
+        # Счетчиковый генератор случайных чисел для разнообразия: значение зависит только
+        # от (client_code, продукт, версия датасета), а не от порядка обработки клиентов
+        self.noise = CounterNoise(dataset_version)
         
         # Шаблоны для пуш-уведомлений
         self.push_templates = {
@@ -77,104 +651,264 @@ class BankingMLService:
             'Золотые слитки': "{name}, рассмотрите золотые слитки для диверсификации портфеля. Узнать подробнее."
         }
 
-    def process_data(self, clients_df: pd.DataFrame, transactions_df: pd.DataFrame, transfers_df: pd.DataFrame) -> pd.DataFrame:
-        """Обработка и объединение всех данных"""
+    def config_fingerprint(self) -> Dict[str, Any]:
+        """Настройки, от которых зависит результат /process при тех же входных данных"""
+        return {
+            "pipeline": PIPELINE_VERSION,
+            "engine": self.benefit_engine,
+            "dataset_version": str(self.noise.dataset_version),
+            "product_groups": self.product_groups,
+            "target_distribution": self.target_distribution
+        }
+
+    def aggregate(self, kind: str, data, warn_missing: bool = True) -> 'ClientAggregates':
+        """Агрегаты по клиентам для транзакций/переводов: из DataFrame или уже готовые (потоковая загрузка)
+        
+        warn_missing=False - для порций онлайн-событий (см. ClientAggregates.update).
+        """
+        if isinstance(data, ClientAggregates):
+            return data
+        return ClientAggregates(kind, self.flag_rules).update(data, warn_missing)
+
+    def process_data(self, clients_df: pd.DataFrame, transactions_df, transfers_df, progress=None) -> pd.DataFrame:
+        """Обработка и объединение всех данных
+        
+        transactions_df и transfers_df - исходные DataFrame или ClientAggregates из потоковой загрузки.
+        progress(stage, rows) вызывается в начале стадий 'aggregation' и 'flags'.
+        Последовательно выполняет стадии transaction_metrics, transfer_metrics, collect_flag_codes
+        и merge_features (по отдельности их кеширует StagedPipeline).
+        """
+        progress = progress or _no_progress
         try:
-            # Агрегация транзакций
-            df_transactions_agg = transactions_df.groupby(['client_code', 'category'])['amount'].sum().reset_index()
-            df_transactions_agg = df_transactions_agg.rename(columns={'amount': 'total_spent'})
-            
-            # Агрегация переводов
-            df_transfers_agg = transfers_df.groupby(['client_code', 'direction'])['amount'].sum().reset_index()
-            df_transfers_agg = df_transfers_agg.rename(columns={'amount': 'total_transfer_amount'})
-            
-            # Расчет месячных метрик
-            df_transactions_monthly = df_transactions_agg.copy()
-            df_transactions_monthly['TOTAL_m'] = df_transactions_monthly.groupby('client_code')['total_spent'].transform('sum') / 3
-            
-            df_transactions_pivot = df_transactions_agg.pivot(index='client_code', columns='category', values='total_spent').fillna(0)
-            df_transactions_monthly_pivot = df_transactions_pivot / 3
-            df_transactions_monthly_pivot.columns = [col + '_m' for col in df_transactions_monthly_pivot.columns]
-            
-            # TRAVEL_m
-            travel_categories = [col for col in df_transactions_monthly_pivot.columns if 'Такси' in col or 'Путешествия' in col or 'Отели' in col]
-            df_transactions_monthly_pivot['TRAVEL_m'] = df_transactions_monthly_pivot[travel_categories].sum(axis=1)
-            
-            # ONLINE_m
-            online_categories = [col for col in df_transactions_monthly_pivot.columns if 'Играем дома' in col or 'Смотрим дома' in col or 'Едим дома' in col]
-            df_transactions_monthly_pivot['ONLINE_m'] = df_transactions_monthly_pivot[online_categories].sum(axis=1)
-            
-            # TOP3_m
-            def get_top3_sum(row):
-                return row.nlargest(3).sum()
-            
-            df_transactions_monthly_pivot['TOP3_m'] = df_transactions_monthly_pivot.drop(columns=['TRAVEL_m', 'ONLINE_m']).apply(get_top3_sum, axis=1)
-            
-            # Переводы
-            df_transfers_in_monthly = df_transfers_agg[df_transfers_agg['direction'] == 'in'].copy()
-            df_transfers_in_monthly['INFLOWS_m'] = df_transfers_in_monthly['total_transfer_amount'] / 3
-            
-            df_transfers_out_monthly = df_transfers_agg[df_transfers_agg['direction'] == 'out'].copy()
-            df_transfers_out_monthly['OUTFLOWS_m'] = df_transfers_out_monthly['total_transfer_amount'] / 3
-            
-            # Объединение метрик
-            df_monthly_metrics = df_transactions_monthly_pivot.merge(
-                df_transfers_in_monthly[['client_code', 'INFLOWS_m']],
-                on='client_code',
-                how='left'
-            ).merge(
-                df_transfers_out_monthly[['client_code', 'OUTFLOWS_m']],
-                on='client_code',
-                how='left'
-            )
+            progress('aggregation', _input_rows(transactions_df) + _input_rows(transfers_df))
+            transactions = self.transaction_metrics(transactions_df)
+            transfers = self.transfer_metrics(transfers_df)
             
-            df_monthly_metrics = df_monthly_metrics.merge(
-                df_transactions_monthly[['client_code', 'TOTAL_m']].drop_duplicates(),
-                on='client_code',
-                how='left'
-            )
-            
-            df_monthly_metrics.fillna(0, inplace=True)
-            
-            # Расчет флагов
-            df_flags = pd.DataFrame({'client_code': clients_df['client_code'].unique()})
-            
-            # HAS_FX
-            df_transactions_fx = transactions_df[transactions_df['currency'] != 'KZT']['client_code'].unique()
-            df_flags['HAS_FX'] = df_flags['client_code'].apply(lambda x: x in df_transactions_fx)
-            
-            # HAS_CC
-            df_transactions_cc = transactions_df[transactions_df['product'].fillna('').str.contains('Кредит', na=False)]['client_code'].unique()
-            df_flags['HAS_CC'] = df_flags['client_code'].apply(lambda x: x in df_transactions_cc)
-            
-            # HAS_ATM_P2P
-            df_transfers_atm_p2p = transfers_df[transfers_df['type'].fillna('').str.contains('atm|p2p', na=False)]['client_code'].unique()
-            df_flags['HAS_ATM_P2P'] = df_flags['client_code'].apply(lambda x: x in df_transfers_atm_p2p)
-            
-            # Объединение всех данных
-            df_merged = clients_df.merge(df_monthly_metrics, on='client_code', how='left')
-            df_merged = df_merged.merge(df_flags, on='client_code', how='left')
-            
-            return df_merged
+            progress('flags', len(clients_df))
+            flag_codes = self.collect_flag_codes(transactions, transfers)
+            return self.merge_features(clients_df, transactions, transfers, flag_codes)
             
         except Exception as e:
             logger.error(f"Ошибка при обработке данных: {str(e)}")
             raise
 
-    def calculate_benefits(self, df_merged: pd.DataFrame) -> pd.DataFrame:
-        """Расчет выгоды по продуктам с улучшенной логикой"""
+    def transaction_metrics(self, transactions_df, categories: list = None) -> Dict[str, Any]:
+        """Стадия агрегации транзакций: агрегаты, месячные траты по категориям, TRAVEL_m, ONLINE_m, TOP3_m и TOTAL_m
+        
+        categories - полный список категорий, когда метрики считаются для части клиентов
+        (колонки должны совпасть с расчетом по всем клиентам).
+        """
+        transactions_agg = self.aggregate('transactions', transactions_df)
+        df_transactions_agg = transactions_agg.totals().rename(columns={'amount': 'total_spent'})
+        
+        # Расчет месячных метрик
+        df_transactions_monthly = df_transactions_agg.copy()
+        df_transactions_monthly['TOTAL_m'] = df_transactions_monthly.groupby('client_code')['total_spent'].transform('sum') / 3
+        
+        df_transactions_pivot = df_transactions_agg.pivot(index='client_code', columns='category', values='total_spent').fillna(0)
+        if categories is not None:
+            df_transactions_pivot = df_transactions_pivot.reindex(columns=categories, fill_value=0)
+        df_transactions_monthly_pivot = df_transactions_pivot / 3
+        df_transactions_monthly_pivot.columns = [col + '_m' for col in df_transactions_monthly_pivot.columns]
+        
+        # TRAVEL_m
+        travel_categories = [col for col in df_transactions_monthly_pivot.columns if _has_marker(col, TRAVEL_CATEGORY_MARKERS)]
+        df_transactions_monthly_pivot['TRAVEL_m'] = df_transactions_monthly_pivot[travel_categories].sum(axis=1)
+        
+        # ONLINE_m
+        online_categories = [col for col in df_transactions_monthly_pivot.columns if _has_marker(col, ONLINE_CATEGORY_MARKERS)]
+        df_transactions_monthly_pivot['ONLINE_m'] = df_transactions_monthly_pivot[online_categories].sum(axis=1)
+        
+        # TOP3_m и топ-категории: один проход частичной сортировки по всем клиентам
+        category_names = np.asarray(df_transactions_pivot.columns, dtype=object)
+        category_values = df_transactions_monthly_pivot.drop(columns=['TRAVEL_m', 'ONLINE_m']).to_numpy()
+        top_indices, top_values = self.compute_top_k(category_values)
+        df_transactions_monthly_pivot['TOP3_m'] = top_values.sum(axis=1)
+        
+        # Названия топ-категорий для пуш-уведомлений (только категории с ненулевыми тратами)
+        for rank in range(top_indices.shape[1]):
+            names = category_names[top_indices[:, rank]]
+            df_transactions_monthly_pivot[f'top_category_{rank + 1}'] = np.where(top_values[:, rank] > 0, names, None)
+        
+        return {
+            "aggregates": transactions_agg,
+            "categories": list(df_transactions_pivot.columns),
+            "monthly": df_transactions_monthly_pivot,
+            "total": df_transactions_monthly[['client_code', 'TOTAL_m']].drop_duplicates()
+        }
+
+    def transfer_metrics(self, transfers_df) -> Dict[str, Any]:
+        """Стадия агрегации переводов: агрегаты и месячные INFLOWS_m / OUTFLOWS_m"""
+        transfers_agg = self.aggregate('transfers', transfers_df)
+        df_transfers_agg = transfers_agg.totals().rename(columns={'amount': 'total_transfer_amount'})
+        
+        df_transfers_in_monthly = df_transfers_agg[df_transfers_agg['direction'] == 'in'].copy()
+        df_transfers_in_monthly['INFLOWS_m'] = df_transfers_in_monthly['total_transfer_amount'] / 3
+        
+        df_transfers_out_monthly = df_transfers_agg[df_transfers_agg['direction'] == 'out'].copy()
+        df_transfers_out_monthly['OUTFLOWS_m'] = df_transfers_out_monthly['total_transfer_amount'] / 3
+        
+        return {
+            "aggregates": transfers_agg,
+            "inflows": df_transfers_in_monthly[['client_code', 'INFLOWS_m']],
+            "outflows": df_transfers_out_monthly[['client_code', 'OUTFLOWS_m']]
+        }
+
+    def collect_flag_codes(self, transactions: Dict[str, Any], transfers: Dict[str, Any]) -> Dict[str, np.ndarray]:
+        """Стадия флагов: коды клиентов, для которых выполняется каждое правило self.flag_rules"""
+        sources = {'transactions': transactions["aggregates"], 'transfers': transfers["aggregates"]}
+        return {
+            flag: sources[source].flag_codes.get(flag, np.array([], dtype=np.int64))
+            for flag, (source, column, predicate) in self.flag_rules.items()
+        }
+
+    def merge_features(self, clients_df: pd.DataFrame, transactions: Dict[str, Any], transfers: Dict[str, Any],
+                       flag_codes: Dict[str, np.ndarray]) -> pd.DataFrame:
+        """Стадия объединения: клиенты, месячные метрики и флаги в одну таблицу признаков"""
+        # Объединение метрик
+        df_monthly_metrics = transactions["monthly"].merge(
+            transfers["inflows"],
+            on='client_code',
+            how='left'
+        ).merge(
+            transfers["outflows"],
+            on='client_code',
+            how='left'
+        )
+        
+        df_monthly_metrics = df_monthly_metrics.merge(
+            transactions["total"],
+            on='client_code',
+            how='left'
+        )
+        
+        # Пропуски в суммах - нулевые траты; топ-категории без трат остаются пустыми
+        category_columns = [col for col in df_monthly_metrics.columns if col.startswith('top_category_')]
+        amount_columns = df_monthly_metrics.columns.difference(category_columns)
+        df_monthly_metrics[amount_columns] = df_monthly_metrics[amount_columns].fillna(0)
+        
+        # Флаги клиентов
+        df_flags = self.compute_flags(clients_df['client_code'].unique(), flag_codes)
+        
+        # Объединение всех данных
+        df_merged = clients_df.merge(df_monthly_metrics, on='client_code', how='left')
+        df_merged = df_merged.merge(df_flags, on='client_code', how='left')
+        
+        return df_merged
+
+    def compute_top_k(self, values: np.ndarray, k: int = TOP_K):
+        """Индексы и значения k наибольших трат в каждой строке матрицы клиент x категория
+        
+        Используется частичная сортировка (np.partition) вместо полной сортировки строк.
+        При равных тратах раньше идет категория с меньшим индексом, как при стабильной сортировке.
+        Возвращает (индексы, значения) размером (клиенты, k), упорядоченные по убыванию.
+        """
+        n_rows, n_cols = values.shape
+        k = min(k, n_cols)
+        if k == 0:
+            return np.empty((n_rows, 0), dtype=np.intp), np.empty((n_rows, 0))
+        
+        # k-е по величине значение строки и отбор ровно k колонок с учетом равенств
+        kth = np.partition(values, n_cols - k, axis=1)[:, n_cols - k][:, None]
+        greater = values > kth
+        equal = values == kth
+        need = k - greater.sum(axis=1, keepdims=True)
+        selected = greater | (equal & (np.cumsum(equal, axis=1) <= need))
+        
+        top_indices = np.nonzero(selected)[1].reshape(n_rows, k)
+        top_values = np.take_along_axis(values, top_indices, axis=1)
+        order = np.argsort(-top_values, axis=1, kind='stable')
+        return np.take_along_axis(top_indices, order, axis=1), np.take_along_axis(top_values, order, axis=1)
+
+    def compute_flags(self, client_codes, flag_codes: Dict[str, np.ndarray]) -> pd.DataFrame:
+        """Расчет булевых флагов клиентов по правилам self.flag_rules
+        
+        Коды клиентов для каждого флага собираются при агрегации источника (collect_flag_codes),
+        а проверка принадлежности делается через хеш-таблицу (isin), поэтому время линейно
+        по числу клиентов и строк источников.
+        """
+        df_flags = pd.DataFrame({'client_code': client_codes})
+        for flag in self.flag_rules:
+            df_flags[flag] = df_flags['client_code'].isin(flag_codes.get(flag, []))
+        return df_flags
+
+    def client_features(self, profile: Dict[str, Any], transactions: list = (), transfers: list = (),
+                        monthly: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Признаки одного клиента без DataFrame - те же колонки, что у строки таблицы признаков
+        
+        transactions и transfers - исходные строки (как в CSV, за 3 месяца), monthly - уже посчитанные
+        месячные значения в именах колонок: траты категорий ('<категория>_m'), INFLOWS_m, OUTFLOWS_m и флаги.
+        Значения из monthly складываются с посчитанными по строкам.
+        """
+        features = dict(profile)
+        features.update({column: 0.0 for column in MONTHLY_METRIC_COLUMNS})
+        for record in transactions:
+            self.add_spending(features, record['category'], float(record['amount']) / 3)
+        for record in transfers:
+            if record['direction'] in TRANSFER_FLOW_COLUMNS:
+                features[TRANSFER_FLOW_COLUMNS[record['direction']]] += float(record['amount']) / 3
+        
+        # Флаг - хотя бы одна строка источника удовлетворяет правилу (строки без колонки не подходят)
+        sources = {'transactions': transactions, 'transfers': transfers}
+        for flag, (source, column, predicate) in self.flag_rules.items():
+            features[flag] = any(column in record and _matches_predicate(record[column], predicate) for record in sources[source])
+        
+        for column, value in (monthly or {}).items():
+            if column in self.flag_rules:
+                features[column] = features[column] or bool(value)
+            elif column in TRANSFER_FLOW_COLUMNS.values():
+                features[column] += float(value)
+            elif column.endswith('_m') and column not in MONTHLY_METRIC_COLUMNS:
+                self.add_spending(features, column[:-len('_m')], float(value))
+            else:
+                raise ValueError(f"Неизвестная месячная метрика: {column}")
+        
+        # Категории в алфавитном порядке, как колонки сводной таблицы при расчете
+        self.update_top_categories(features, sorted(
+            column for column in features if column.endswith('_m') and column not in MONTHLY_METRIC_COLUMNS
+        ))
+        return features
+
+    def add_spending(self, features: Dict[str, Any], category: str, monthly: float):
+        """Месячные траты категории в признаках клиента и зависящие от них TRAVEL_m, ONLINE_m и TOTAL_m"""
+        column = f'{category}_m'
+        features[column] = features.get(column, 0.0) + monthly
+        features['TOTAL_m'] += monthly
+        if _has_marker(column, TRAVEL_CATEGORY_MARKERS):
+            features['TRAVEL_m'] += monthly
+        if _has_marker(column, ONLINE_CATEGORY_MARKERS):
+            features['ONLINE_m'] += monthly
+
+    def update_top_categories(self, features: Dict[str, Any], columns: list):
+        """TOP3_m и топ-категории клиента по колонкам трат columns (их порядок решает при равных тратах)"""
+        values = np.array([[features.get(column, 0.0) for column in columns]], dtype=np.float64)
+        top_indices, top_values = self.compute_top_k(values)
+        features['TOP3_m'] = float(top_values.sum())
+        features.update({f'top_category_{rank}': None for rank in range(1, TOP_K + 1)})
+        for rank in range(top_indices.shape[1]):
+            name = columns[top_indices[0, rank]][:-len('_m')]
+            features[f'top_category_{rank + 1}'] = name if top_values[0, rank] > 0 else None
+
+    def calculate_benefits(self, df_merged: pd.DataFrame, engine: str = None, progress=None) -> pd.DataFrame:
+        """Расчет выгоды по продуктам с улучшенной логикой
+        
+        engine: 'vectorized' (по умолчанию) или 'rowwise' - прежний построчный расчет.
+        progress(stage, rows) вызывается перед каждым продуктом ('benefits') и перед назначением ('diversity').
+        """
+        engine = engine or self.benefit_engine
+        progress = progress or _no_progress
         try:
+            if engine not in BENEFIT_ENGINES:
+                raise ValueError(f"Неизвестный движок расчета выгоды: {engine}")
+            
             # Расчет выгоды для каждого продукта
-            for product, formula in self.benefit_formulas.items():
-                benefit_col_name = f'benefit_{product}'
-                df_merged[benefit_col_name] = df_merged.apply(formula, axis=1)
-                df_merged[benefit_col_name] = df_merged[benefit_col_name].clip(lower=0)
-                
-                if product in self.benefit_caps:
-                    df_merged[benefit_col_name] = df_merged[benefit_col_name].clip(upper=self.benefit_caps[product])
+            df_benefits = self.compute_benefits(df_merged, engine, progress)
+            for benefit_col_name in df_benefits.columns:
+                df_merged[benefit_col_name] = df_benefits[benefit_col_name]
             
             # Добавляем разнообразие через взвешенное ранжирование
-            df_merged = self._apply_diverse_ranking(df_merged)
+            progress('diversity', len(df_merged))
+            df_merged = self._apply_diverse_ranking(df_merged, engine)
             
             return df_merged
             
@@ -182,32 +916,160 @@ class BankingMLService:
             logger.error(f"Ошибка при расчете выгоды: {str(e)}")
             raise
 
-    def _apply_diverse_ranking(self, df_merged: pd.DataFrame) -> pd.DataFrame:
+    def compute_benefits(self, df_merged: pd.DataFrame, engine: str = None, progress=None) -> pd.DataFrame:
+        """Стадия выгоды: колонки benefit_<продукт> для таблицы признаков (сама таблица не меняется)"""
+        engine = engine or self.benefit_engine
+        progress = progress or _no_progress
+        df_benefits = pd.DataFrame(index=df_merged.index)
+        for product, formula in self.benefit_formulas.items():
+            progress('benefits', len(df_merged))
+            benefit_col_name = f'benefit_{product}'
+            if engine == 'vectorized':
+                benefit = self.vectorized_benefit_formulas[product](df_merged)
+            else:
+                benefit = df_merged.apply(formula, axis=1)
+            benefit = pd.Series(benefit, index=df_merged.index).clip(lower=0)
+            
+            if product in self.benefit_caps:
+                benefit = benefit.clip(upper=self.benefit_caps[product])
+            df_benefits[benefit_col_name] = benefit
+        return df_benefits
+
+    def client_benefits(self, features: Dict[str, Any]) -> np.ndarray:
+        """Выгоды одного клиента по словарю признаков в порядке self.benefit_formulas
+        
+        Считается построчными формулами без DataFrame (результат тот же, что у compute_benefits),
+        поэтому подходит для пересчета отдельных клиентов на лету.
+        """
+        benefits = np.empty(len(self.benefit_formulas), dtype=np.float64)
+        for position, (product, formula) in enumerate(self.benefit_formulas.items()):
+            benefit = max(formula(features), 0)
+            if product in self.benefit_caps:
+                benefit = min(benefit, self.benefit_caps[product])
+            benefits[position] = benefit
+        return benefits
+
+    def top_products(self, benefits: np.ndarray, limit: int = 4) -> List[int]:
+        """Индексы до limit продуктов с положительной выгодой по убыванию выгоды (как для клиентов без квоты)"""
+        order = np.argsort(-benefits, kind='stable')[:limit]
+        return [int(product) for product in order if benefits[product] > 0]
+
+    def assign_ranking(self, df_merged: pd.DataFrame, df_benefits: pd.DataFrame, engine: str = None) -> Dict[str, Any]:
+        """Ранжирование с состоянием для дозагрузок: таблица рекомендаций, пары выгод и результат назначения
+        
+        Для векторного движка кроме таблицы ("frame") возвращаются упорядоченные пары выгод ("pairs"),
+        назначенные продукты ("assigned") и лучшие продукты ("ranked") - по ним rerank пересчитывает
+        назначение после изменения части строк. У построчного движка состояния нет (None).
+        """
+        if (engine or self.benefit_engine) == 'rowwise':
+            ranking_input = pd.concat([df_merged[['client_code']], df_benefits], axis=1)
+            ranked = self._apply_diverse_ranking(ranking_input, engine)
+            return {"frame": ranked[['top4_products', 'ranked_products', 'assigned_product']], "pairs": None, "assigned": None, "ranked": None}
+        
+        benefits = df_benefits.to_numpy(dtype=np.float64)
+        pairs = self.benefit_pairs(benefits)
+        return self._ranking_state(df_merged, df_benefits, benefits, pairs)
+
+    def rerank(self, state: Dict[str, Any], df_merged: pd.DataFrame, df_benefits: pd.DataFrame, positions: np.ndarray) -> Dict[str, Any]:
+        """Назначение заново после пересчета выгод строк positions
+        
+        Упорядоченные пары выгод не сортируются заново, а обновляются за O(E); списки рекомендаций
+        пересобираются только у строк, чье назначение изменилось. Результат совпадает с assign_ranking.
+        """
+        benefits = df_benefits.to_numpy(dtype=np.float64)
+        pairs = self.update_benefit_pairs(state["pairs"], benefits, positions)
+        return self._ranking_state(df_merged, df_benefits, benefits, pairs, state)
+
+    def _ranking_state(self, df_merged, df_benefits, benefits, pairs, previous=None) -> Dict[str, Any]:
+        """Назначение по готовым парам выгод; при previous списки меняются только у изменившихся строк"""
+        products = [col.replace('benefit_', '') for col in df_benefits.columns]
+        assigned, ranked = self.assign_products(
+            benefits, df_merged['client_code'].to_numpy(), products, self.product_groups, self.target_distribution, pairs
+        )
+        if previous is None:
+            frame = pd.DataFrame(index=df_merged.index)
+            frame['top4_products'] = self._top4_lists(products, assigned, ranked)
+        else:
+            changed = np.flatnonzero((assigned != previous["assigned"]) | (ranked != previous["ranked"]).any(axis=1))
+            frame = previous["frame"].copy(deep=False)
+            top4 = frame['top4_products'].to_numpy(dtype=object, copy=True)
+            lists = self._top4_lists(products, assigned[changed], ranked[changed])
+            for position, products_list in zip(changed, lists):
+                top4[position] = products_list
+            frame['top4_products'] = top4
+        frame['ranked_products'] = frame['top4_products']
+        frame['assigned_product'] = self._assigned_column(products, assigned)
+        return {"frame": frame, "pairs": pairs, "assigned": assigned, "ranked": ranked}
+
+    def _top4_lists(self, products: list, assigned: np.ndarray, ranked: np.ndarray) -> list:
+        """Назначенный по квоте продукт или до 4 лучших по выгоде для каждой строки"""
+        products = np.asarray(products, dtype=object)
+        return [
+            [products[product]] if product >= 0 else [products[i] for i in row if i >= 0]
+            for product, row in zip(assigned, ranked)
+        ]
+
+    def _assigned_column(self, products: list, assigned: np.ndarray) -> pd.Categorical:
+        """Назначенный по квоте продукт каждой строки (пропуск - без назначения) для колонки assigned_product"""
+        return pd.Categorical.from_codes(assigned, categories=products)
+
+    def benefit_pairs(self, benefits: np.ndarray):
+        """Пары (строка, продукт) с выгодой > 0 по убыванию выгоды, при равенстве - по строкам и колонкам
+        
+        Возвращает (строки, продукты, выгоды) в этом порядке.
+        """
+        rows, cols = np.nonzero(benefits > 0)
+        values = benefits[rows, cols]
+        order = np.argsort(-values, kind='stable')
+        return rows[order], cols[order], values[order]
+
+    def update_benefit_pairs(self, pairs, benefits: np.ndarray, positions: np.ndarray):
+        """Пары выгод после пересчета строк positions без полной сортировки
+        
+        Пары этих строк удаляются, новые пары (их мало) сортируются и вставляются бинарным поиском
+        на свои места - порядок тот же, что дал бы benefit_pairs.
+        """
+        rows, cols, values = pairs
+        n_cols = benefits.shape[1]
+        touched = np.zeros(len(benefits), dtype=bool)
+        touched[positions] = True
+        keep = ~touched[rows]
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+        
+        part = benefits[positions]
+        part_rows, new_cols = np.nonzero(part > 0)
+        new_rows, new_values = positions[part_rows], part[part_rows, new_cols]
+        new_keys = new_rows.astype(np.int64) * n_cols + new_cols
+        order = np.lexsort((new_keys, -new_values))
+        new_rows, new_cols, new_values, new_keys = new_rows[order], new_cols[order], new_values[order], new_keys[order]
+        
+        # Место вставки: за всеми парами с большей выгодой, а при равной выгоде - по строке и колонке
+        negated = -values
+        low = np.searchsorted(negated, -new_values, side='left')
+        high = np.searchsorted(negated, -new_values, side='right')
+        insert_at = low.copy()
+        tied = np.flatnonzero(high > low)
+        if len(tied):
+            keys = rows.astype(np.int64) * n_cols + cols
+            for i in tied:
+                insert_at[i] = low[i] + np.searchsorted(keys[low[i]:high[i]], new_keys[i])
+        
+        return (np.insert(rows, insert_at, new_rows), np.insert(cols, insert_at, new_cols),
+                np.insert(values, insert_at, new_values))
+
+    def _apply_diverse_ranking(self, df_merged: pd.DataFrame, engine: str = None) -> pd.DataFrame:
         """Применяет разнообразное ранжирование с принудительным разнообразием"""
         benefit_columns = [col for col in df_merged.columns if col.startswith('benefit_')]
         
         # Применяем принудительное разнообразие
-        df_merged = self._apply_forced_diversity(df_merged, benefit_columns)
+        df_merged = self._apply_forced_diversity(df_merged, benefit_columns, engine)
         
         return df_merged
 
-    def _apply_forced_diversity(self, df_merged: pd.DataFrame, benefit_columns: list) -> pd.DataFrame:
+    def _apply_forced_diversity(self, df_merged: pd.DataFrame, benefit_columns: list, engine: str = None) -> pd.DataFrame:
         """Применяет принудительное разнообразие рекомендаций"""
-        # Группируем продукты по типам
-        product_groups = {
-            'deposits': ['Депозит Сберегательный', 'Депозит Накопительный', 'Депозит Мультивалютный'],
-            'cards': ['Кредитная карта', 'Премиальная карта', 'Карта для путешествий'],
-            'investments': ['Инвестиции', 'Золотые слитки'],
-            'other': ['Кредит наличными', 'Мультивалютный счет']
-        }
-        
-        # Целевое распределение (в процентах) - более сбалансированное
-        target_distribution = {
-            'deposits': 0.30,  # 30% депозиты
-            'cards': 0.40,     # 40% карты
-            'investments': 0.20, # 20% инвестиции
-            'other': 0.10      # 10% прочее
-        }
+        product_groups = self.product_groups
+        target_distribution = self.target_distribution
         
         # Создаем пул продуктов для каждого клиента
         def create_diverse_recommendations(row):
@@ -254,12 +1116,115 @@ class BankingMLService:
             return diverse_products[:4]  # Возвращаем максимум 4 продукта
         
         # Применяем глобальное разнообразие
-        df_merged = self._apply_global_diversity(df_merged, benefit_columns, product_groups, target_distribution)
+        if (engine or self.benefit_engine) == 'rowwise':
+            df_merged = self._apply_global_diversity_rowwise(df_merged, benefit_columns, product_groups, target_distribution)
+        else:
+            df_merged = self._apply_global_diversity(df_merged, benefit_columns, product_groups, target_distribution)
         
         return df_merged
 
     def _apply_global_diversity(self, df_merged: pd.DataFrame, benefit_columns: list, product_groups: dict, target_distribution: dict) -> pd.DataFrame:
-        """Применяет глобальное разнообразие на уровне всех клиентов"""
+        """Применяет глобальное разнообразие на уровне всех клиентов (векторный движок назначения)"""
+        products = [col.replace('benefit_', '') for col in benefit_columns]
+        benefits = df_merged[benefit_columns].to_numpy(dtype=np.float64)
+        assigned, ranked = self.assign_products(
+            benefits, df_merged['client_code'].to_numpy(), products, product_groups, target_distribution
+        )
+        
+        # Назначенный по квоте продукт или до 4 лучших по выгоде
+        df_merged['top4_products'] = self._top4_lists(products, assigned, ranked)
+        df_merged['ranked_products'] = df_merged['top4_products']
+        df_merged['assigned_product'] = self._assigned_column(products, assigned)
+        
+        return df_merged
+
+    def assign_products(self, benefits: np.ndarray, client_codes: np.ndarray, products: list, product_groups: dict,
+                        target_distribution: dict, pairs=None):
+        """Назначение продуктов по квотам групп за O(E log E), E - число положительных выгод
+        
+        Дает то же распределение, что и последовательный жадный алгоритм
+        _apply_global_diversity_rowwise: все пары (клиент, продукт) с выгодой > 0 идут по убыванию
+        выгоды (при равенстве - в порядке строк и колонок). Сначала каждой группе достается лучшая
+        пара со свободным клиентом, затем клиент получает первую свою пару, чья группа еще не заполнила квоту.
+        
+        Вместо прохода по парам по одной назначение идет эпохами: внутри эпохи ни одна группа
+        не закрывается, поэтому каждый свободный клиент берет свою первую подходящую пару сразу
+        для всех клиентов. Эпоха заканчивается на паре, заполнившей квоту группы, - эпох не больше,
+        чем групп.
+        
+        pairs - готовые упорядоченные пары из benefit_pairs (иначе строятся здесь).
+        Возвращает (assigned, ranked): индекс назначенного продукта для каждой строки (-1 - нет)
+        и матрицу до 4 лучших продуктов по выгоде (-1 - пусто) для строк без назначения.
+        """
+        n_rows = len(benefits)
+        groups = list(product_groups)
+        product_group = np.array([
+            next((g for g, group in enumerate(groups) if product in product_groups[group]), -1)
+            for product in products
+        ], dtype=np.int64)
+        capacity = np.array([int(n_rows * target_distribution.get(group, 0)) for group in groups], dtype=np.int64)
+        
+        # Назначение ведется по кодам клиентов (как в построчной версии), строки - через client_ids
+        client_ids, unique_codes = pd.factorize(client_codes)
+        assigned_product = np.full(len(unique_codes), -1, dtype=np.int64)
+        
+        # Все пары с положительной выгодой в порядке убывания выгоды (стабильно)
+        pair_rows, pair_products, _ = pairs if pairs is not None else self.benefit_pairs(benefits)
+        pair_clients = client_ids[pair_rows]
+        pair_groups = product_group[pair_products]
+        
+        # Первый проход: лучшая пара каждой группы со свободным клиентом
+        for g in range(len(groups)):
+            for pair in np.flatnonzero(pair_groups == g):
+                if assigned_product[pair_clients[pair]] < 0:
+                    assigned_product[pair_clients[pair]] = pair_products[pair]
+                    capacity[g] -= 1
+                    break
+        
+        # Второй проход: заполнение квот эпохами
+        start = 0
+        while True:
+            is_open = np.append(capacity > 0, False)  # последний элемент - для пар без группы (-1)
+            candidates = np.flatnonzero(is_open[pair_groups] & (assigned_product[pair_clients] < 0))
+            candidates = candidates[candidates >= start]
+            if len(candidates) == 0:
+                break
+            
+            # Первая пара каждого клиента: при записи в обратном порядке побеждает самая ранняя
+            first_pair = np.full(len(unique_codes), -1, dtype=np.int64)
+            first_pair[pair_clients[candidates[::-1]]] = candidates[::-1]
+            picks = np.sort(first_pair[first_pair >= 0])
+            pick_groups = pair_groups[picks]
+            
+            # Позиция, на которой первая из групп заполняет квоту
+            close_at = None
+            for g in np.flatnonzero(capacity > 0):
+                group_picks = picks[pick_groups == g]
+                if len(group_picks) >= capacity[g]:
+                    position = group_picks[capacity[g] - 1]
+                    close_at = position if close_at is None else min(close_at, position)
+            
+            accepted = picks if close_at is None else picks[picks <= close_at]
+            assigned_product[pair_clients[accepted]] = pair_products[accepted]
+            capacity -= np.bincount(pair_groups[accepted], minlength=len(groups))
+            if close_at is None:
+                break
+            start = close_at + 1
+        
+        # Для строк без назначения - до 4 лучших продуктов с положительной выгодой
+        assigned = assigned_product[client_ids]
+        unassigned = np.flatnonzero(assigned < 0)
+        ranked = np.full((n_rows, 4), -1, dtype=np.int64)
+        if len(unassigned):
+            unassigned_benefits = benefits[unassigned]
+            top = np.argsort(-unassigned_benefits, axis=1, kind='stable')[:, :4]
+            top = np.where(np.take_along_axis(unassigned_benefits, top, axis=1) > 0, top, -1)
+            ranked[unassigned, :top.shape[1]] = top
+        
+        return assigned, ranked
+
+    def _apply_global_diversity_rowwise(self, df_merged: pd.DataFrame, benefit_columns: list, product_groups: dict, target_distribution: dict) -> pd.DataFrame:
+        """Применяет глобальное разнообразие на уровне всех клиентов (прежний построчный алгоритм)"""
         total_clients = len(df_merged)
         
         # Вычисляем целевые количества для каждой группы
@@ -331,6 +1296,11 @@ class BankingMLService:
         
         df_merged['top4_products'] = df_merged.apply(get_final_recommendations, axis=1)
         df_merged['ranked_products'] = df_merged['top4_products']
+        assignment = {client_code: product for assignments in group_assignments.values() for client_code, product in assignments}
+        df_merged['assigned_product'] = pd.Categorical(
+            [assignment.get(client_code) for client_code in df_merged['client_code']],
+            categories=[col.replace('benefit_', '') for col in benefit_columns]
+        )
         
         return df_merged
 
@@ -351,6 +1321,75 @@ class BankingMLService:
         
         return stats
 
+    def compute_stats(self, df_merged: pd.DataFrame) -> Dict[str, Any]:
+        """Сводная статистика по обработанным данным для /stats (векторно, один раз на /process)
+        
+        Распределение лучших продуктов и покрытие, сводка выгод по продуктам, число клиентов,
+        назначенных по квотам групп, в сравнении с target_distribution и число клиентов без назначения.
+        """
+        total_clients = len(df_merged)
+        best_products = df_merged['top4_products'].str[0]
+        has_recommendation = best_products.notna().to_numpy()
+        clients_with_recommendations = int(has_recommendation.sum())
+        
+        # Распределение лучших продуктов (в порядке первого появления, как при проходе по строкам)
+        codes, products = pd.factorize(best_products)
+        counts = np.bincount(codes[codes >= 0], minlength=len(products))
+        product_distribution = {product: int(count) for product, count in zip(products, counts)}
+        
+        # Сводка выгод по продуктам: по всем клиентам и по клиентам, которым продукт рекомендован первым
+        benefit_summary = {}
+        for product in self.benefit_formulas:
+            col = f'benefit_{product}'
+            if col not in df_merged:
+                continue
+            values = df_merged[col].to_numpy(dtype=np.float64)
+            positive = values[values > 0]
+            recommended = values[(best_products == product).to_numpy()]
+            benefit_summary[product] = {
+                'clients_with_benefit': int(len(positive)),
+                'mean_benefit': float(positive.mean()) if len(positive) else 0.0,
+                'median_benefit': float(np.median(positive)) if len(positive) else 0.0,
+                'max_benefit': float(positive.max()) if len(positive) else 0.0,
+                'total_benefit': float(positive.sum()),
+                'recommended_mean_benefit': float(np.nanmean(recommended)) if np.isfinite(recommended).any() else 0.0
+            }
+        
+        # Выполнение квот: назначенный по квоте продукт (assigned_product) по группам против целевого
+        # распределения; первый продукт неназначенного клиента - запасной топ-4 и в квоты не входит
+        if 'assigned_product' in df_merged:
+            assigned = df_merged['assigned_product'].astype(object).to_numpy()
+        else:
+            assigned = np.full(total_clients, None, dtype=object)
+        assigned_counts = pd.Series(assigned).value_counts().to_dict()
+        unassigned = total_clients - int(sum(assigned_counts.values()))
+        group_distribution = {}
+        for group, group_products in self.product_groups.items():
+            count = int(sum(assigned_counts.get(product, 0) for product in group_products))
+            target_share = self.target_distribution.get(group, 0)
+            target_count = int(total_clients * target_share)
+            group_distribution[group] = {
+                'clients': count,
+                'share': count / total_clients if total_clients else 0.0,
+                'target_share': target_share,
+                'target_clients': target_count,
+                'fill_rate': count / target_count if target_count else None
+            }
+        
+        return {
+            'total_clients': total_clients,
+            'clients_with_recommendations': clients_with_recommendations,
+            'coverage': clients_with_recommendations / total_clients if total_clients else 0.0,
+            'product_distribution': product_distribution,
+            'benefit_summary': benefit_summary,
+            'group_distribution': group_distribution,
+            'unassigned': {
+                'clients': unassigned,
+                'share': unassigned / total_clients if total_clients else 0.0
+            },
+            'data_columns': list(df_merged.columns)
+        }
+
     def _get_global_balance_factor(self, product, global_stats):
         """Определяет фактор глобального баланса для предотвращения перекосов"""
         if product not in global_stats:
@@ -459,16 +1498,15 @@ class BankingMLService:
         
         return trend_factors.get(product, 1.0)
 
-    def generate_push_notification(self, client_data: Dict, product: str) -> str:
-        """Генерация персонализированного пуш-уведомления"""
+    def generate_push_notification(self, client_data: Dict, product: str, month: str = None) -> str:
+        """Генерация персонализированного пуш-уведомления (для многих клиентов - render_push_notifications)"""
         try:
             name = client_data.get('name', 'Клиент')
-            month = datetime.now().strftime('%B')
+            month = month or _month_prepositional()
             
-            # Получаем детальную информацию о тратах клиента
-            category_columns = [col for col in client_data.keys() if col.endswith('_m') and col not in ['TRAVEL_m', 'ONLINE_m', 'TOP3_m', 'TOTAL_m', 'INFLOWS_m', 'OUTFLOWS_m']]
-            category_spending = {col.replace('_m', ''): client_data[col] for col in category_columns if client_data.get(col, 0) > 0}
-            top_categories = sorted(category_spending.items(), key=lambda x: x[1], reverse=True)[:3]
+            # Топ-категории трат клиента, посчитанные в process_data
+            top_categories = [client_data.get(f'top_category_{rank}') for rank in range(1, TOP_K + 1)]
+            top_categories = [category for category in top_categories if isinstance(category, str)]
             
             # Персонализация по продуктам с конкретными данными
             if product == 'Карта для путешествий':
@@ -496,7 +1534,7 @@ class BankingMLService:
             
             elif product == 'Кредитная карта':
                 if len(top_categories) >= 3:
-                    cat1, cat2, cat3 = top_categories[0][0], top_categories[1][0], top_categories[2][0]
+                    cat1, cat2, cat3 = top_categories[:3]
                     online_spending = client_data.get('ONLINE_m', 0)
                     if online_spending > 0:
                         template = f"{name}, ваши топ-категории — {cat1}, {cat2}, {cat3}. Кредитная карта даёт до 10% в любимых категориях и на онлайн-сервисы. Оформить карту."
@@ -567,7 +1605,171 @@ class BankingMLService:
             logger.error(f"Ошибка при генерации пуш-уведомления: {str(e)}")
             return f"{name}, рассмотрите {product} для оптимизации ваших финансов."
 
-    def _calculate_deposit_benefit(self, row, annual_rate, min_balance, optimal_balance):
+    def render_push_notifications(self, df: pd.DataFrame, products) -> List[str]:
+        """Пакетная генерация пуш-уведомлений: тексты те же, что у generate_push_notification
+        
+        products - продукт для каждой строки df. Ветка шаблона выбирается масками сразу для всех
+        клиентов продукта, суммы форматируются пачкой, месяц вычисляется один раз на вызов.
+        """
+        month = _month_prepositional()
+        products = np.asarray(products, dtype=object)
+        names = np.asarray([str(name) for name in _column(df, 'name', 'Клиент').tolist()], dtype=object)
+        texts = np.empty(len(df), dtype=object)
+        
+        renderers = {
+            'Карта для путешествий': self._render_travel_card_push,
+            'Премиальная карта': self._render_premium_card_push,
+            'Кредитная карта': self._render_credit_card_push,
+            'Мультивалютный счет': self._render_fx_account_push,
+            'Депозит Сберегательный': self._render_deposit_push,
+            'Депозит Накопительный': self._render_deposit_push,
+            'Депозит Мультивалютный': self._render_deposit_push,
+            'Инвестиции': self._render_investment_push,
+            'Кредит наличными': self._render_credit_push,
+            'Золотые слитки': self._render_gold_push,
+        }
+        
+        for product in pd.unique(products):
+            rows = np.flatnonzero(products == product)
+            renderer = renderers.get(product)
+            if renderer is None:
+                # Базовый шаблон для неизвестных продуктов
+                texts[rows] = [f"{name}, рассмотрите {product} для оптимизации ваших финансов. Узнать подробнее." for name in names[rows]]
+            else:
+                def column(name, default=0, rows=rows):
+                    return _column(df, name, default)[rows]
+                texts[rows] = renderer(product, column, names[rows], month)
+        
+        return texts.tolist()
+    
+    def _render_travel_card_push(self, product, column, names, month):
+        """Карта для путешествий: число поездок, траты на поездки и кешбэк 4% или общий текст без поездок"""
+        texts = np.empty(len(names), dtype=object)
+        travel_amount = column('TRAVEL_m').astype(np.float64)
+        trips_estimate = (column('Такси_m').astype(np.float64) + column('Отели_m').astype(np.float64)) / 5000
+        
+        travelled = travel_amount > 0
+        texts[~travelled] = [f"{name}, планируете поездки? Карта для путешествий даёт 4% кешбэк на такси, отели и авиабилеты. Оформить карту." for name in names[~travelled]]
+        
+        # int() от nan/inf в построчной версии падает в общий запасной текст
+        broken = travelled & ~np.isfinite(trips_estimate)
+        texts[broken] = [f"{name}, рассмотрите {product} для оптимизации ваших финансов." for name in names[broken]]
+        
+        travelled &= ~broken
+        trips_count = np.maximum(1, np.trunc(trips_estimate[travelled])).astype(np.int64).tolist()
+        amounts = _format_amounts(travel_amount[travelled])
+        cashbacks = _format_amounts(travel_amount[travelled] * 0.04)
+        texts[travelled] = [
+            f"{name}, в {month} вы сделали {trips} поездок на {amount} ₸. С картой для путешествий вернули бы ≈{cashback} ₸. Откройте карту в приложении."
+            for name, trips, amount, cashback in zip(names[travelled], trips_count, amounts, cashbacks)
+        ]
+        return texts
+    
+    def _render_premium_card_push(self, product, column, names, month):
+        """Премиальная карта: по остатку выше 1 млн ₸ и тратам в ресторанах выше 50 000 ₸"""
+        texts = np.empty(len(names), dtype=object)
+        balance = column('avg_monthly_balance_KZT').astype(np.float64)
+        restaurant_spending = column('Кафе и рестораны_m').astype(np.float64)
+        
+        high_balance = balance > 1000000
+        restaurants = high_balance & (restaurant_spending > 50000)
+        balance_only = high_balance & ~restaurants
+        
+        texts[restaurants] = [f"{name}, у вас стабильно крупный остаток и траты в ресторанах. Премиальная карта даст повышенный кешбэк и бесплатные снятия. Оформить сейчас." for name in names[restaurants]]
+        texts[balance_only] = [
+            f"{name}, у вас высокий остаток на счету ({amount} ₸). Премиальная карта даст до 4% кешбэка на все покупки и бесплатные снятия. Подключите сейчас."
+            for name, amount in zip(names[balance_only], _format_amounts(balance[balance_only]))
+        ]
+        texts[~high_balance] = [f"{name}, премиальная карта даёт до 4% кешбэка на все покупки и бесплатные снятия по миру. Оформить карту." for name in names[~high_balance]]
+        return texts
+    
+    def _render_credit_card_push(self, product, column, names, month):
+        """Кредитная карта: три топ-категории клиента и онлайн-траты, без трех категорий - общий текст"""
+        texts = np.empty(len(names), dtype=object)
+        online_spending = column('ONLINE_m').astype(np.float64)
+        
+        # Первые три категории-строки, как в построчной версии
+        categories = zip(*(column(f'top_category_{rank}', None).tolist() for rank in range(1, TOP_K + 1)))
+        top_categories = [[category for category in row if isinstance(category, str)][:3] for row in categories]
+        has_top3 = np.array([len(row) == 3 for row in top_categories], dtype=bool)
+        
+        for mask, tail in ((has_top3 & (online_spending > 0), " и на онлайн-сервисы"), (has_top3 & ~(online_spending > 0), "")):
+            texts[mask] = [
+                f"{name}, ваши топ-категории — {cat1}, {cat2}, {cat3}. Кредитная карта даёт до 10% в любимых категориях{tail}. Оформить карту."
+                for name, (cat1, cat2, cat3) in zip(names[mask], (top_categories[row] for row in np.flatnonzero(mask)))
+            ]
+        texts[~has_top3] = [f"{name}, кредитная карта даёт до 10% кешбэка в любимых категориях и на онлайн-сервисы. Оформить карту." for name in names[~has_top3]]
+        return texts
+    
+    def _render_fx_account_push(self, product, column, names, month):
+        """Мультивалютный счет: по наличию валютных операций (HAS_FX)"""
+        # Истинность как у if: nan тоже считается наличием валютных операций
+        texts = np.empty(len(names), dtype=object)
+        fx_operations = np.array([bool(value) for value in column('HAS_FX', False).tolist()], dtype=bool)
+        
+        texts[fx_operations] = [f"{name}, вы часто платите в валюте. В приложении выгодный обмен и авто-покупка по целевому курсу. Настроить обмен." for name in names[fx_operations]]
+        texts[~fx_operations] = [f"{name}, мультивалютный счёт даёт выгодный обмен валют 24/7 без комиссии. Открыть счёт." for name in names[~fx_operations]]
+        return texts
+    
+    def _render_deposit_push(self, product, column, names, month):
+        """Депозиты: свободный остаток и доход в месяц по ставке вклада или общий текст вклада"""
+        # Порог остатка, ставка для расчета дохода и текст без персональных сумм по видам вкладов
+        threshold, annual_rate, title, fallback = {
+            'Депозит Сберегательный': (500000, 0.165, 'Сберегательный', 'сберегательный вклад даёт 16,5% годовых с защитой KDIF'),
+            'Депозит Накопительный': (300000, 0.155, 'Накопительный', 'накопительный вклад даёт 15,5% годовых с возможностью пополнения'),
+            'Депозит Мультивалютный': (400000, 0.145, 'Мультивалютный', 'мультивалютный вклад даёт 14,5% годовых в KZT/USD/RUB/EUR'),
+        }[product]
+        texts = np.empty(len(names), dtype=object)
+        balance = column('avg_monthly_balance_KZT').astype(np.float64)
+        
+        free_funds = balance > threshold
+        texts[free_funds] = [
+            f"{name}, у вас остаются свободные средства ({amount} ₸). {title} вклад даст {income} ₸ в месяц. Открыть вклад."
+            for name, amount, income in zip(
+                names[free_funds],
+                _format_amounts(balance[free_funds]),
+                _format_amounts(balance[free_funds] * annual_rate / 12)
+            )
+        ]
+        texts[~free_funds] = [f"{name}, {fallback}. Открыть вклад." for name in names[~free_funds]]
+        return texts
+    
+    def _render_investment_push(self, product, column, names, month):
+        """Инвестиции: по остатку выше 100 000 ₸"""
+        texts = np.empty(len(names), dtype=object)
+        free_funds = column('avg_monthly_balance_KZT').astype(np.float64) > 100000
+        
+        texts[free_funds] = [f"{name}, у вас есть свободные средства. Инвестиции дают возможность роста с 0% комиссий в первый год. Открыть счёт." for name in names[free_funds]]
+        texts[~free_funds] = [f"{name}, инвестиции доступны от 6 ₸ с 0% комиссий на сделки. Открыть счёт." for name in names[~free_funds]]
+        return texts
+    
+    def _render_credit_push(self, product, column, names, month):
+        """Кредит наличными: месячные расходы при оттоке выше 200 000 ₸"""
+        texts = np.empty(len(names), dtype=object)
+        outflows = column('OUTFLOWS_m').astype(np.float64)
+        
+        high_outflows = outflows > 200000
+        texts[high_outflows] = [
+            f"{name}, у вас высокие расходы ({amount} ₸/мес). Кредит наличными даст запас на крупные траты с гибкими выплатами. Узнать лимит."
+            for name, amount in zip(names[high_outflows], _format_amounts(outflows[high_outflows]))
+        ]
+        texts[~high_outflows] = [f"{name}, кредит наличными до 2 млн ₸ на 2 месяца без переплаты. Оформить онлайн." for name in names[~high_outflows]]
+        return texts
+    
+    def _render_gold_push(self, product, column, names, month):
+        """Золотые слитки: по остатку выше 1 млн ₸"""
+        texts = np.empty(len(names), dtype=object)
+        high_balance = column('avg_monthly_balance_KZT').astype(np.float64) > 1000000
+        
+        texts[high_balance] = [f"{name}, у вас высокий остаток. Золотые слитки — надёжная защита от инфляции. Узнать подробнее." for name in names[high_balance]]
+        texts[~high_balance] = [f"{name}, золотые слитки 999,9 пробы — диверсификация портфеля. Узнать подробнее." for name in names[~high_balance]]
+        return texts
+
+    def _client_random(self, row, product):
+        """Случайное число в [0, 1) для клиента строки по продукту"""
+        return self.noise.value(row.get('client_code', 0), product)
+
+    def _calculate_deposit_benefit(self, row, product, annual_rate, min_balance, optimal_balance):
         """Расчет выгоды от депозита с учетом баланса и возраста клиента"""
         balance = row.get('avg_monthly_balance_KZT', 0)
         age = row.get('age', 30)
@@ -601,7 +1803,7 @@ class BankingMLService:
             conservatism_factor = 0.7  # Снижаем если тратит больше чем есть
         
         # 4. Случайный фактор для разнообразия
-        random_factor = 0.9 + self.random.random() * 0.2
+        random_factor = 0.9 + self._client_random(row, product) * 0.2
         
         return base_benefit * age_factor * balance_factor * conservatism_factor * random_factor
 
@@ -631,7 +1833,7 @@ class BankingMLService:
         stability_factor = min(1.5, balance / 200000)
         
         # 4. Случайный фактор
-        random_factor = 0.7 + self.random.random() * 0.6
+        random_factor = 0.7 + self._client_random(row, 'Кредит наличными') * 0.6
         
         return base_benefit * age_factor * cc_factor * stability_factor * random_factor
 
@@ -664,7 +1866,7 @@ class BankingMLService:
         activity_bonus = 1.0 + (total_spending / 150000) * 0.3
         
         # 4. Сезонный фактор (случайный)
-        seasonal_factor = 0.9 + self.random.random() * 0.2
+        seasonal_factor = 0.9 + self._client_random(row, 'Карта для путешествий') * 0.2
         
         return base_benefit * ratio_factor * age_factor * activity_bonus * seasonal_factor
 
@@ -683,7 +1885,7 @@ class BankingMLService:
         
         # Модификаторы
         # 1. Фактор разнообразия трат
-        diversity_factor = min(1.8, len([col for col in row.index if col.endswith('_m') and row[col] > 0]) / 3)
+        diversity_factor = min(1.8, len([col for col, value in row.items() if col.endswith('_m') and value > 0]) / 3)
         
         # 2. Возрастной фактор (шире диапазон)
         if 25 <= age <= 45:
@@ -699,7 +1901,7 @@ class BankingMLService:
         activity_bonus = 1.0 + (total_spending / 200000) * 0.5
         
         # 5. Случайный фактор
-        random_factor = 0.9 + self.random.random() * 0.2
+        random_factor = 0.9 + self._client_random(row, 'Кредитная карта') * 0.2
         
         return base_benefit * diversity_factor * age_factor * stability_factor * activity_bonus * random_factor
 
@@ -728,7 +1930,7 @@ class BankingMLService:
         balance_factor = min(1.5, balance / 1000000)
         
         # 4. Случайный фактор (меньше случайности для премиум)
-        random_factor = 0.9 + self.random.random() * 0.2
+        random_factor = 0.9 + self._client_random(row, 'Премиальная карта') * 0.2
         
         return base_benefit * status_factor * age_factor * balance_factor * random_factor
 
@@ -753,7 +1955,7 @@ class BankingMLService:
         age_factor = max(0.7, min(1.2, age_factor))
         
         # 3. Случайный фактор
-        random_factor = 0.7 + self.random.random() * 0.6
+        random_factor = 0.7 + self._client_random(row, 'Мультивалютный счет') * 0.6
         
         return base_benefit * fx_factor * age_factor * random_factor
 
@@ -785,7 +1987,7 @@ class BankingMLService:
         free_money_factor = min(1.2, free_money / 200000)
         
         # 3. Фактор риска (более консервативный)
-        risk_factor = 0.3 + self.random.random() * 0.4  # Снижаем случайность
+        risk_factor = 0.3 + self._client_random(row, 'Инвестиции') * 0.4  # Снижаем случайность
         
         # 4. Дополнительный фактор - только для клиентов с высоким доходом
         income_factor = min(1.5, total_spending / 200000)
@@ -812,56 +2014,1831 @@ class BankingMLService:
         balance_factor = min(1.3, balance / 2000000)
         
         # 3. Случайный фактор (золото очень волатильно)
-        random_factor = 0.3 + self.random.random() * 1.4
+        random_factor = 0.3 + self._client_random(row, 'Золотые слитки') * 1.4
         
         return base_benefit * age_factor * balance_factor * random_factor
 
-# Инициализация сервиса
-ml_service = BankingMLService()
-
-@app.route('/', methods=['GET'])
-def index():
-    """Главная страница с веб-интерфейсом"""
-    return render_template('index.html')
+    # Векторные версии формул: те же пороги и коэффициенты, но над колонками целиком.
+    # Ветки if/elif заменены на np.where, min/max - на _py_min/_py_max (с той же семантикой NaN).
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Проверка состояния сервера"""
-    return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()})
+    def _random_vector(self, df, product):
+        """Случайные числа в [0, 1) для всех клиентов df по продукту"""
+        return self.noise.uniform(_column(df, 'client_code', 0), product)
 
-@app.route('/upload/clients', methods=['POST'])
-def upload_clients():
-    """Загрузка данных клиентов"""
-    global clients_data, data_counts
-    
-    try:
-        if 'file' not in request.files:
+    def _vectorized_deposit_benefit(self, df, product, annual_rate, min_balance, optimal_balance):
+        """Векторный расчет выгоды от депозита"""
+        balance = _column(df, 'avg_monthly_balance_KZT', 0)
+        age = _column(df, 'age', 30)
+        total_spending = _column(df, 'TOTAL_m', 0)
+        
+        base_benefit = balance * annual_rate / 12
+        
+        age_factor = np.where(age < 25, 0.6, np.where(age > 50, 1.3, 1.0 + (age - 30) * 0.015))
+        
+        balance_factor = np.where(
+            balance < min_balance, 0.5,
+            np.where((min_balance <= balance) & (balance <= optimal_balance), 1.2, 1.0)
+        )
+        
+        free_money = balance - total_spending
+        conservatism_factor = np.where(free_money > 0, _py_min(1.3, 1.0 + free_money / 300000), 0.7)
+        
+        random_factor = 0.9 + self._random_vector(df, product) * 0.2
+        
+        return base_benefit * age_factor * balance_factor * conservatism_factor * random_factor
+
+    def _vectorized_credit_benefit(self, df):
+        """Векторный расчет выгоды от кредита наличными"""
+        outflows = _column(df, 'OUTFLOWS_m', 0)
+        balance = _column(df, 'avg_monthly_balance_KZT', 0)
+        age = _column(df, 'age', 30)
+        has_cc = _column(df, 'HAS_CC', False).astype(bool)
+        
+        eligible = ~((outflows < 100000) | (balance < 50000))
+        
+        base_benefit = outflows * 0.05
+        
+        age_factor = 1.5 - (age - 25) * 0.02
+        age_factor = _py_max(0.5, _py_min(1.5, age_factor))
+        
+        cc_factor = np.where(has_cc, 1.2, 0.8)
+        
+        stability_factor = _py_min(1.5, balance / 200000)
+        
+        random_factor = 0.7 + self._random_vector(df, 'Кредит наличными') * 0.6
+        
+        benefit = base_benefit * age_factor * cc_factor * stability_factor * random_factor
+        return np.where(eligible, benefit, 0)
+
+    def _vectorized_travel_card_benefit(self, df):
+        """Векторный расчет выгоды от карты для путешествий"""
+        travel_spending = _column(df, 'TRAVEL_m', 0)
+        total_spending = _column(df, 'TOTAL_m', 0)
+        age = _column(df, 'age', 30)
+        
+        eligible = ~(travel_spending < 5000)
+        
+        base_benefit = travel_spending * 0.06
+        
+        travel_ratio = travel_spending / _py_max(total_spending, 1)
+        ratio_factor = _py_min(2.5, travel_ratio * 15)
+        
+        age_factor = np.where(age < 35, 1.4, np.where(age < 50, 1.1, 0.8))
+        
+        activity_bonus = 1.0 + (total_spending / 150000) * 0.3
+        
+        seasonal_factor = 0.9 + self._random_vector(df, 'Карта для путешествий') * 0.2
+        
+        benefit = base_benefit * ratio_factor * age_factor * activity_bonus * seasonal_factor
+        return np.where(eligible, benefit, 0)
+
+    def _vectorized_credit_card_benefit(self, df):
+        """Векторный расчет выгоды от кредитной карты"""
+        top3_spending = _column(df, 'TOP3_m', 0)
+        online_spending = _column(df, 'ONLINE_m', 0)
+        total_spending = _column(df, 'TOTAL_m', 0)
+        age = _column(df, 'age', 30)
+        
+        eligible = ~(total_spending < 30000)
+        
+        base_benefit = top3_spending * 0.12 + online_spending * 0.08
+        
+        # Количество месячных метрик с ненулевыми тратами (как в построчной версии - по всем *_m колонкам)
+        monthly_columns = [col for col in df.columns if col.endswith('_m')]
+        active_count = (df[monthly_columns] > 0).sum(axis=1).to_numpy()
+        diversity_factor = _py_min(1.8, active_count / 3)
+        
+        age_factor = np.where((25 <= age) & (age <= 45), 1.2, 0.8)
+        age_factor = _py_max(0.5, _py_min(1.5, age_factor))
+        
+        stability_factor = _py_min(1.5, total_spending / 80000)
+        
+        activity_bonus = 1.0 + (total_spending / 200000) * 0.5
+        
+        random_factor = 0.9 + self._random_vector(df, 'Кредитная карта') * 0.2
+        
+        benefit = base_benefit * diversity_factor * age_factor * stability_factor * activity_bonus * random_factor
+        return np.where(eligible, benefit, 0)
+
+    def _vectorized_premium_card_benefit(self, df):
+        """Векторный расчет выгоды от премиальной карты"""
+        balance = _column(df, 'avg_monthly_balance_KZT', 0)
+        total_spending = _column(df, 'TOTAL_m', 0)
+        status = _column(df, 'status', '')
+        age = _column(df, 'age', 30)
+        
+        eligible = ~(balance < 500000)
+        
+        base_benefit = total_spending * 0.02
+        
+        status_factor = np.where(_contains_token(status, 'Премиальный'), 1.5, 1.0)
+        
+        age_factor = 1.0 + (age - 30) * 0.01
+        age_factor = _py_max(0.8, _py_min(1.3, age_factor))
+        
+        balance_factor = _py_min(1.5, balance / 1000000)
+        
+        random_factor = 0.9 + self._random_vector(df, 'Премиальная карта') * 0.2
+        
+        benefit = base_benefit * status_factor * age_factor * balance_factor * random_factor
+        return np.where(eligible, benefit, 0)
+
+    def _vectorized_fx_account_benefit(self, df):
+        """Векторный расчет выгоды от мультивалютного счета"""
+        has_fx = _column(df, 'HAS_FX', False).astype(bool)
+        balance = _column(df, 'avg_monthly_balance_KZT', 0)
+        age = _column(df, 'age', 30)
+        
+        eligible = ~(~has_fx & (balance < 200000))
+        
+        base_benefit = balance * 0.12 / 12
+        
+        fx_factor = np.where(has_fx, 2.0, 0.5)
+        
+        age_factor = 1.0 + np.abs(age - 40) * -0.01
+        age_factor = _py_max(0.7, _py_min(1.2, age_factor))
+        
+        random_factor = 0.7 + self._random_vector(df, 'Мультивалютный счет') * 0.6
+        
+        benefit = base_benefit * fx_factor * age_factor * random_factor
+        return np.where(eligible, benefit, 0)
+
+    def _vectorized_investment_benefit(self, df):
+        """Векторный расчет выгоды от инвестиций"""
+        balance = _column(df, 'avg_monthly_balance_KZT', 0)
+        age = _column(df, 'age', 30)
+        total_spending = _column(df, 'TOTAL_m', 0)
+        
+        free_money = balance - total_spending
+        eligible = ~((balance < 200000) | (total_spending < 100000)) & ~(free_money < 50000)
+        
+        base_benefit = balance * 0.008
+        
+        age_factor = np.where((age < 25) | (age > 50), 0.3, 1.0 + np.abs(age - 35) * -0.02)
+        age_factor = _py_max(0.2, _py_min(1.2, age_factor))
+        
+        free_money_factor = _py_min(1.2, free_money / 200000)
+        
+        risk_factor = 0.3 + self._random_vector(df, 'Инвестиции') * 0.4
+        
+        income_factor = _py_min(1.5, total_spending / 200000)
+        
+        benefit = base_benefit * age_factor * free_money_factor * risk_factor * income_factor
+        return np.where(eligible, benefit, 0)
+
+    def _vectorized_gold_benefit(self, df):
+        """Векторный расчет выгоды от золотых слитков"""
+        balance = _column(df, 'avg_monthly_balance_KZT', 0)
+        age = _column(df, 'age', 30)
+        
+        eligible = ~(balance < 500000)
+        
+        base_benefit = balance * 0.008
+        
+        age_factor = 1.0 + (age - 40) * 0.01
+        age_factor = _py_max(0.7, _py_min(1.3, age_factor))
+        
+        balance_factor = _py_min(1.3, balance / 2000000)
+        
+        random_factor = 0.3 + self._random_vector(df, 'Золотые слитки') * 1.4
+        
+        benefit = base_benefit * age_factor * balance_factor * random_factor
+        return np.where(eligible, benefit, 0)
+
+def ranked_product_matrix(merged: pd.DataFrame, products: List[str]) -> np.ndarray:
+    """Матрица индексов рекомендованных продуктов (клиенты x 4, -1 - пусто) из списков top4_products"""
+    ranked = np.full((len(merged), 4), -1, dtype=np.int8)
+    exploded = merged['top4_products'].reset_index(drop=True).explode().dropna()
+    if len(exploded):
+        slots = exploded.groupby(level=0).cumcount().to_numpy()
+        codes = pd.Categorical(exploded, categories=products).codes
+        ranked[exploded.index.to_numpy(), slots] = codes
+    return ranked
+
+
+class ClientIndex:
+    """Неизменяемый индекс client_code -> позиция строки для быстрых ответов /recommendations
+    
+    Строится один раз в конце /process. Поиск клиента - хеш-таблица, а рекомендованные продукты
+    и их выгоды заранее собраны в выровненные массивы, поэтому ответ для клиента собирается
+    за O(1) независимо от числа клиентов.
+    """
+
+    __slots__ = ('_index', '_positions', '_names', '_products', '_ranked', '_benefits', '_assigned')
+
+    def __init__(self, merged: pd.DataFrame, ranked: np.ndarray = None, ranked_benefits: np.ndarray = None):
+        codes = merged['client_code']
+        first = ~codes.duplicated().to_numpy()  # как и раньше, при дублях берется первая строка
+        self._index = pd.Index(codes.to_numpy()[first])
+        self._positions = np.flatnonzero(first)
+        
+        names = merged['name'] if 'name' in merged else pd.Series('Неизвестно', index=merged.index)
+        # Имя берется из колонки по позиции при ответе: без копии всей колонки в объекты Python
+        self._names = names.array
+        
+        benefit_columns = [col for col in merged.columns if col.startswith('benefit_')]
+        self._products = tuple(col.replace('benefit_', '') for col in benefit_columns)
+        # ranked и ranked_benefits можно передать готовыми (например, из сохраненного снимка)
+        self._ranked = ranked if ranked is not None else ranked_product_matrix(merged, list(self._products))
+        if ranked_benefits is None:
+            benefits = merged[benefit_columns].to_numpy(dtype=np.float64)
+            ranked_benefits = np.take_along_axis(benefits, np.maximum(self._ranked, 0).astype(np.intp), axis=1)
+        self._benefits = ranked_benefits
+        # Назначенный по квоте продукт (-1 - без назначения); в снимках без колонки назначения неизвестен
+        if 'assigned_product' in merged:
+            self._assigned = pd.Categorical(merged['assigned_product'], categories=self._products).codes
+        else:
+            self._assigned = np.full(len(merged), -1, dtype=np.int8)
+        for array in (self._positions, self._ranked, self._benefits, self._assigned):
+            array.flags.writeable = False
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def products(self) -> tuple:
+        return self._products
+
+    @property
+    def ranked(self) -> np.ndarray:
+        return self._ranked
+
+    @property
+    def ranked_benefits(self) -> np.ndarray:
+        return self._benefits
+
+    @property
+    def assigned(self) -> np.ndarray:
+        return self._assigned
+
+    def position(self, client_code):
+        """Позиция строки клиента или None, если клиента нет"""
+        try:
+            return int(self._positions[self._index.get_loc(client_code)])
+        except (KeyError, TypeError):
+            return None
+
+    def gather(self, client_codes: np.ndarray):
+        """Рекомендации многих клиентов одним векторным поиском по индексу
+        
+        Возвращает (маска найденных client_codes, имена, продукты, выгоды) - строки найденных клиентов
+        в порядке client_codes; продукты и выгоды - матрицы (клиенты x 4), как ranked и ranked_benefits.
+        """
+        locations = self._index.get_indexer(client_codes)
+        found = locations >= 0
+        positions = self._positions[locations[found]]
+        names = np.asarray(self._names.take(positions), dtype=object)
+        return found, names, self._ranked[positions], self._benefits[positions]
+
+    def record(self, client_code) -> Dict[str, Any]:
+        """Ответ /recommendations для клиента или None, если клиента нет"""
+        position = self.position(client_code)
+        if position is None:
+            return None
+        recommendations = [
+            {"product": self._products[product], "benefit_kzt_per_month": float(benefit)}
+            for product, benefit in zip(self._ranked[position], self._benefits[position])
+            if product >= 0
+        ]
+        return {
+            "client_code": client_code,
+            "client_name": self._names[position],
+            "recommendations": recommendations
+        }
+
+
+# Колонки с точным фильтром /products/<product>/top, для которых порядки продуктов строятся по значениям заранее
+PRODUCT_GROUP_COLUMNS = ('city', 'status')
+
+# Максимальный offset страницы /products/<product>/top с фильтрами
+PRODUCT_TOP_MAX_OFFSET = int(os.environ.get('PRODUCT_TOP_MAX_OFFSET', 10000))
+
+
+class ProductRanking:
+    """Клиенты по убыванию выгоды для каждого продукта - индекс для /products/<product>/top
+    
+    Порядки (позиции строк с положительной выгодой) строятся один раз в конце /process и сохраняются
+    вместе со снимком. Так же заранее строятся порядки продукта по каждому значению city и status
+    (groups: (продукт, колонка) -> значение -> позиции). Страница без фильтров или с одним из этих
+    фильтров - срез готового порядка. Остальные фильтры проверяются блоками по самому узкому готовому
+    порядку до нужного числа подходящих клиентов. Поэтому время зависит от размера страницы и доли
+    подходящих клиентов в этом порядке, а не от общего числа клиентов.
+    
+    Порядки отражают версию данных: клиенты, измененные онлайн-событиями (LiveOverlay), попадают
+    в них только после следующего /process.
+    """
+
+    def __init__(self, merged: pd.DataFrame, products: tuple, orders: Dict[str, np.ndarray] = None,
+                 groups: Dict[tuple, Dict[Any, np.ndarray]] = None):
+        self._merged = merged
+        self.products = products
+        self.orders = orders if orders is not None else {
+            product: self._order(merged[f'benefit_{product}'].to_numpy(dtype=np.float64)) for product in products
+        }
+        self._codes = {}
+        self._lock = threading.Lock()
+        self.groups = groups if groups is not None else self._groups()
+
+    @staticmethod
+    def _order(benefits: np.ndarray) -> np.ndarray:
+        """Позиции строк с выгодой > 0 по убыванию выгоды (при равенстве - по порядку строк)"""
+        positive = np.flatnonzero(benefits > 0)
+        return positive[np.argsort(-benefits[positive], kind='stable')].astype(np.int32)
+
+    def _groups(self) -> Dict[tuple, Dict[Any, np.ndarray]]:
+        """Порядки продуктов по значениям колонок PRODUCT_GROUP_COLUMNS: стабильная сортировка порядка по коду значения"""
+        groups = {}
+        for column in PRODUCT_GROUP_COLUMNS:
+            if column not in self._merged.columns:
+                continue
+            codes, lookup = self._category_codes(column)
+            values = list(lookup)
+            for product in self.products:
+                order = self.orders[product]
+                permutation = np.argsort(codes[order], kind='stable')
+                grouped = order[permutation]
+                # Пропуски (код -1) оказываются в начале и не входят ни в одно значение
+                bounds = np.searchsorted(codes[grouped], np.arange(len(values) + 1))
+                groups[(product, column)] = {
+                    value: grouped[start:stop] for value, start, stop in zip(values, bounds[:-1], bounds[1:])
+                }
+        return groups
+
+    def _category_codes(self, column: str):
+        """Коды значений колонки и словарь значение -> код (для категорий - готовые коды, иначе factorize один раз)"""
+        if column not in self._codes:
+            with self._lock:
+                if column not in self._codes:
+                    series = self._merged[column]
+                    if isinstance(series.dtype, pd.CategoricalDtype):
+                        codes, values = series.cat.codes.to_numpy(), series.cat.categories
+                    else:
+                        codes, values = pd.factorize(series)
+                    self._codes[column] = (codes, {value: code for code, value in enumerate(values.tolist())})
+        return self._codes[column]
+
+    def page(self, product: str, offset: int, limit: int, filters: Dict[str, Any] = None):
+        """Позиции строк клиентов [offset, offset + limit) топа продукта с фильтрами и есть ли следующая страница
+        
+        filters: city, status (точное значение), age_min, age_max (включительно).
+        """
+        order = self.orders[product]
+        filters = {name: value for name, value in (filters or {}).items() if value is not None}
+        
+        # Самый узкий из готовых порядков по city/status; остальные условия проверяются просмотром
+        grouped = [column for column in PRODUCT_GROUP_COLUMNS if column in filters]
+        subsets = [self.groups.get((product, column), {}).get(filters[column]) for column in grouped]
+        if any(subset is None for subset in subsets):
+            return order[:0], False
+        conditions = []
+        if grouped:
+            narrowest = min(range(len(grouped)), key=lambda number: len(subsets[number]))
+            order = subsets[narrowest]
+            for column in grouped[:narrowest] + grouped[narrowest + 1:]:
+                codes, lookup = self._category_codes(column)
+                conditions.append((codes, lookup[filters[column]]))
+        ages = self._merged['age'].to_numpy() if 'age_min' in filters or 'age_max' in filters else None
+        if not conditions and ages is None:
+            return order[offset:offset + limit], offset + limit < len(order)
+        
+        # Подходящие клиенты набираются блоками растущего размера; +1 - чтобы узнать о следующей странице
+        need = offset + limit + 1
+        matched, found, start, block = [], 0, 0, max(1024, 4 * need)
+        while start < len(order) and found < need:
+            rows = order[start:start + block]
+            mask = np.ones(len(rows), dtype=bool)
+            for codes, code in conditions:
+                mask &= codes[rows] == code
+            if 'age_min' in filters:
+                mask &= ages[rows] >= filters['age_min']
+            if 'age_max' in filters:
+                mask &= ages[rows] <= filters['age_max']
+            matched.append(rows[mask])
+            found += int(mask.sum())
+            start, block = start + block, block * 2
+        
+        rows = np.concatenate(matched)[offset:need] if matched else order[:0]
+        return rows[:limit], len(rows) > limit
+
+
+# Максимум ответов в кеше одной версии данных
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 200000))
+
+
+class ResponseCache:
+    """Кеш сериализованных JSON-ответов по клиентам для одной версии данных
+    
+    Ключ кеша - (version, client_code): экземпляр привязан к версии и к индексу клиентов,
+    из которого строятся ответы. При новом /process создается новый экземпляр и заменяет
+    старый одним присваиванием, поэтому читатели никогда не смешивают версии.
+    """
+
+    def __init__(self, version: str, index: ClientIndex, max_entries: int = RESPONSE_CACHE_SIZE):
+        self.version = version
+        self.index = index
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, builder):
+        """Готовые байты ответа по ключу; builder() вызывается при промахе и возвращает объект или None"""
+        body = self._entries.get(key)
+        if body is not None:
+            return body
+        payload = builder()
+        if payload is None:
+            return None
+        # Те же байты, что отдал бы jsonify
+        body = app.json.response(payload).get_data()
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = body
+        return body
+
+
+def _cached_json_response(cache: ResponseCache, key, builder, etag: str = None):
+    """Ответ из кеша с ETag версии данных (или etag); 304, если у клиента уже эта версия
+    
+    Существование ключа проверяет вызывающий: 304 отдается без построения ответа.
+    """
+    etag = etag or cache.version
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = cache.get(key, builder)
+        if body is None:
+            return None
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+class NotificationStore:
+    """Пуш-уведомления по лучшему продукту каждого клиента для одной версии данных
+    
+    Генерируются один раз при первом обращении (/push-notifications или /export/csv) и хранятся
+    колонками: client_code (int64), продукт (категория) и тексты (строковый dtype pandas).
+    Хранится только эта таблица: куски CSV, gzip и Arrow кодируются при выгрузке по одному,
+    поэтому память выгрузки не растет с числом клиентов. При новом /process создается новый
+    экземпляр, как и ResponseCache.
+    """
+
+    def __init__(self, version: str, merged: pd.DataFrame, service: 'BankingMLService', chunk_rows: int = None):
+        self.version = version
+        self.chunk_rows = chunk_rows or STREAM_CHUNK_ROWS
+        self._merged = merged
+        self._service = service
+        self._frame = None
+        self._lock = threading.Lock()
+
+    def frame(self) -> pd.DataFrame:
+        """Колонки client_code, product, push_notification (генерируются при первом вызове)"""
+        if self._frame is None:
+            with self._lock:
+                if self._frame is None:
+                    self._frame = self._build()
+                    self._merged = None
+        return self._frame
+
+    def _build(self) -> pd.DataFrame:
+        """Пакетная генерация кусками по chunk_rows клиентов, чтобы не держать промежуточные объекты целиком"""
+        merged = self._merged
+        parts = []
+        for start in range(0, len(merged), self.chunk_rows):
+            part = merged.iloc[start:start + self.chunk_rows]
+            part = part[part['top4_products'].map(bool).to_numpy(dtype=bool)]
+            products = [top4[0] for top4 in part['top4_products']]
+            parts.append(pd.DataFrame({
+                'client_code': part['client_code'].to_numpy(dtype=np.int64),
+                'product': pd.Series(products, dtype='str'),
+                'push_notification': pd.Series(self._service.render_push_notifications(part, products), dtype='str')
+            }))
+        
+        if not parts:
+            parts.append(pd.DataFrame({
+                'client_code': np.empty(0, dtype=np.int64),
+                'product': pd.Series([], dtype='str'),
+                'push_notification': pd.Series([], dtype='str')
+            }))
+        frame = pd.concat(parts, ignore_index=True)
+        frame['product'] = frame['product'].astype('category')
+        
+        logger.info(f"Сгенерированы пуш-уведомления для {len(frame)} клиентов (версия {self.version})")
+        return frame
+
+    def records(self) -> List[Dict[str, Any]]:
+        """Уведомления списком словарей для JSON-ответа"""
+        frame = self.frame()
+        return [
+            {"client_code": client_code, "product": product, "push_notification": text}
+            for client_code, product, text in zip(
+                frame['client_code'].tolist(),
+                frame['product'].astype(object).tolist(),
+                frame['push_notification'].tolist()
+            )
+        ]
+
+    def csv_chunks(self, compressed: bool = False):
+        """CSV кусками по chunk_rows строк (заголовок в первом); compressed - каждый кусок отдельным gzip-членом
+        
+        Последовательность gzip-членов - корректный gzip-файл.
+        """
+        frame = self.frame()
+        for number, start in enumerate(range(0, max(len(frame), 1), self.chunk_rows)):
+            data = frame.iloc[start:start + self.chunk_rows].to_csv(index=False, header=number == 0).encode('utf-8')
+            yield gzip.compress(data, mtime=0) if compressed else data
+
+    @staticmethod
+    def arrow_schema():
+        """Схема выгрузки в Parquet и Arrow"""
+        return pa.schema([
+            ('client_code', pa.int64()),
+            ('product', pa.string()),
+            ('push_notification', pa.string())
+        ])
+
+    def arrow_chunks(self):
+        """Уведомления таблицами pyarrow по chunk_rows строк"""
+        frame = self.frame()
+        schema = self.arrow_schema()
+        for start in range(0, len(frame), self.chunk_rows):
+            part = frame.iloc[start:start + self.chunk_rows].astype({'product': 'str'})
+            yield pa.Table.from_pandas(part, schema=schema, preserve_index=False)
+
+
+class LiveOverlay:
+    """Онлайн-события поверх снимка: признаки и рекомендации клиентов, изменившихся после /process
+    
+    Событие меняет месячные метрики и флаги своего клиента за O(1) от числа клиентов, затем выгоды
+    клиента пересчитываются теми же формулами. Снимок не меняется: измененные клиенты хранятся здесь
+    и отдаются /recommendations вместо строк снимка. Назначение по квотам групп пересчитывается
+    только следующим /process, а до него клиент сохраняет назначенный продукт (колонка assigned_product
+    снимка), пока выгода по нему положительна; иначе получает до 4 лучших продуктов по новой выгоде.
+    
+    При общем каталоге данных cursor - позиция (поколение, смещение) в журнале EventLog, до которой
+    порции уже применены; начинается с первого поколения, не вошедшего во входные данные снимка.
+    """
+
+    def __init__(self, merged: pd.DataFrame, index: ClientIndex, service: 'BankingMLService', events_generation: int = 0):
+        self.merged = merged
+        self.index = index
+        self.service = service
+        self.cursor = (events_generation, 0)
+        # Растет с каждой порцией событий; ревизия клиента - номер порции, последней изменившей его
+        self.revision = 0
+        self._clients = {}
+        self._categories = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def get(self, client_code):
+        """Состояние клиента, измененного событиями: ревизия ("revision"), ответ ("record"), признаки; None - не менялся"""
+        return self._clients.get(client_code)
+
+    def patch(self, client_codes: np.ndarray, ranked: np.ndarray, ranked_benefits: np.ndarray):
+        """Продукты и выгоды, собранные из снимка (ClientIndex.gather), с подменой клиентов, измененных событиями"""
+        if not self._clients:
+            return ranked, ranked_benefits
+        rows = [(row, self._clients.get(client_code)) for row, client_code in enumerate(client_codes.tolist())]
+        rows = [(row, entry) for row, entry in rows if entry is not None]
+        if not rows:
+            return ranked, ranked_benefits
+        
+        ranked, ranked_benefits = ranked.copy(), ranked_benefits.copy()
+        for row, entry in rows:
+            ranked[row] = -1
+            for slot, (product, recommendation) in enumerate(zip(entry["ranked"], entry["record"]["recommendations"])):
+                ranked[row, slot] = product
+                ranked_benefits[row, slot] = recommendation["benefit_kzt_per_month"]
+        return ranked, ranked_benefits
+
+    def apply(self, kind: str, delta: ClientAggregates):
+        """Применение порции событий (агрегаты delta); возвращает (ответы по измененным клиентам, неизвестные коды)"""
+        with self._lock:
+            touched, unknown = {}, set()
+            if delta.sums is not None:
+                for (client_code, key), amount in delta.sums.items():
+                    features = self._features(client_code, touched)
+                    if features is None:
+                        unknown.add(int(client_code))
+                    elif kind == 'transactions':
+                        self.service.add_spending(features, key, amount / 3)
+                    elif key in TRANSFER_FLOW_COLUMNS:
+                        features[TRANSFER_FLOW_COLUMNS[key]] += amount / 3
+            
+            # Флаг ставится, если его условию удовлетворяет хотя бы одно событие клиента
+            for flag, codes in delta.flag_codes.items():
+                for client_code in codes.tolist():
+                    features = self._features(client_code, touched)
+                    if features is None:
+                        unknown.add(client_code)
+                    else:
+                        features[flag] = True
+            
+            if not touched:
+                return [], sorted(unknown)
+            self.revision += 1
+            return self._rescore(touched), sorted(unknown)
+
+    def _features(self, client_code, touched: Dict[int, Dict[str, Any]]):
+        """Изменяемая копия признаков клиента: из прежних событий или из строки снимка; None - клиента нет"""
+        client_code = int(client_code)
+        if client_code in touched:
+            return touched[client_code]
+        entry = self._clients.get(client_code)
+        if entry is not None:
+            features = dict(entry["features"])
+        else:
+            position = self.index.position(client_code)
+            if position is None:
+                return None
+            row = self.merged.iloc[position]
+            features = {
+                column: value for column, value in row.items()
+                if not column.startswith('benefit_') and column not in ('top4_products', 'ranked_products', 'assigned_product')
+            }
+            # У клиента без трат метрики пустые: с первым событием они, как при расчете, становятся нулями
+            for column in self.categories + list(MONTHLY_METRIC_COLUMNS):
+                if column in features and pd.isna(features[column]):
+                    features[column] = 0.0
+        touched[client_code] = features
+        return features
+
+    @property
+    def categories(self) -> List[str]:
+        """Колонки месячных трат по категориям в порядке таблицы снимка"""
+        if self._categories is None:
+            self._categories = [
+                column for column in self.merged.columns
+                if column.endswith('_m') and column not in MONTHLY_METRIC_COLUMNS
+            ]
+        return self._categories
+
+    def _rescore(self, touched: Dict[int, Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Выгоды и рекомендации измененных клиентов; публикует их для /recommendations"""
+        for features in touched.values():
+            # Новые категории - после категорий снимка
+            self.service.update_top_categories(features, self.categories + [
+                column for column in features
+                if column.endswith('_m') and column not in MONTHLY_METRIC_COLUMNS and column not in self.categories
+            ])
+        
+        # Порядок продуктов индекса совпадает с порядком формул (колонки benefit_* снимка)
+        records = []
+        for client_code, features in touched.items():
+            values = self.service.client_benefits(features)
+            previous = self._clients.get(client_code)
+            if previous is not None:
+                assigned = previous["assigned"]
+            else:
+                assigned = int(self.index.assigned[self.index.position(client_code)])
+            
+            # Продукт, назначенный по квоте, остается за клиентом, пока выгода по нему положительна
+            if assigned >= 0 and values[assigned] > 0:
+                ranked = [assigned]
+            else:
+                ranked = self.service.top_products(values)
+            
+            record = {
+                "client_code": client_code,
+                "client_name": features.get('name', 'Неизвестно'),
+                "recommendations": [
+                    {"product": self.index.products[product], "benefit_kzt_per_month": float(values[product])}
+                    for product in ranked
+                ]
+            }
+            self._clients[client_code] = {
+                "revision": self.revision, "features": features, "assigned": assigned, "ranked": ranked, "record": record
+            }
+            records.append(record)
+        return records
+
+
+# Дозагрузки пересчитываются по затронутым клиентам, пока их доля не больше этой, иначе - полный расчет
+INCREMENTAL_MAX_SHARE = 0.2
+
+
+def _source_fingerprint(source: Dict[str, str]) -> str:
+    """Отпечаток загрузки из UploadedInputs.sources"""
+    return f"{source['sha256']}:{source['mode']}"
+
+
+def _client_subset(data, client_codes):
+    """Строки или агрегаты только указанных клиентов"""
+    if isinstance(data, ClientAggregates):
+        return data.subset(client_codes)
+    return data[data['client_code'].isin(client_codes)]
+
+
+def _aggregate_categories(aggregates: ClientAggregates) -> list:
+    """Категории трат в агрегатах транзакций"""
+    return [] if aggregates.sums is None else list(aggregates.sums.index.levels[1])
+
+
+def _replace_rows(base: pd.DataFrame, positions: np.ndarray, rows: pd.DataFrame, columns: list) -> pd.DataFrame:
+    """Копия base, в которой строки positions колонок columns заменены строками rows (по порядку)"""
+    patched = base.copy(deep=False)
+    for column in columns:
+        patched.iloc[positions, patched.columns.get_loc(column)] = rows[column].to_numpy()
+    return patched
+
+
+# Стадии /process в порядке выполнения и их входы: загрузки (clients, transactions, transfers) или результаты стадий
+PIPELINE_STAGES = {
+    'transaction_aggregation': ('transactions',),
+    'transfer_aggregation': ('transfers',),
+    'flags': ('transaction_aggregation', 'transfer_aggregation'),
+    'merge': ('clients', 'transaction_aggregation', 'transfer_aggregation', 'flags'),
+    'benefits': ('merge',),
+    'ranking': ('merge', 'benefits'),
+}
+
+
+class StagedPipeline:
+    """Конвейер /process из стадий PIPELINE_STAGES с кешем результатов по отпечаткам входов
+    
+    Отпечаток загрузки - sha256 файла и режим загрузки (UploadedInputs.sources), отпечаток стадии -
+    sha256 от имени стадии, отпечатков ее входов и настроек сервиса. Хранится последний результат
+    каждой стадии: при новой загрузке одного файла пересчитываются только зависящие от него стадии,
+    остальные берутся из кеша. Стадия без известных отпечатков входов выполняется всегда.
+    Результаты стадий не изменяются после расчета, поэтому их можно отдавать повторно.
+    
+    Если транзакции или переводы дозагружены (mode=append) после последнего расчета, пересчитываются
+    только затронутые клиенты (run_incremental): их признаки и выгоды заменяются в прежних результатах,
+    а назначение по квотам обновляется без полной сортировки пар выгод.
+    """
+
+    def __init__(self, service: 'BankingMLService'):
+        self.service = service
+        self._entries = {}
+        # Отпечатки загрузок и категории транзакций последнего расчета - база для дозагрузок
+        self._last_inputs = {}
+        self._categories = None
+        self._lock = threading.Lock()
+
+    def run(self, inputs: 'UploadedInputs', progress=None):
+        """Таблица признаков, выгод и рекомендаций и отчет {стадия: 'ran' | 'reused' | 'incremental'}"""
+        progress = progress or _no_progress
+        service = self.service
+        outputs = {'clients': inputs.clients, 'transactions': inputs.transactions, 'transfers': inputs.transfers}
+        fingerprints = self._fingerprints(inputs)
+        
+        touched = self._touched_clients(inputs, fingerprints)
+        if touched is not None:
+            result = self.run_incremental(inputs, fingerprints, touched, progress)
+            if result is not None:
+                return result
+        
+        stages = {
+            'transaction_aggregation': lambda: service.transaction_metrics(outputs['transactions']),
+            'transfer_aggregation': lambda: service.transfer_metrics(outputs['transfers']),
+            'flags': lambda: service.collect_flag_codes(outputs['transaction_aggregation'], outputs['transfer_aggregation']),
+            'merge': lambda: service.merge_features(
+                outputs['clients'], outputs['transaction_aggregation'], outputs['transfer_aggregation'], outputs['flags']),
+            'benefits': lambda: service.compute_benefits(outputs['merge'], progress=progress),
+            'ranking': lambda: service.assign_ranking(outputs['merge'], outputs['benefits']),
+        }
+        # Стадии задачи /process, как и раньше: aggregation, flags, benefits, diversity
+        progress_stages = {
+            'transaction_aggregation': ('aggregation', _input_rows(inputs.transactions)),
+            'transfer_aggregation': ('aggregation', _input_rows(inputs.transfers)),
+            'flags': ('flags', len(inputs.clients)),
+            'ranking': ('diversity', len(inputs.clients)),
+        }
+        
+        report = {}
+        for stage in PIPELINE_STAGES:
+            fingerprint = fingerprints[stage]
+            with self._lock:
+                cached = self._entries.get(stage)
+            if fingerprint is not None and cached is not None and cached[0] == fingerprint:
+                outputs[stage] = cached[1]
+                report[stage] = 'reused'
+                continue
+            
+            if stage in progress_stages:
+                progress(*progress_stages[stage])
+            outputs[stage] = stages[stage]()
+            report[stage] = 'ran'
+            if fingerprint is not None:
+                with self._lock:
+                    self._entries[stage] = (fingerprint, outputs[stage])
+        
+        with self._lock:
+            self._last_inputs = fingerprints
+            self._categories = outputs['transaction_aggregation']["categories"]
+        merged = pd.concat([outputs['merge'], outputs['benefits'], outputs['ranking']["frame"]], axis=1)
+        return merged, report
+
+    def _fingerprints(self, inputs: 'UploadedInputs') -> Dict[str, str]:
+        """Отпечатки загрузок и всех стадий (None - неизвестен, стадия не кешируется)"""
+        config = self.service.config_fingerprint()
+        fingerprints = {}
+        for kind in ('clients', 'transactions', 'transfers'):
+            source = inputs.sources.get(kind)
+            fingerprints[kind] = _source_fingerprint(source) if source else None
+        for stage, depends in PIPELINE_STAGES.items():
+            upstream = [fingerprints[name] for name in depends]
+            fingerprints[stage] = None
+            if None not in upstream:
+                payload = json.dumps([stage, upstream, config], sort_keys=True, ensure_ascii=False)
+                fingerprints[stage] = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+        return fingerprints
+
+    def _touched_clients(self, inputs: 'UploadedInputs', fingerprints: Dict[str, str]):
+        """Коды клиентов, затронутых дозагрузками после последнего расчета; None - нужен обычный расчет"""
+        with self._lock:
+            last = self._last_inputs
+            entries = dict(self._entries)
+        if not last or last.get('ranking') is None or fingerprints['clients'] != last['clients']:
+            return None
+        if any(entries.get(stage, (None,))[0] != last[stage] for stage in ('merge', 'benefits', 'ranking')):
+            return None
+        if entries['ranking'][1]["pairs"] is None:
+            return None
+        
+        touched = []
+        for kind in ('transactions', 'transfers'):
+            if fingerprints[kind] == last[kind]:
+                continue
+            data = getattr(inputs, kind)
+            lineage = data.lineage if isinstance(data, ClientAggregates) else {}
+            if last[kind] not in lineage:
+                return None
+            touched.append(lineage[last[kind]])
+        if not touched:
+            return None
+        return np.unique(np.concatenate(touched))
+
+    def run_incremental(self, inputs: 'UploadedInputs', fingerprints: Dict[str, str], touched: np.ndarray, progress):
+        """Пересчет только затронутых клиентов поверх результатов последнего расчета; None - нужен полный расчет"""
+        service = self.service
+        with self._lock:
+            base = {stage: self._entries[stage][1] for stage in ('merge', 'benefits', 'ranking')}
+            categories = self._categories
+        
+        clients = inputs.clients
+        positions = np.flatnonzero(clients['client_code'].isin(touched).to_numpy())
+        if len(positions) > INCREMENTAL_MAX_SHARE * len(clients):
+            return None
+        # Новая категория трат меняет набор колонок - тогда нужен полный расчет
+        if fingerprints['transactions'] != self._last_inputs['transactions']:
+            if not set(_aggregate_categories(inputs.transactions)) <= set(categories):
+                return None
+        
+        progress('aggregation', len(positions))
+        codes = clients['client_code'].to_numpy()[positions]
+        transactions = service.transaction_metrics(_client_subset(inputs.transactions, codes), categories)
+        transfers = service.transfer_metrics(_client_subset(inputs.transfers, codes))
+        progress('flags', len(positions))
+        part = service.merge_features(
+            clients.iloc[positions], transactions, transfers, service.collect_flag_codes(transactions, transfers))
+        if list(part.columns) != list(base['merge'].columns):
+            return None
+        
+        part_benefits = service.compute_benefits(part, progress=progress)
+        progress('diversity', len(clients))
+        merged = _replace_rows(base['merge'], positions, part, [col for col in part.columns if col not in clients.columns])
+        benefits = _replace_rows(base['benefits'], positions, part_benefits, list(part_benefits.columns))
+        ranking = service.rerank(base['ranking'], merged, benefits, positions)
+        
+        # Пересчитаны стадии, зависящие (прямо или через другие стадии) от измененных загрузок, остальные - прежние
+        changed = {kind for kind in ('clients', 'transactions', 'transfers') if fingerprints[kind] != self._last_inputs[kind]}
+        report = {}
+        for stage, depends in PIPELINE_STAGES.items():
+            if changed.intersection(depends):
+                changed.add(stage)
+            report[stage] = 'incremental' if stage in changed else 'reused'
+        
+        with self._lock:
+            # Агрегаты и флаги измененных загрузок посчитаны только для части клиентов - в кеше их больше нет
+            for stage in ('transaction_aggregation', 'transfer_aggregation', 'flags'):
+                if report[stage] == 'incremental':
+                    self._entries.pop(stage, None)
+            for stage, output in (('merge', merged), ('benefits', benefits), ('ranking', ranking)):
+                self._entries[stage] = (fingerprints[stage], output)
+            self._last_inputs = fingerprints
+        
+        return pd.concat([merged, benefits, ranking["frame"]], axis=1), report
+
+
+class ProcessingCancelled(Exception):
+    """Обработка остановлена по запросу отмены задачи"""
+
+
+# Сколько завершенных задач /process хранить для запросов статуса
+PROCESS_JOBS_HISTORY = 20
+
+
+class ProcessingJob:
+    """Задача /process: выполняет work(job) в фоне, хранит стадию, число строк, время и результат
+    
+    work получает задачу и передает job.report как колбэк прогресса в process_data/calculate_benefits.
+    Отмена (cancel) срабатывает на ближайшем вызове report - до публикации результата.
+    lock - межпроцессный замок задачи (SharedDataStore.try_lock_processing), снимается по завершении run.
+    """
+
+    def __init__(self, work, store: 'SharedDataStore' = None, lock=None):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.stage = None
+        self.rows = 0
+        self.error = None
+        self.result = None
+        self._work = work
+        self._store = store
+        self._started = time.monotonic()
+        self._finished = None
+        self._cancel = threading.Event()
+        self._lock = lock
+        if lock is not None:
+            store.mark_processing(lock, self.id)
+
+    @property
+    def active(self) -> bool:
+        return self.status in ('queued', 'running')
+
+    def report(self, stage: str, rows: int):
+        """Колбэк прогресса; при запрошенной отмене прерывает обработку"""
+        if self._cancel.is_set() or (self._store is not None and self._store.cancel_requested(self.id)):
+            raise ProcessingCancelled(f"Задача {self.id} отменена на стадии {stage}")
+        self.stage = stage
+        self.rows = int(rows)
+        self.save_status()
+
+    def cancel(self):
+        self._cancel.set()
+        if self.status == 'queued':
+            self.status = 'cancelled'
+            self.save_status()
+
+    def save_status(self):
+        """Статус для запросов, попавших в другой воркер (при общем каталоге данных)"""
+        if self._store is not None:
+            self._store.save_job(self.to_dict())
+
+    def run(self):
+        if self._cancel.is_set():
+            self.status = 'cancelled'
+            self._release()
+            return
+        self.status = 'running'
+        self.save_status()
+        try:
+            self.result = self._work(self)
+            self.status = 'done'
+        except ProcessingCancelled as e:
+            logger.info(str(e))
+            self.status = 'cancelled'
+        except Exception as e:
+            logger.error(f"Ошибка при обработке данных: {str(e)}")
+            self.error = str(e)
+            self.status = 'failed'
+        finally:
+            self._finished = time.monotonic()
+            self.save_status()
+            self._release()
+
+    def _release(self):
+        """Снятие межпроцессного замка: следующий /process может запустить любой воркер"""
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        finished = self._finished if self._finished is not None else time.monotonic()
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "rows": self.rows,
+            "elapsed_seconds": round(finished - self._started, 3),
+            "error": self.error,
+            "result": self.result
+        }
+
+
+@dataclass(frozen=True)
+class UploadedInputs:
+    """Загруженные входные данные: клиенты, транзакции и переводы (DataFrame или ClientAggregates)
+    
+    Загрузка не меняет объект, а публикует новый через dataclasses.replace, поэтому /process
+    работает с теми входными данными, что были на момент запуска.
+    """
+    clients: Any = None
+    transactions: Any = None
+    transfers: Any = None
+    # Происхождение каждой загрузки: {вид данных: {"sha256": хеш файла, "mode": режим загрузки}}
+    sources: Dict[str, Dict[str, str]] = field(default_factory=dict)
+
+    @property
+    def complete(self) -> bool:
+        return self.clients is not None and self.transactions is not None and self.transfers is not None
+
+    def processing_key(self, config: Dict[str, Any]):
+        """Ключ результата /process: хеши всех трех загрузок и настройки сервиса; None, если хеш неизвестен"""
+        if any(kind not in self.sources for kind in ('clients', 'transactions', 'transfers')):
+            return None
+        payload = json.dumps({"inputs": self.sources, "config": config}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def counts(self) -> Dict[str, int]:
+        """Число загруженных строк по видам данных"""
+        return {
+            'clients': 0 if self.clients is None else len(self.clients),
+            'transactions': 0 if self.transactions is None else _input_rows(self.transactions),
+            'transfers': 0 if self.transfers is None else _input_rows(self.transfers)
+        }
+
+
+uploaded_inputs = UploadedInputs()
+
+# Разобранные загрузки по хешу содержимого (общий для всех видов данных)
+upload_cache = UploadCache()
+
+
+@dataclass(frozen=True)
+class DatasetSnapshot:
+    """Неизменяемый снимок одной версии обработанных данных
+    
+    Входные данные, признаки, выгоды и ранжирование (merged), индекс клиентов, кеш ответов,
+    уведомления и статистика собираются целиком и публикуются одним присваиванием current_snapshot.
+    Обработчик берет ссылку на снимок один раз и до конца запроса видит одну версию.
+    merged после публикации не изменяется; онлайн-события копятся отдельно в live.
+    """
+    version: str
+    inputs: UploadedInputs
+    merged: pd.DataFrame
+    index: ClientIndex
+    response_cache: ResponseCache
+    notifications: NotificationStore
+    stats: Dict[str, Any]
+    # Ключ входных данных и настроек (UploadedInputs.processing_key), по которому /process находит готовый результат
+    key: str = None
+    # Клиенты, измененные онлайн-событиями после расчета этой версии
+    live: LiveOverlay = None
+    # Клиенты по убыванию выгоды для каждого продукта
+    product_ranking: ProductRanking = None
+    # Первое поколение общего журнала событий, не вошедшее во входные данные (EventLog)
+    events_generation: int = 0
+
+    @classmethod
+    def build(cls, inputs: UploadedInputs, merged: pd.DataFrame, service: 'BankingMLService',
+              version: str = None, ranked: np.ndarray = None, ranked_benefits: np.ndarray = None,
+              stats: Dict[str, Any] = None, key: str = None,
+              product_orders: Dict[str, np.ndarray] = None, events_generation: int = 0,
+              product_groups: Dict[tuple, Dict[Any, np.ndarray]] = None) -> 'DatasetSnapshot':
+        """Снимок версии: индекс, пустой кеш ответов, ленивые уведомления, статистика и топы продуктов
+        
+        version, ranked, ranked_benefits, stats, product_orders и product_groups передаются при загрузке сохраненного снимка,
+        иначе создаются заново.
+        """
+        version = version or uuid.uuid4().hex
+        index = ClientIndex(merged, ranked, ranked_benefits)
+        return cls(
+            version=version,
+            inputs=inputs,
+            merged=merged,
+            index=index,
+            response_cache=ResponseCache(version, index),
+            notifications=NotificationStore(version, merged, service),
+            stats=stats if stats is not None else service.compute_stats(merged),
+            key=key,
+            live=LiveOverlay(merged, index, service, events_generation),
+            product_ranking=ProductRanking(merged, index.products, product_orders, product_groups),
+            events_generation=events_generation
+        )
+
+
+# Общий каталог данных для нескольких процессов-воркеров (см. wsgi.py); пусто - данные только в памяти процесса
+SHARED_DATA_DIR = os.environ.get('SHARED_DATA_DIR', '')
+
+# Каталог сохраненных снимков для теплого старта после перезапуска; по умолчанию пусто - снимки не сохраняются.
+# При SHARED_DATA_DIR снимки хранятся в общем каталоге (SHARED_DATA_DIR/snapshots)
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '')
+
+# Сколько последних версий снимков хранить на диске
+SNAPSHOT_KEEP_VERSIONS = int(os.environ.get('SNAPSHOT_KEEP_VERSIONS', 3))
+
+# Как часто воркер сверяет манифест снимков со своей версией, секунды
+SNAPSHOT_POLL_SECONDS = float(os.environ.get('SNAPSHOT_POLL_SECONDS', 1.0))
+
+# Сколько хранить замененные файлы загрузок (их может еще читать другой воркер), секунды
+INPUTS_RETENTION_SECONDS = 3600
+
+# Сколько хранить статусы задач /process и метки отмены в общем каталоге, секунды
+JOBS_RETENTION_SECONDS = 24 * 3600
+
+# Имя каталога версии снимка (uuid4().hex); другие каталоги в SNAPSHOT_DIR хранилище не трогает
+SNAPSHOT_VERSION_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+def _write_json_atomic(path: str, payload: Dict[str, Any]):
+    """Запись JSON через временный файл и os.replace: читатели видят либо старый, либо новый файл"""
+    staging = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(staging, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(staging, path)
+
+
+def _read_json(path: str):
+    """JSON из файла или None, если файла нет"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Межпроцессная блокировка (flock на файл-замок)"""
+    with open(path, 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _smallest_codes(codes: np.ndarray) -> np.ndarray:
+    """Коды словаря в минимальном целом типе (-1 - пропуск)"""
+    for dtype in (np.int8, np.int16, np.int32):
+        if len(codes) == 0 or codes.max() <= np.iinfo(dtype).max:
+            return codes.astype(dtype, copy=False)
+    return codes.astype(np.int64, copy=False)
+
+
+class SnapshotStore:
+    """Сохраненные на диск версии обработанных данных: теплый старт и общий доступ воркеров
+    
+    <version>/ - колонки merged по одной в .npy: числа как есть, строки и списки продуктов -
+    коды плюс словарь значений в meta.json; там же матрица ранжирования, выгоды рекомендованных
+    продуктов и статистика. Колонки открываются через mmap только для чтения: загрузка не читает
+    данные целиком, а при нескольких воркерах страницы данных общие для всех процессов.
+    
+    manifest.json - текущая версия и список хранимых версий; заменяется атомарно после записи
+    каталога версии. Хранятся последние keep версий, более старые удаляются.
+    """
+
+    def __init__(self, directory: str, keep: int = SNAPSHOT_KEEP_VERSIONS):
+        self.directory = directory
+        self.keep = max(1, keep)
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self._checked_at = 0.0
+        self._poll_lock = threading.Lock()
+
+    def save(self, snapshot: DatasetSnapshot):
+        """Запись снимка в <version>/, переключение манифеста на него и удаление старых версий"""
+        staging = os.path.join(self.directory, f"{snapshot.version}.tmp")
+        os.makedirs(staging, exist_ok=True)
+        
+        columns = [
+            self._save_column(staging, f'col_{number:03d}', snapshot.merged[name])
+            for number, name in enumerate(snapshot.merged.columns)
+        ]
+        np.save(os.path.join(staging, 'ranked.npy'), snapshot.index.ranked)
+        np.save(os.path.join(staging, 'ranked_benefits.npy'), snapshot.index.ranked_benefits)
+        # Порядки топов продуктов - одним массивом, границы продуктов - в meta.json
+        orders = [snapshot.product_ranking.orders[product] for product in snapshot.index.products]
+        np.save(os.path.join(staging, 'product_orders.npy'), np.concatenate(orders) if orders else np.empty(0, dtype=np.int32))
+        # Порядки продуктов по значениям city/status - так же одним массивом, состав и размеры - в meta.json
+        groups = [
+            (product, column, value, rows)
+            for (product, column), group in snapshot.product_ranking.groups.items() for value, rows in group.items()
+        ]
+        np.save(os.path.join(staging, 'product_groups.npy'),
+                np.concatenate([rows for *_, rows in groups]) if groups else np.empty(0, dtype=np.int32))
+        _write_json_atomic(os.path.join(staging, 'meta.json'), {
+            "version": snapshot.version,
+            "rows": len(snapshot.merged),
+            "columns": columns,
+            "products": list(snapshot.index.products),
+            "product_order_sizes": [len(order) for order in orders],
+            "product_groups": [[product, column, value, len(rows)] for product, column, value, rows in groups],
+            "stats": snapshot.stats,
+            "key": snapshot.key,
+            "events_generation": snapshot.events_generation
+        })
+        
+        self._publish({
+            "version": snapshot.version,
+            "created_at": datetime.now().isoformat(timespec='seconds'),
+            "clients": len(snapshot.merged),
+            "key": snapshot.key
+        }, staging=staging)
+
+    def activate(self, version: str):
+        """Сделать текущей уже сохраненную версию (повторный /process с теми же входными данными)"""
+        entry = next((other for other in self.versions() if other["version"] == version), None)
+        if entry is not None:
+            self._publish(entry)
+
+    def _publish(self, entry: Dict[str, Any], staging: str = None):
+        """Манифест: версия entry становится текущей и последней в списке, лишние версии удаляются
+        
+        Переименование записанного каталога staging в каталог версии, запись манифеста и удаление старых
+        версий идут под одной межпроцессной блокировкой: другой воркер не удалит каталог версии,
+        которая еще не попала в манифест.
+        """
+        with _file_lock(os.path.join(self.directory, '.lock')):
+            if staging is not None:
+                os.replace(staging, os.path.join(self.directory, entry["version"]))
+            manifest = _read_json(self.manifest_path) or {}
+            versions = [other for other in manifest.get("versions", []) if other["version"] != entry["version"]]
+            versions = (versions + [entry])[-self.keep:]
+            _write_json_atomic(self.manifest_path, {**entry, "versions": versions})
+            self._prune({other["version"] for other in versions})
+
+    def _prune(self, kept: set):
+        """Удаление каталогов версий, которых нет в манифесте; вызывается под блокировкой манифеста
+        
+        Удаляются только каталоги с именем версии (SNAPSHOT_VERSION_PATTERN): остальное содержимое
+        каталога снимков хранилищу не принадлежит.
+        Воркер, который еще читает удаленную версию через mmap, продолжает работать: отображенные
+        файлы остаются доступны до закрытия, а на новую версию он переключится при следующей проверке.
+        """
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if SNAPSHOT_VERSION_PATTERN.fullmatch(name) and name not in kept and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _save_column(self, directory: str, stem: str, series: pd.Series) -> Dict[str, Any]:
+        """Одна колонка в .npy; описание колонки для meta.json"""
+        meta = {"name": series.name, "file": f"{stem}.npy"}
+        if isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biuf':
+            meta["kind"] = 'array'
+            np.save(os.path.join(directory, meta["file"]), series.to_numpy())
+            return meta
+        
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes, values = series.cat.codes.to_numpy(), series.cat.categories.tolist()
+            meta["kind"] = 'category'
+        else:
+            # Строки и списки продуктов: словарь уникальных значений и коды строк
+            if series.dtype == object:
+                series = series.map(lambda value: tuple(value) if isinstance(value, list) else value)
+            codes, uniques = pd.factorize(series)
+            if any(isinstance(value, tuple) for value in uniques):
+                meta["kind"] = 'lists'
+                values = [list(value) for value in uniques]
+            else:
+                meta["kind"] = 'category'
+                values = pd.Index(uniques).tolist()
+        
+        meta["values"] = values
+        np.save(os.path.join(directory, meta["file"]), _smallest_codes(np.asarray(codes)))
+        return meta
+
+    def latest_version(self):
+        manifest = _read_json(self.manifest_path)
+        return manifest["version"] if manifest else None
+
+    def versions(self) -> List[Dict[str, Any]]:
+        """Хранимые версии из манифеста, от старых к новым"""
+        manifest = _read_json(self.manifest_path)
+        return manifest.get("versions", []) if manifest else []
+
+    def find(self, key: str):
+        """Самая новая сохраненная версия, посчитанная по ключу входных данных key, или None"""
+        if key is None:
+            return None
+        return next((entry["version"] for entry in reversed(self.versions()) if entry.get("key") == key), None)
+
+    def load(self, service: 'BankingMLService', version: str = None) -> DatasetSnapshot:
+        """Снимок версии (по умолчанию текущей по манифесту) с колонками через mmap; None, если снимков нет"""
+        version = version or self.latest_version()
+        if version is None:
+            return None
+        directory = os.path.join(self.directory, version)
+        meta = _read_json(os.path.join(directory, 'meta.json'))
+        
+        columns = {}
+        for column in meta["columns"]:
+            data = np.load(os.path.join(directory, column["file"]), mmap_mode='r')
+            if column["kind"] == 'array':
+                columns[column["name"]] = data
+            elif column["kind"] == 'category':
+                columns[column["name"]] = pd.Categorical.from_codes(data, categories=column["values"])
+            else:
+                # Последний элемент словаря - пропуск для кода -1
+                lookup = np.empty(len(column["values"]) + 1, dtype=object)
+                for position, value in enumerate(column["values"]):
+                    lookup[position] = value
+                columns[column["name"]] = lookup[data]
+        
+        merged = pd.DataFrame(columns, copy=False)
+        ranked = np.load(os.path.join(directory, 'ranked.npy'), mmap_mode='r')
+        ranked_benefits = np.load(os.path.join(directory, 'ranked_benefits.npy'), mmap_mode='r')
+        
+        # Снимки прежних версий без сохраненных топов продуктов (или их порядков по city/status) - они строятся заново
+        product_orders = None
+        if "product_order_sizes" in meta:
+            orders = np.load(os.path.join(directory, 'product_orders.npy'), mmap_mode='r')
+            bounds = np.cumsum([0] + meta["product_order_sizes"])
+            product_orders = {
+                product: orders[start:stop] for product, start, stop in zip(meta["products"], bounds[:-1], bounds[1:])
+            }
+        product_groups = None
+        if "product_groups" in meta:
+            rows = np.load(os.path.join(directory, 'product_groups.npy'), mmap_mode='r')
+            bounds = np.cumsum([0] + [size for *_, size in meta["product_groups"]])
+            product_groups = {}
+            for (product, column, value, _), start, stop in zip(meta["product_groups"], bounds[:-1], bounds[1:]):
+                product_groups.setdefault((product, column), {})[value] = rows[start:stop]
+        return DatasetSnapshot.build(UploadedInputs(), merged, service, version=version, ranked=ranked,
+                                     ranked_benefits=ranked_benefits, stats=meta["stats"], key=meta.get("key"),
+                                     product_orders=product_orders, events_generation=meta.get("events_generation", 0),
+                                     product_groups=product_groups)
+
+    def poll(self, current: DatasetSnapshot, service: 'BankingMLService') -> DatasetSnapshot:
+        """Новый снимок, если манифест указывает на другую версию; иначе None
+        
+        Манифест читается не чаще раза в SNAPSHOT_POLL_SECONDS; пока один поток загружает снимок,
+        остальные продолжают работать с текущим.
+        """
+        now = time.monotonic()
+        if now - self._checked_at < SNAPSHOT_POLL_SECONDS or not self._poll_lock.acquire(blocking=False):
+            return None
+        try:
+            self._checked_at = now
+            version = self.latest_version()
+            if version is None or (current is not None and current.version == version):
+                return None
+            logger.info(f"Загрузка снимка данных версии {version} из {self.directory}")
+            return self.load(service, version)
+        finally:
+            self._poll_lock.release()
+
+
+class EventLog:
+    """Общий для воркеров журнал онлайн-событий: <поколение>.ndjson, по строке на порцию /events
+    
+    Запрос /events дописывает строку под межпроцессной блокировкой - время зависит только от размера порции,
+    загрузки не читаются. Каждый воркер дочитывает журнал со своей позиции (LiveOverlay.cursor) и применяет
+    новые порции к live своего снимка, поэтому клиенты, измененные событиями, видны во всех воркерах.
+    
+    /process сворачивает еще не учтенные поколения в дозагрузки (rotate, затем mark_folded) и открывает новое
+    поколение: события нового поколения войдут в следующий расчет. Поколения, которые уже есть во входных
+    данных опубликованного снимка, удаляются (remove_before).
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock_path = os.path.join(directory, '.lock')
+        self.folded_path = os.path.join(directory, 'folded.json')
+
+    def _path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"{generation:08d}.ndjson")
+
+    def generations(self) -> List[int]:
+        """Поколения журнала по возрастанию"""
+        return sorted(int(name[:-7]) for name in os.listdir(self.directory) if name.endswith('.ndjson') and name[:-7].isdigit())
+
+    def folded(self) -> int:
+        """Первое поколение, еще не свернутое в загрузки"""
+        return (_read_json(self.folded_path) or {}).get("generation", 0)
+
+    def append(self, kind: str, events_sha256: str, events: List[Dict[str, Any]]) -> tuple:
+        """Запись порции событий в текущее поколение; возвращает позицию порции (поколение, смещение)"""
+        line = json.dumps({"kind": kind, "sha256": events_sha256, "events": events}, ensure_ascii=False) + '\n'
+        with _file_lock(self.lock_path):
+            generation = max(self.generations() + [self.folded()])
+            with open(self._path(generation), 'ab') as f:
+                offset = f.tell()
+                f.write(line.encode('utf-8'))
+        return generation, offset
+
+    def changed(self, cursor: tuple) -> bool:
+        """Есть ли порции после позиции cursor: размер текущего поколения и наличие следующего, без чтения каталога"""
+        generation, offset = cursor
+        try:
+            if os.path.getsize(self._path(generation)) > offset:
+                return True
+        except FileNotFoundError:
+            pass
+        return os.path.exists(self._path(generation + 1))
+
+    def read(self, cursor: tuple):
+        """Порции после позиции cursor: список (позиция, вид, sha256, события) и новая позиция"""
+        generation, offset = cursor
+        entries = []
+        for current in self.generations():
+            if current < generation:
+                continue
+            if current > generation:
+                generation, offset = current, 0
+            path = self._path(current)
+            try:
+                if os.path.getsize(path) <= offset:
+                    continue
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            # Строка, которую другой воркер еще дописывает, будет прочитана в следующий раз
+            data = data[:data.rfind(b'\n') + 1]
+            for line in data.splitlines(keepends=True):
+                entry = json.loads(line)
+                entries.append(((current, offset), entry["kind"], entry["sha256"], entry["events"]))
+                offset += len(line)
+        return entries, (generation, offset)
+
+    def rotate(self):
+        """Порции всех несвернутых поколений и номер нового поколения для следующих событий
+        
+        Если несвернутых событий нет, новое поколение не открывается и возвращается ([], folded()).
+        """
+        with _file_lock(self.lock_path):
+            folded = self.folded()
+            pending = [generation for generation in self.generations() if generation >= folded]
+            if not any(os.path.getsize(self._path(generation)) for generation in pending):
+                return [], folded
+            generation = max(pending) + 1
+            open(self._path(generation), 'ab').close()
+        # В прежние поколения больше никто не пишет - их можно читать без блокировки
+        entries, _ = self.read((folded, 0))
+        return [entry for entry in entries if entry[0][0] < generation], generation
+
+    def mark_folded(self, generation: int):
+        """Поколения до generation перенесены в загрузки"""
+        _write_json_atomic(self.folded_path, {"generation": generation})
+
+    def remove_before(self, generation: int):
+        """Удаление поколений, которые уже вошли во входные данные опубликованного снимка"""
+        for current in self.generations():
+            if current < min(generation, self.folded()):
+                try:
+                    os.remove(self._path(current))
+                except FileNotFoundError:
+                    pass
+
+
+class SharedDataStore:
+    """Общий для процессов-воркеров каталог: снимки обработанных данных, загрузки и статусы задач /process
+    
+    snapshots/ - снимки версий (SnapshotStore); воркеры сверяются с манифестом не чаще раза
+    в SNAPSHOT_POLL_SECONDS и подхватывают новую версию без перезапуска.
+    inputs/ - последние загрузки (pickle) и их манифест, чтобы /process мог выполнить любой воркер.
+    jobs/ - статусы задач /process, метки отмены и замок единственной задачи для всех воркеров.
+    events/ - журнал онлайн-событий (EventLog).
+    
+    Каталогу доверяют: загрузки читаются через pickle.load, а он может выполнить произвольный код.
+    Писать в каталог должен только пользователь сервиса; доступный всем на запись каталог дает предупреждение.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.snapshots = SnapshotStore(os.path.join(root, 'snapshots'))
+        self.inputs_dir = os.path.join(root, 'inputs')
+        self.jobs_dir = os.path.join(root, 'jobs')
+        for path in (self.inputs_dir, self.jobs_dir):
+            os.makedirs(path, exist_ok=True)
+        self.inputs_manifest_path = os.path.join(self.inputs_dir, 'manifest.json')
+        self.processing_lock_path = os.path.join(self.jobs_dir, '.process-lock')
+        self.events = EventLog(os.path.join(root, 'events'))
+        self._inputs = ({}, UploadedInputs())
+        for path in (root, self.inputs_dir):
+            if os.stat(path).st_mode & stat.S_IWOTH:
+                logger.warning(f"Каталог {path} доступен на запись всем пользователям: загрузки из него читаются через pickle")
+
+    # --- загрузки ---
+
+    def save_input(self, kind: str, data, source: Dict[str, str]) -> Dict[str, int]:
+        """Сохранение загрузки вида kind для всех воркеров; возвращает число строк по видам данных
+        
+        Имя файла строится по хешу содержимого: повторная загрузка того же файла не пишется заново.
+        """
+        filename = f"{kind}-{source['mode']}-{source['sha256']}.pkl"
+        path = os.path.join(self.inputs_dir, filename)
+        if os.path.exists(path):
+            # Продлеваем срок хранения, чтобы файл не удалили как замененный
+            os.utime(path)
+        else:
+            staging = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(staging, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(staging, path)
+        
+        with _file_lock(os.path.join(self.inputs_dir, '.lock')):
+            manifest = _read_json(self.inputs_manifest_path) or {}
+            manifest[kind] = {"file": filename, "rows": _input_rows(data), **source}
+            _write_json_atomic(self.inputs_manifest_path, manifest)
+        
+        # Этот воркер уже держит данные в памяти - повторно читать файл не нужно
+        cached_manifest, cached_inputs = self._inputs
+        self._inputs = (
+            {**cached_manifest, kind: manifest[kind]},
+            replace(cached_inputs, **{kind: data}, sources={**cached_inputs.sources, kind: source})
+        )
+        self._remove_stale_inputs(manifest)
+        
+        return {name: manifest.get(name, {}).get("rows", 0) for name in ('clients', 'transactions', 'transfers')}
+
+    def append_lock(self):
+        """Межпроцессная блокировка дозагрузок: чтение текущей загрузки и запись новой - без гонок"""
+        return _file_lock(os.path.join(self.inputs_dir, '.append-lock'))
+
+    def load_inputs(self) -> UploadedInputs:
+        """Последние загрузки всех воркеров; перечитываются только изменившиеся виды данных"""
+        manifest = _read_json(self.inputs_manifest_path) or {}
+        cached_manifest, inputs = self._inputs
+        for kind, entry in manifest.items():
+            if cached_manifest.get(kind) != entry:
+                with open(os.path.join(self.inputs_dir, entry["file"]), 'rb') as f:
+                    data = pickle.load(f)
+                if not isinstance(data, (pd.DataFrame, ClientAggregates)):
+                    raise TypeError(f"Файл загрузки {entry['file']} содержит {type(data).__name__}, а не данные загрузки")
+                # Загрузки, сохраненные до появления хешей, не участвуют в кеше результатов /process
+                sources = {name: other for name, other in inputs.sources.items() if name != kind}
+                if "sha256" in entry:
+                    sources[kind] = {"sha256": entry["sha256"], "mode": entry["mode"]}
+                inputs = replace(inputs, **{kind: data}, sources=sources)
+        self._inputs = (manifest, inputs)
+        return inputs
+
+    def _remove_stale_inputs(self, manifest: Dict[str, Any]):
+        """Удаление замененных файлов загрузок старше INPUTS_RETENTION_SECONDS"""
+        current = {entry["file"] for entry in manifest.values()}
+        now = time.time()
+        for filename in os.listdir(self.inputs_dir):
+            path = os.path.join(self.inputs_dir, filename)
+            if filename.endswith('.pkl') and filename not in current and now - os.path.getmtime(path) > INPUTS_RETENTION_SECONDS:
+                os.remove(path)
+
+    # --- задачи /process ---
+
+    def save_job(self, status: Dict[str, Any]):
+        """Статус задачи для всех воркеров; у завершенной задачи метка отмены больше не нужна"""
+        _write_json_atomic(os.path.join(self.jobs_dir, f"{status['job_id']}.json"), status)
+        if status["status"] not in ('queued', 'running'):
+            try:
+                os.remove(os.path.join(self.jobs_dir, f"{status['job_id']}.cancel"))
+            except FileNotFoundError:
+                pass
+
+    def load_job(self, job_id: str):
+        if not all(char in '0123456789abcdef' for char in job_id):
+            return None
+        return _read_json(os.path.join(self.jobs_dir, f"{job_id}.json"))
+
+    def request_cancel(self, job_id: str):
+        open(os.path.join(self.jobs_dir, f"{job_id}.cancel"), 'w').close()
+
+    def cancel_requested(self, job_id: str) -> bool:
+        return os.path.exists(os.path.join(self.jobs_dir, f"{job_id}.cancel"))
+
+    def try_lock_processing(self):
+        """Замок единственной задачи /process во всех воркерах: открытый файл или None, если задача уже идет
+        
+        flock держится, пока файл открыт, и снимается ОС при падении процесса - зависших замков не бывает.
+        """
+        lock_file = open(self.processing_lock_path, 'a+', encoding='utf-8')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+        return lock_file
+
+    def mark_processing(self, lock_file, job_id: str):
+        """Запись задачи, держащей замок, - для ответа 409 в других воркерах"""
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(job_id)
+        lock_file.flush()
+
+    def processing_job_id(self):
+        """Задача, держащая замок /process (или последняя державшая его)"""
+        try:
+            with open(self.processing_lock_path, encoding='utf-8') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def remove_stale_jobs(self):
+        """Удаление статусов задач и меток отмены, не менявшихся дольше JOBS_RETENTION_SECONDS"""
+        now = time.time()
+        for filename in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, filename)
+            if filename.endswith(('.json', '.cancel')) and now - os.path.getmtime(path) > JOBS_RETENTION_SECONDS:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def _open_snapshot_store():
+    """Каталог снимков: общий при SHARED_DATA_DIR, иначе SNAPSHOT_DIR; None - снимки не сохраняются"""
+    if shared_store is not None:
+        return shared_store.snapshots
+    if not SNAPSHOT_DIR:
+        return None
+    try:
+        return SnapshotStore(SNAPSHOT_DIR)
+    except OSError as e:
+        logger.error(f"Каталог снимков {SNAPSHOT_DIR} недоступен, снимки не сохраняются: {str(e)}")
+        return None
+
+
+shared_store = SharedDataStore(SHARED_DATA_DIR) if SHARED_DATA_DIR else None
+snapshot_store = _open_snapshot_store()
+
+
+# Инициализация сервиса (движок расчета выгоды и версия датасета для шума задаются переменными окружения)
+ml_service = BankingMLService(
+    benefit_engine=os.environ.get('BENEFIT_ENGINE', 'vectorized'),
+    dataset_version=os.environ.get('DATASET_VERSION', '1')
+)
+
+# Конвейер /process с кешем результатов стадий
+pipeline = StagedPipeline(ml_service)
+
+
+def _publish_snapshot(snapshot: DatasetSnapshot):
+    """Публикация новой версии; онлайн-события, не вошедшие в ее входные данные, переносятся в ее live"""
+    global current_snapshot
+    
+    with events_lock:
+        for kind, delta, _ in pending_events:
+            snapshot.live.apply(kind, delta)
+        _sync_live_events(snapshot)
+        current_snapshot = snapshot
+
+
+def _sync_live_events(snapshot: DatasetSnapshot) -> Dict[tuple, tuple]:
+    """Применение к live снимка порций общего журнала событий, которых этот воркер еще не видел
+    
+    Вызывается под events_lock. Возвращает {позиция порции: (ответы по измененным клиентам, неизвестные коды)}.
+    """
+    if shared_store is None or snapshot is None:
+        return {}
+    entries, cursor = shared_store.events.read(snapshot.live.cursor)
+    results = {}
+    for position, kind, _, events in entries:
+        delta = ml_service.aggregate(kind, pd.DataFrame.from_records(events), warn_missing=False)
+        results[position] = snapshot.live.apply(kind, delta)
+    snapshot.live.cursor = cursor
+    return results
+
+
+def warm_start():
+    """Загрузка последнего сохраненного снимка при старте: сервер отвечает без повторных загрузок и /process
+    
+    Вызывается точкой входа (python app.py, wsgi.py), а не при импорте модуля.
+    """
+    global current_snapshot
+    
+    if snapshot_store is None:
+        return
+    try:
+        started = time.perf_counter()
+        snapshot = snapshot_store.load(ml_service)
+        if snapshot is not None:
+            current_snapshot = snapshot
+            logger.info(f"Загружен снимок данных версии {snapshot.version} ({len(snapshot.merged)} клиентов) "
+                        f"за {time.perf_counter() - started:.3f} с")
+    except Exception as e:
+        # Поврежденный снимок не мешает старту: данные можно загрузить и обработать заново
+        logger.error(f"Ошибка при загрузке сохраненного снимка данных: {str(e)}")
+
+
+@app.before_request
+def sync_shared_snapshot():
+    """Переключение на новую версию снимка из общего каталога, если ее опубликовал другой воркер,
+    и применение событий из общего журнала
+    
+    Журнал, как и манифест снимков, проверяется не чаще раза в SNAPSHOT_POLL_SECONDS и двумя stat без чтения
+    каталога; events_lock берется, только если в журнале есть новые порции. Собственные события воркер
+    применяет сразу в /events.
+    """
+    global current_snapshot, events_checked_at
+    
+    if shared_store is None:
+        return
+    try:
+        snapshot = snapshot_store.poll(current_snapshot, ml_service)
+        if snapshot is not None:
+            _publish_snapshot(snapshot)
+        # События, принятые другими воркерами
+        snapshot, now = current_snapshot, time.monotonic()
+        if snapshot is None or now - events_checked_at < SNAPSHOT_POLL_SECONDS:
+            return
+        events_checked_at = now
+        if shared_store.events.changed(snapshot.live.cursor):
+            with events_lock:
+                _sync_live_events(current_snapshot)
+    except Exception as e:
+        # Запрос обслуживается текущим снимком, следующая проверка - через SNAPSHOT_POLL_SECONDS
+        logger.error(f"Ошибка при загрузке снимка данных: {str(e)}")
+
+@app.route('/', methods=['GET'])
+def index():
+    """Главная страница с веб-интерфейсом"""
+    return render_template('index.html')
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Проверка состояния сервера"""
+    return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()})
+
+def _upload_mode() -> str:
+    """Режим загрузки: frame (файл целиком в DataFrame) или stream (потоковая агрегация)"""
+    return request.args.get('mode', request.form.get('mode', 'frame'))
+
+def _upload_chunksize():
+    """Размер куска для потоковой загрузки или None, если это не положительное целое число"""
+    try:
+        chunksize = int(request.args.get('chunksize', request.form.get('chunksize', INGEST_CHUNK_SIZE)))
+    except ValueError:
+        return None
+    return chunksize if chunksize > 0 else None
+
+def _store_upload(kind: str, data, source: Dict[str, str]) -> Dict[str, int]:
+    """Публикация загрузки вида kind для /process; возвращает число строк по видам данных
+    
+    При общем каталоге загрузка сохраняется для всех воркеров, а число строк считается по загрузкам всех воркеров.
+    """
+    global uploaded_inputs
+    
+    with uploads_lock:
+        inputs = uploaded_inputs = replace(uploaded_inputs, **{kind: data}, sources={**uploaded_inputs.sources, kind: source})
+    return shared_store.save_input(kind, data, source) if shared_store is not None else inputs.counts()
+
+
+def _append_upload(kind: str, delta: ClientAggregates, delta_sha256: str, skip_applied: bool = False):
+    """Дозагрузка: агрегаты новой порции добавляются к текущей загрузке вида kind (mode=append)
+    
+    Прежние агрегаты не меняются - их могут читать идущий /process и кеш стадий. Дозагрузки выполняются
+    по одной (при общем каталоге - и между воркерами), чтобы ни одна порция не потерялась.
+    skip_applied - файл, уже входящий в цепочку загрузок (полная загрузка или одна из дозагрузок после нее),
+    повторно не добавляется: его суммы посчитались бы дважды. Порции событий так не проверяются - одинаковые
+    тела запросов там означают разные события.
+    Возвращает (агрегаты, описание загрузки, число строк по видам данных, добавлена ли порция).
+    """
+    with appends_lock, (shared_store.append_lock() if shared_store is not None else nullcontext()):
+        current = shared_store.load_inputs() if shared_store is not None else uploaded_inputs
+        base, base_source = getattr(current, kind), current.sources.get(kind)
+        if skip_applied and base is not None and base_source is not None:
+            applied = base.applied_deltas() if isinstance(base, ClientAggregates) else ()
+            if delta_sha256 in applied or (base_source.get("mode") != 'append' and base_source.get("sha256") == delta_sha256):
+                return base, base_source, current.counts(), False
+        parent = _source_fingerprint(base_source) if base_source else None
+        if base is None:
+            combined = copy.copy(delta)
+            combined.applied = (delta_sha256,)
+        else:
+            combined = ml_service.aggregate(kind, base).appended(delta, parent, delta_sha256)
+            if base_source is not None and base_source.get("mode") != 'append':
+                # Хеш полной загрузки - начало цепочки: ее файл тоже не добавляется как порция
+                combined.applied = (base_source["sha256"], *combined.applied)
+        
+        # Отпечаток дозагрузки зависит от всей цепочки: прежняя загрузка плюс новая порция
+        chained = hashlib.sha256(f"{parent or ''}+{delta_sha256}".encode('utf-8')).hexdigest()
+        source = {"sha256": chained, "mode": 'append'}
+        return combined, source, _store_upload(kind, combined, source), True
+
+
+@app.route('/upload/clients', methods=['POST'])
+def upload_clients():
+    """Загрузка данных клиентов"""
+    
+    try:
+        if 'file' not in request.files:
             return jsonify({"error": "Файл не найден"}), 400
         
         file = request.files['file']
         if file.filename == '':
             return jsonify({"error": "Файл не выбран"}), 400
         
-        if file.filename.endswith('.csv'):
-            clients_data = pd.read_csv(file)
-            data_counts['clients'] = len(clients_data)
-        else:
+        if not file.filename.endswith('.csv'):
             return jsonify({"error": "Поддерживаются только CSV файлы"}), 400
         
-        # Подсчитываем общее количество данных
+        # Тот же файл повторно не разбирается: берем готовый DataFrame по хешу содержимого
+        source = {"sha256": content_hash(file.stream), "mode": 'frame'}
+        (clients_data, memory), cached = upload_cache.get_or_parse(
+            ('clients', source["mode"], source["sha256"]), lambda: read_csv_compact(file, 'clients'))
+        
+        # Подсчитываем общее количество данных (при общем каталоге - по загрузкам всех воркеров)
+        data_counts = _store_upload('clients', clients_data, source)
         total_records = sum(data_counts.values())
         
         logger.info(f"Загружены данные {len(clients_data)} клиентов")
         return jsonify({
             "message": f"Загружены данные {len(clients_data)} клиентов",
             "total_records": total_records,
-            "breakdown": {
-                "clients": data_counts['clients'],
-                "transactions": data_counts['transactions'],
-                "transfers": data_counts['transfers']
-            },
+            "breakdown": data_counts,
             "columns": list(clients_data.columns),
-            "sample": clients_data.head().to_dict('records')
+            "sample": clients_data.head().to_dict('records'),
+            "memory": memory,
+            "content_sha256": source["sha256"],
+            "cache": "hit" if cached else "miss"
         })
         
     except Exception as e:
@@ -871,7 +3848,6 @@ def upload_clients():
 @app.route('/upload/transactions', methods=['POST'])
 def upload_transactions():
     """Загрузка данных транзакций"""
-    global transactions_data, data_counts
     
     try:
         if 'file' not in request.files:
@@ -881,26 +3857,57 @@ def upload_transactions():
         if file.filename == '':
             return jsonify({"error": "Файл не выбран"}), 400
         
-        if file.filename.endswith('.csv'):
-            transactions_data = pd.read_csv(file)
-            data_counts['transactions'] = len(transactions_data)
-        else:
+        if not file.filename.endswith('.csv'):
             return jsonify({"error": "Поддерживаются только CSV файлы"}), 400
         
-        # Подсчитываем общее количество данных
+        mode = _upload_mode()
+        if mode not in UPLOAD_MODES:
+            return jsonify({"error": f"Неизвестный режим загрузки: {mode}"}), 400
+        chunksize = _upload_chunksize()
+        if chunksize is None:
+            return jsonify({"error": "chunksize должен быть положительным целым числом"}), 400
+        
+        # Тот же файл в том же режиме повторно не разбирается: результат берется по хешу содержимого
+        source = {"sha256": content_hash(file.stream), "mode": mode}
+        cache_key = ('transactions', mode, source["sha256"])
+        
+        # mode=stream: файл читается кусками и сразу сворачивается в агрегаты по клиентам;
+        # mode=append: так же, и агрегаты добавляются к уже загруженным
+        if mode in ('stream', 'append'):
+            transactions_data, cached = upload_cache.get_or_parse(
+                cache_key, lambda: read_csv_aggregates(file, 'transactions', ml_service, chunksize))
+            rows, columns, sample = transactions_data.rows, transactions_data.columns, transactions_data.sample
+            memory = {"columns": {}, "total_before": None, "total_after": transactions_data.memory_usage()}
+        else:
+            (transactions_data, memory), cached = upload_cache.get_or_parse(cache_key, lambda: read_csv_compact(file, 'transactions'))
+            rows, columns, sample = len(transactions_data), list(transactions_data.columns), transactions_data.head().to_dict('records')
+        
+        # Подсчитываем общее количество данных (при общем каталоге - по загрузкам всех воркеров)
+        appended = None
+        if mode == 'append':
+            transactions_data, source, data_counts, appended = _append_upload('transactions', transactions_data, source["sha256"], skip_applied=True)
+        else:
+            data_counts = _store_upload('transactions', transactions_data, source)
         total_records = sum(data_counts.values())
         
-        logger.info(f"Загружены данные {len(transactions_data)} транзакций")
+        if appended is False:
+            # Тот же файл уже добавлен: загрузка не меняется, его строки не считаются второй раз
+            logger.info("Порция транзакций уже добавлена, повторная дозагрузка пропущена")
+            message = "Порция транзакций уже добавлена ранее, данные не изменены"
+        else:
+            logger.info(f"Загружены данные {rows} транзакций")
+            message = f"Загружены данные {rows} транзакций"
         return jsonify({
-            "message": f"Загружены данные {len(transactions_data)} транзакций",
+            "message": message,
             "total_records": total_records,
-            "breakdown": {
-                "clients": data_counts['clients'],
-                "transactions": data_counts['transactions'],
-                "transfers": data_counts['transfers']
-            },
-            "columns": list(transactions_data.columns),
-            "sample": transactions_data.head().to_dict('records')
+            "breakdown": data_counts,
+            "columns": columns,
+            "sample": sample,
+            "memory": memory,
+            "content_sha256": source["sha256"],
+            "cache": "hit" if cached else "miss",
+            # mode=append: добавлена ли порция (false - этот файл уже есть в цепочке загрузок)
+            "appended": appended
         })
         
     except Exception as e:
@@ -910,7 +3917,6 @@ def upload_transactions():
 @app.route('/upload/transfers', methods=['POST'])
 def upload_transfers():
     """Загрузка данных переводов"""
-    global transfers_data, data_counts
     
     try:
         if 'file' not in request.files:
@@ -920,82 +3926,440 @@ def upload_transfers():
         if file.filename == '':
             return jsonify({"error": "Файл не выбран"}), 400
         
-        if file.filename.endswith('.csv'):
-            transfers_data = pd.read_csv(file)
-            data_counts['transfers'] = len(transfers_data)
-        else:
+        if not file.filename.endswith('.csv'):
             return jsonify({"error": "Поддерживаются только CSV файлы"}), 400
         
-        # Подсчитываем общее количество данных
+        mode = _upload_mode()
+        if mode not in UPLOAD_MODES:
+            return jsonify({"error": f"Неизвестный режим загрузки: {mode}"}), 400
+        chunksize = _upload_chunksize()
+        if chunksize is None:
+            return jsonify({"error": "chunksize должен быть положительным целым числом"}), 400
+        
+        # Тот же файл в том же режиме повторно не разбирается: результат берется по хешу содержимого
+        source = {"sha256": content_hash(file.stream), "mode": mode}
+        cache_key = ('transfers', mode, source["sha256"])
+        
+        # mode=stream: файл читается кусками и сразу сворачивается в агрегаты по клиентам;
+        # mode=append: так же, и агрегаты добавляются к уже загруженным
+        if mode in ('stream', 'append'):
+            transfers_data, cached = upload_cache.get_or_parse(
+                cache_key, lambda: read_csv_aggregates(file, 'transfers', ml_service, chunksize))
+            rows, columns, sample = transfers_data.rows, transfers_data.columns, transfers_data.sample
+            memory = {"columns": {}, "total_before": None, "total_after": transfers_data.memory_usage()}
+        else:
+            (transfers_data, memory), cached = upload_cache.get_or_parse(cache_key, lambda: read_csv_compact(file, 'transfers'))
+            rows, columns, sample = len(transfers_data), list(transfers_data.columns), transfers_data.head().to_dict('records')
+        
+        # Подсчитываем общее количество данных (при общем каталоге - по загрузкам всех воркеров)
+        appended = None
+        if mode == 'append':
+            transfers_data, source, data_counts, appended = _append_upload('transfers', transfers_data, source["sha256"], skip_applied=True)
+        else:
+            data_counts = _store_upload('transfers', transfers_data, source)
         total_records = sum(data_counts.values())
         
-        logger.info(f"Загружены данные {len(transfers_data)} переводов")
+        if appended is False:
+            # Тот же файл уже добавлен: загрузка не меняется, его строки не считаются второй раз
+            logger.info("Порция переводов уже добавлена, повторная дозагрузка пропущена")
+            message = "Порция переводов уже добавлена ранее, данные не изменены"
+        else:
+            logger.info(f"Загружены данные {rows} переводов")
+            message = f"Загружены данные {rows} переводов"
         return jsonify({
-            "message": f"Загружены данные {len(transfers_data)} переводов",
+            "message": message,
             "total_records": total_records,
-            "breakdown": {
-                "clients": data_counts['clients'],
-                "transactions": data_counts['transactions'],
-                "transfers": data_counts['transfers']
-            },
-            "columns": list(transfers_data.columns),
-            "sample": transfers_data.head().to_dict('records')
+            "breakdown": data_counts,
+            "columns": columns,
+            "sample": sample,
+            "memory": memory,
+            "content_sha256": source["sha256"],
+            "cache": "hit" if cached else "miss",
+            # mode=append: добавлена ли порция (false - этот файл уже есть в цепочке загрузок)
+            "appended": appended
         })
         
     except Exception as e:
         logger.error(f"Ошибка при загрузке переводов: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/process', methods=['POST'])
-def process_data():
-    """Обработка всех данных и расчет рекомендаций"""
-    global clients_data, transactions_data, transfers_data, merged_data
+# Максимум событий в одном запросе /events
+EVENTS_MAX_BATCH = int(os.environ.get('EVENTS_MAX_BATCH', 10000))
+
+
+def _read_events(kind: str):
+    """События из тела запроса: JSON-объект, JSON-массив или NDJSON (по событию в строке)
     
+    Возвращает (DataFrame с колонками INGEST_SCHEMAS[kind], None) или (None, текст ошибки).
+    """
+    body = request.get_data(as_text=True)
     try:
-        if clients_data is None or transactions_data is None or transfers_data is None:
-            return jsonify({"error": "Не все данные загружены. Загрузите клиентов, транзакции и переводы."}), 400
-        
-        # Обработка данных
-        merged_data = ml_service.process_data(clients_data, transactions_data, transfers_data)
-        
-        # Расчет выгоды
-        merged_data = ml_service.calculate_benefits(merged_data)
-        
-        logger.info(f"Обработаны данные для {len(merged_data)} клиентов")
+        if request.mimetype == 'application/x-ndjson':
+            records = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            payload = json.loads(body)
+            records = [payload] if isinstance(payload, dict) else payload
+    except ValueError:
+        return None, "Некорректный JSON"
+    
+    if not isinstance(records, list) or not records or not all(isinstance(record, dict) for record in records):
+        return None, "Ожидается событие, массив событий или NDJSON"
+    if len(records) > EVENTS_MAX_BATCH:
+        return None, f"Не больше {EVENTS_MAX_BATCH} событий в одном запросе"
+    
+    events = pd.DataFrame.from_records(records)
+    missing = [col for col in ('client_code', AGGREGATE_KEYS[kind], 'amount') if col not in events or events[col].isna().any()]
+    if missing:
+        return None, f"В событиях не заполнены поля: {', '.join(missing)}"
+    try:
+        events['client_code'] = events['client_code'].astype(np.int64)
+        events['amount'] = events['amount'].astype(np.float64)
+    except (TypeError, ValueError):
+        return None, "client_code должен быть целым числом, amount - числом"
+    # Порция событий маленькая: только колонки схемы, без приведения к категориям
+    return events[[col for col in events.columns if col in INGEST_SCHEMAS[kind]]], None
+
+
+def _event_records(events: pd.DataFrame) -> List[Dict[str, Any]]:
+    """События для общего журнала: словари с None вместо пропусков"""
+    return events.astype(object).where(events.notna(), None).to_dict('records')
+
+
+@app.route('/events/<any(transactions, transfers):kind>', methods=['POST'])
+def post_events(kind):
+    """Онлайн-события: транзакции или переводы сразу меняют метрики, флаги и рекомендации своих клиентов"""
+    global current_snapshot
+    
+    try:
+        events, error = _read_events(kind)
+        if error is not None:
+            return jsonify({"error": error}), 400
+        
+        events_sha256 = hashlib.sha256(request.get_data()).hexdigest()
+        with events_lock:
+            snapshot = current_snapshot
+            if shared_store is not None:
+                # При общем каталоге порция пишется в общий журнал: ее применят все воркеры, а /process
+                # на любом воркере свернет журнал в загрузки. Порции применяются в порядке журнала
+                position = shared_store.events.append(kind, events_sha256, _event_records(events))
+                records, unknown = _sync_live_events(snapshot).get(position, ([], []))
+            else:
+                delta = ml_service.aggregate(kind, events, warn_missing=False)
+                pending_events.append((kind, delta, events_sha256))
+                records, unknown = snapshot.live.apply(kind, delta) if snapshot is not None else ([], [])
+            revision = snapshot.live.revision if snapshot is not None else None
         
         return jsonify({
-            "message": f"Обработаны данные для {len(merged_data)} клиентов",
-            "clients_count": len(merged_data),
-            "sample": merged_data[['client_code', 'name', 'top4_products']].head().to_dict('records')
+            "message": f"Принято событий: {len(events)}",
+            "accepted": len(events),
+            "version": snapshot.version if snapshot is not None else None,
+            "revision": revision,
+            "recommendations": records,
+            "unknown_clients": unknown
+        })
+        
+    except Exception as e:
+        logger.error(f"Ошибка при обработке событий: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+def _flush_events() -> int:
+    """Перенос накопленных онлайн-событий в загрузки (как mode=append), чтобы их учел /process
+    
+    Порции одного вида данных складываются в одну дозагрузку, ее отпечаток - цепочка sha256 тел запросов.
+    При общем каталоге порции берутся из общего журнала. Возвращает первое поколение журнала,
+    не вошедшее в загрузки (без общего каталога - 0).
+    """
+    if shared_store is not None:
+        entries, generation = shared_store.events.rotate()
+        for kind in AGGREGATE_KEYS:
+            batches = [(events, events_sha256) for _, other, events_sha256, events in entries if other == kind]
+            if not batches:
+                continue
+            rows = pd.DataFrame.from_records([event for events, _ in batches for event in events])
+            delta = ml_service.aggregate(kind, rows, warn_missing=False)
+            chained = hashlib.sha256('+'.join(events_sha256 for _, events_sha256 in batches).encode('utf-8')).hexdigest()
+            _append_upload(kind, delta, chained)
+        shared_store.events.mark_folded(generation)
+        return generation
+    
+    with events_lock:
+        for kind in AGGREGATE_KEYS:
+            batches = [(delta, events_sha256) for other, delta, events_sha256 in pending_events if other == kind]
+            if not batches:
+                continue
+            combined = batches[0][0]
+            for delta, _ in batches[1:]:
+                combined = combined.appended(delta, None)
+            chained = hashlib.sha256('+'.join(events_sha256 for _, events_sha256 in batches).encode('utf-8')).hexdigest()
+            _append_upload(kind, combined, chained)
+            pending_events[:] = [event for event in pending_events if event[0] != kind]
+    return 0
+
+
+def _processing_result(snapshot: DatasetSnapshot, cache: str) -> Dict[str, Any]:
+    """Ответ /process по опубликованному снимку; cache - 'hit' (готовый результат) или 'miss' (расчет)"""
+    merged = snapshot.merged
+    return {
+        "message": f"Обработаны данные для {len(merged)} клиентов",
+        "clients_count": len(merged),
+        "version": snapshot.version,
+        "sample": merged[['client_code', 'name', 'top4_products']].head().to_dict('records'),
+        "cache": cache
+    }
+
+
+def _find_processed(key: str, inputs: UploadedInputs) -> DatasetSnapshot:
+    """Уже посчитанный по ключу key снимок - текущий или сохраненный на диске; None - нужен расчет
+    
+    Сохраненная версия загружается и публикуется (при общем каталоге - и для остальных воркеров).
+    """
+    global current_snapshot
+    
+    if key is None:
+        return None
+    snapshot = current_snapshot
+    if snapshot is not None and snapshot.key == key:
+        return snapshot
+    
+    version = snapshot_store.find(key) if snapshot_store is not None else None
+    if version is None:
+        return None
+    snapshot = replace(snapshot_store.load(ml_service, version), inputs=inputs)
+    snapshot_store.activate(version)
+    _publish_snapshot(snapshot)
+    logger.info(f"Входные данные уже обработаны, опубликована сохраненная версия {version}")
+    return snapshot
+
+
+def _run_processing(job: ProcessingJob, inputs: UploadedInputs, key: str = None, events_generation: int = 0) -> Dict[str, Any]:
+    """Расчет рекомендаций для задачи /process; прежний снимок обслуживает запросы до публикации нового"""
+    global current_snapshot
+    
+    # Обработка данных и расчет выгоды: стадии с неизменившимися входами берутся из кеша
+    merged, stages = pipeline.run(inputs, progress=job.report)
+    logger.info(f"Стадии обработки: {stages}")
+    
+    # Снимок новой версии (индекс клиентов, кеши, статистика) публикуется одним присваиванием;
+    # онлайн-события, пришедшие во время расчета, переносятся в новую версию
+    job.report('publishing', len(merged))
+    snapshot = DatasetSnapshot.build(inputs, merged, ml_service, key=key, events_generation=events_generation)
+    if snapshot_store is not None:
+        # Сохраненная версия загрузится при перезапуске; остальные воркеры подхватят ее по манифесту
+        try:
+            snapshot_store.save(snapshot)
+        except OSError as e:
+            if shared_store is not None:
+                raise
+            # Без общего каталога снимок нужен только для теплого старта - результат публикуется и так
+            logger.error(f"Ошибка при сохранении снимка данных: {str(e)}")
+    _publish_snapshot(snapshot)
+    if shared_store is not None:
+        # События, вошедшие во входные данные опубликованной версии, из журнала больше не нужны
+        shared_store.events.remove_before(events_generation)
+    
+    logger.info(f"Обработаны данные для {len(merged)} клиентов")
+    
+    return {**_processing_result(snapshot, 'miss'), "stages": stages}
+
+
+def _remember_job(job: ProcessingJob):
+    """Регистрирует задачу и удаляет самые старые завершенные сверх PROCESS_JOBS_HISTORY"""
+    processing_jobs[job.id] = job
+    finished = [job_id for job_id, other in processing_jobs.items() if not other.active]
+    for job_id in finished[:max(0, len(finished) - PROCESS_JOBS_HISTORY)]:
+        del processing_jobs[job_id]
+
+
+@app.route('/process', methods=['POST'])
+def process_data():
+    """Запуск обработки всех данных и расчета рекомендаций фоновой задачей (?wait=1 - синхронно)"""
+    global uploaded_inputs
+    
+    try:
+        with processing_jobs_lock:
+            running = next((job for job in processing_jobs.values() if job.active), None)
+            if running is not None:
+                return jsonify({"error": "Обработка уже выполняется", "job_id": running.id}), 409
+            
+            # При общем каталоге задачу может выполнять другой воркер - проверка по межпроцессному замку
+            lock = None
+            if shared_store is not None:
+                lock = shared_store.try_lock_processing()
+                if lock is None:
+                    return jsonify({"error": "Обработка уже выполняется", "job_id": shared_store.processing_job_id()}), 409
+                shared_store.remove_stale_jobs()
+            
+            try:
+                # При общем каталоге данных берутся последние загрузки всех воркеров
+                inputs = shared_store.load_inputs() if shared_store is not None else uploaded_inputs
+                if not inputs.complete:
+                    return jsonify({"error": "Не все данные загружены. Загрузите клиентов, транзакции и переводы."}), 400
+                
+                # Онлайн-события с прошлого расчета дописываются к загрузкам транзакций и переводов -
+                # только после проверки, чтобы отклоненный запрос не менял загрузки
+                events_generation = _flush_events()
+                # Входные данные фиксируются на момент запуска: новые загрузки не попадут в идущий расчет
+                inputs = shared_store.load_inputs() if shared_store is not None else uploaded_inputs
+                
+                # Ключ результата: хеши трех загрузок и настройки сервиса
+                key = inputs.processing_key(ml_service.config_fingerprint())
+                
+                # Те же входные данные уже обработаны - отдаем готовый результат без пересчета
+                snapshot = _find_processed(key, inputs)
+                if snapshot is not None:
+                    return jsonify(_processing_result(snapshot, 'hit'))
+                
+                # Замок переходит задаче и снимается по ее завершении
+                job = ProcessingJob(lambda current: _run_processing(current, inputs, key, events_generation), shared_store, lock)
+                lock = None
+            finally:
+                if lock is not None:
+                    lock.close()
+            _remember_job(job)
+            job.save_status()
+        
+        if request.args.get('wait') in ('1', 'true'):
+            job.run()
+            if job.status == 'done':
+                return jsonify({**job.result, "job_id": job.id})
+            if job.status == 'cancelled':
+                return jsonify({"error": "Обработка отменена", "job_id": job.id}), 409
+            return jsonify({"error": job.error, "job_id": job.id}), 500
+        
+        threading.Thread(target=job.run, name=f'process-{job.id[:8]}', daemon=True).start()
+        
+        response = jsonify({
+            "message": "Обработка запущена",
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": f"/process/{job.id}"
         })
+        response.status_code = 202
+        response.headers['Location'] = f"/process/{job.id}"
+        return response
         
     except Exception as e:
         logger.error(f"Ошибка при обработке данных: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/process/<job_id>', methods=['GET'])
+def get_process_status(job_id):
+    """Статус задачи /process: стадия, число строк, прошедшее время, результат или ошибка"""
+    job = processing_jobs.get(job_id)
+    if job is not None:
+        return jsonify(job.to_dict())
+    
+    # Задачу мог запустить другой воркер
+    status = shared_store.load_job(job_id) if shared_store is not None else None
+    if status is None:
+        return jsonify({"error": f"Задача {job_id} не найдена"}), 404
+    return jsonify(status)
+
+@app.route('/process/<job_id>', methods=['DELETE'])
+def cancel_process(job_id):
+    """Отмена задачи /process; уже опубликованный результат не откатывается"""
+    job = processing_jobs.get(job_id)
+    if job is None:
+        # Задача другого воркера: метка отмены в общем каталоге, задача проверит ее на следующей стадии
+        status = shared_store.load_job(job_id) if shared_store is not None else None
+        if status is None:
+            return jsonify({"error": f"Задача {job_id} не найдена"}), 404
+        if status["status"] not in ('queued', 'running'):
+            return jsonify({**status, "error": f"Задача уже завершена со статусом {status['status']}"}), 409
+        shared_store.request_cancel(job_id)
+        response = jsonify(status)
+        response.status_code = 202
+        return response
+    if not job.active:
+        return jsonify({**job.to_dict(), "error": f"Задача уже завершена со статусом {job.status}"}), 409
+    job.cancel()
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    return response
+
+# Размер страницы /clients по умолчанию и максимальный
+CLIENTS_PAGE_SIZE = 100
+CLIENTS_MAX_PAGE_SIZE = 1000
+
+# Строк на один кусок при потоковой отдаче NDJSON
+STREAM_CHUNK_ROWS = 10000
+
+
+def _client_records(df: pd.DataFrame, start: int, stop: int) -> List[Dict[str, Any]]:
+    """Карточки клиентов строк [start, stop), собранные из колонок (без iterrows)"""
+    part = df.iloc[start:stop]
+    
+    def values(column, default):
+        return part[column].tolist() if column in part else [default] * len(part)
+    
+    return [
+        {
+            "client_code": int(code),
+            "name": name,
+            "status": status,
+            "age": int(age),
+            "city": city,
+            "avg_monthly_balance_KZT": float(balance)
+        }
+        for code, name, status, age, city, balance in zip(
+            values('client_code', 0),
+            values('name', 'Неизвестно'),
+            values('status', 'Неизвестно'),
+            values('age', 0),
+            values('city', 'Неизвестно'),
+            values('avg_monthly_balance_KZT', 0)
+        )
+    ]
+
+
+def _wants_ndjson() -> bool:
+    """Запрошен ли потоковый формат NDJSON (?format=ndjson или Accept: application/x-ndjson)"""
+    if request.args.get('format'):
+        return request.args.get('format') == 'ndjson'
+    return request.accept_mimetypes.best == 'application/x-ndjson'
+
+
+def _stream_ndjson(df: pd.DataFrame, build_records):
+    """Построчная отдача NDJSON кусками по STREAM_CHUNK_ROWS строк"""
+    def generate():
+        for start in range(0, len(df), STREAM_CHUNK_ROWS):
+            records = build_records(df, start, start + STREAM_CHUNK_ROWS)
+            yield ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
 @app.route('/clients', methods=['GET'])
 def get_clients_list():
-    """Получение списка всех клиентов"""
-    global merged_data
+    """Получение списка клиентов постранично (limit, cursor/offset) или потоком NDJSON (?format=ndjson)"""
+    global current_snapshot
     
     try:
-        if merged_data is None:
+        snapshot = current_snapshot
+        if snapshot is None:
             return jsonify({"error": "Данные не обработаны. Сначала выполните /process"}), 400
+        df = snapshot.merged
         
-        clients = []
-        for _, row in merged_data.iterrows():
-            clients.append({
-                "client_code": int(row['client_code']),
-                "name": row.get('name', 'Неизвестно'),
-                "status": row.get('status', 'Неизвестно'),
-                "age": int(row.get('age', 0)),
-                "city": row.get('city', 'Неизвестно'),
-                "avg_monthly_balance_KZT": float(row.get('avg_monthly_balance_KZT', 0))
-            })
+        if _wants_ndjson():
+            return _stream_ndjson(df, _client_records)
+        
+        try:
+            limit = int(request.args.get('limit', CLIENTS_PAGE_SIZE))
+            offset = int(request.args.get('cursor', request.args.get('offset', 0)))
+        except ValueError:
+            return jsonify({"error": "limit, offset и cursor должны быть целыми числами"}), 400
+        if not 1 <= limit <= CLIENTS_MAX_PAGE_SIZE or offset < 0:
+            return jsonify({"error": f"limit должен быть от 1 до {CLIENTS_MAX_PAGE_SIZE}, offset - неотрицательным"}), 400
+        
+        clients = _client_records(df, offset, offset + limit)
+        next_offset = offset + len(clients)
         
         return jsonify({
             "clients": clients,
-            "total_count": len(clients)
+            "total_count": len(df),
+            "offset": offset,
+            "limit": limit,
+            "next_cursor": str(next_offset) if next_offset < len(df) else None
         })
         
     except Exception as e:
@@ -1005,70 +4369,304 @@ def get_clients_list():
 @app.route('/recommendations/<int:client_code>', methods=['GET'])
 def get_recommendations(client_code):
     """Получение рекомендаций для конкретного клиента"""
-    global merged_data
+    global current_snapshot
     
     try:
-        if merged_data is None:
+        snapshot = current_snapshot
+        if snapshot is None:
             return jsonify({"error": "Данные не обработаны. Сначала выполните /process"}), 400
+        cache = snapshot.response_cache
         
-        client_data = merged_data[merged_data['client_code'] == client_code]
-        if client_data.empty:
+        # Клиент, измененный онлайн-событиями: ответ его ревизии, ETag - версия данных и ревизия
+        live = snapshot.live.get(client_code)
+        if live is not None:
+            return _cached_json_response(cache, (client_code, live["revision"]), lambda: live["record"],
+                                         etag=f"{cache.version}-{live['revision']}")
+        
+        # Поиск по хеш-индексу до проверки ETag: неизвестному клиенту 404, а не 304;
+        # сериализованный ответ кешируется до следующего /process
+        if cache.index.position(client_code) is None:
             return jsonify({"error": f"Клиент {client_code} не найден"}), 404
         
-        client_row = client_data.iloc[0]
-        top4_products = client_row['top4_products']
+        return _cached_json_response(cache, client_code, lambda: cache.index.record(client_code))
+        
+    except Exception as e:
+        logger.error(f"Ошибка при получении рекомендаций: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+# Максимум клиентов в одном запросе /recommendations/bulk
+BULK_MAX_CLIENTS = int(os.environ.get('BULK_MAX_CLIENTS', 100000))
+
+# Форматы ответа /recommendations/bulk (?format= или заголовок Accept)
+BULK_FORMATS = ('json', 'ndjson', 'arrow')
+
+
+# Допустимые коды клиентов в /recommendations/bulk - диапазон int64
+BULK_CODE_MIN, BULK_CODE_MAX = int(np.iinfo(np.int64).min), int(np.iinfo(np.int64).max)
+
+
+def _bulk_client_codes(payload):
+    """Коды клиентов запроса: список client_codes или полуинтервал range {"start", "stop"}
+    
+    Возвращает (коды, задан ли список, None) или (None, None, текст ошибки).
+    """
+    if not isinstance(payload, dict):
+        return None, None, "Ожидается JSON с client_codes или range"
+    too_many = f"Не больше {BULK_MAX_CLIENTS} клиентов в одном запросе"
+    if 'client_codes' in payload:
+        codes = payload['client_codes']
+        if not isinstance(codes, list) or not all(isinstance(code, int) and not isinstance(code, bool) for code in codes):
+            return None, None, "client_codes должен быть списком целых чисел"
+        if len(codes) > BULK_MAX_CLIENTS:
+            return None, None, too_many
+        # Коды вне int64 не могут быть кодами клиентов и не помещаются в массив
+        if any(not BULK_CODE_MIN <= code <= BULK_CODE_MAX for code in codes):
+            return None, None, f"client_codes должны быть целыми числами от {BULK_CODE_MIN} до {BULK_CODE_MAX}"
+        return np.array(codes, dtype=np.int64), True, None
+    try:
+        if isinstance(payload.get('range'), dict):
+            start, stop = int(payload['range']['start']), int(payload['range']['stop'])
+            # Размер диапазона проверяется до создания массива кодов
+            if stop - start > BULK_MAX_CLIENTS:
+                return None, None, too_many
+            return np.arange(start, stop, dtype=np.int64), False, None
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None, None, "range должен содержать целые start и stop"
+    return None, None, "Ожидается JSON с client_codes или range"
+
+
+def _bulk_format() -> str:
+    """Формат ответа /recommendations/bulk: json (по умолчанию), ndjson или arrow"""
+    if request.args.get('format'):
+        return request.args['format']
+    if _wants_ndjson():
+        return 'ndjson'
+    return 'arrow' if request.accept_mimetypes.best == EXPORT_FORMATS['arrow'][0] else 'json'
+
+
+def _bulk_records(products: tuple, codes, names, ranked, benefits, start: int, stop: int) -> List[Dict[str, Any]]:
+    """Ответы в формате /recommendations для строк [start, stop) собранных массивов"""
+    return [
+        {
+            "client_code": code,
+            "client_name": name,
+            "recommendations": [
+                {"product": products[product], "benefit_kzt_per_month": benefit}
+                for product, benefit in zip(row, values) if product >= 0
+            ]
+        }
+        for code, name, row, values in zip(
+            codes[start:stop].tolist(), names[start:stop].tolist(), ranked[start:stop].tolist(), benefits[start:stop].tolist()
+        )
+    ]
+
+
+def _bulk_arrow(products: tuple, codes, names, ranked, benefits, metadata: Dict[str, str]) -> bytes:
+    """Arrow IPC stream: client_code, client_name и списки products / benefits_kzt_per_month по клиентам"""
+    # Продукты в строке идут подряд с начала, поэтому списки - срезы плоских массивов по смещениям
+    filled = ranked >= 0
+    offsets = pa.array(np.concatenate([[0], np.cumsum(filled.sum(axis=1))]).astype(np.int32))
+    table = pa.table({
+        'client_code': pa.array(codes, pa.int64()),
+        'client_name': pa.array(names, pa.string()),
+        'products': pa.ListArray.from_arrays(
+            offsets, pa.DictionaryArray.from_arrays(ranked[filled].astype(np.int32), pa.array(list(products), pa.string()))
+        ),
+        'benefits_kzt_per_month': pa.ListArray.from_arrays(offsets, pa.array(benefits[filled], pa.float64()))
+    }).replace_schema_metadata(metadata)
+    
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+@app.route('/recommendations/bulk', methods=['POST'])
+def get_bulk_recommendations():
+    """Рекомендации для многих клиентов одним запросом: JSON, NDJSON или Arrow; ненайденные коды - списком"""
+    global current_snapshot
+    
+    try:
+        snapshot = current_snapshot
+        if snapshot is None:
+            return jsonify({"error": "Данные не обработаны. Сначала выполните /process"}), 400
+        
+        codes, listed, error = _bulk_client_codes(request.get_json(silent=True))
+        if error is not None:
+            return jsonify({"error": error}), 400
+        response_format = _bulk_format()
+        if response_format not in BULK_FORMATS:
+            return jsonify({"error": f"Неизвестный формат: {response_format}. Доступны: {', '.join(BULK_FORMATS)}"}), 400
+        if response_format == 'arrow' and pa is None:
+            return jsonify({"error": "Формат arrow требует установленного pyarrow"}), 501
+        
+        # Один векторный поиск по индексу вместо поиска по каждому коду; клиенты из онлайн-событий подменяются
+        index = snapshot.index
+        found, names, ranked, benefits = index.gather(codes)
+        ranked, benefits = snapshot.live.patch(codes[found], ranked, benefits)
+        # Для диапазона отсутствующие коды не перечисляются
+        missing = codes[~found].tolist() if listed else []
+        found_codes = codes[found]
+        
+        if response_format == 'arrow':
+            body = _bulk_arrow(index.products, found_codes, names, ranked, benefits, {
+                "version": snapshot.version, "missing": json.dumps(missing)
+            })
+            return Response(body, mimetype=EXPORT_FORMATS['arrow'][0])
         
-        # Получаем выгоду для каждого продукта
-        recommendations = []
-        for product in top4_products:
-            benefit_col = f'benefit_{product}'
-            if benefit_col in client_row:
-                benefit = client_row[benefit_col]
-                recommendations.append({
-                    "product": product,
-                    "benefit_kzt_per_month": float(benefit)
-                })
+        if response_format == 'ndjson':
+            def generate():
+                for start in range(0, len(found_codes), STREAM_CHUNK_ROWS):
+                    records = _bulk_records(index.products, found_codes, names, ranked, benefits, start, start + STREAM_CHUNK_ROWS)
+                    yield ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+                # Последняя строка - ненайденные коды
+                yield json.dumps({"missing": missing}) + '\n'
+            return Response(generate(), mimetype='application/x-ndjson')
         
         return jsonify({
-            "client_code": client_code,
-            "client_name": client_row.get('name', 'Неизвестно'),
-            "recommendations": recommendations
+            "version": snapshot.version,
+            "found": len(found_codes),
+            "recommendations": _bulk_records(index.products, found_codes, names, ranked, benefits, 0, len(found_codes)),
+            "missing": missing
         })
         
     except Exception as e:
         logger.error(f"Ошибка при получении рекомендаций: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+
+@app.route('/products/<product>/top', methods=['GET'])
+def get_product_top(product):
+    """Клиенты с наибольшей выгодой от продукта постранично (limit, offset) с фильтрами city, status, age_min, age_max
+    
+    Выгоды и порядок - версии данных: онлайн-события /events отражаются здесь после следующего /process.
+    """
+    global current_snapshot
+    
+    try:
+        snapshot = current_snapshot
+        if snapshot is None:
+            return jsonify({"error": "Данные не обработаны. Сначала выполните /process"}), 400
+        ranking = snapshot.product_ranking
+        if product not in ranking.orders:
+            return jsonify({"error": f"Продукт {product} не найден", "products": list(ranking.products)}), 404
+        
+        try:
+            limit = int(request.args.get('limit', CLIENTS_PAGE_SIZE))
+            offset = int(request.args.get('offset', 0))
+            filters = {
+                "city": request.args.get('city'),
+                "status": request.args.get('status'),
+                "age_min": int(request.args['age_min']) if 'age_min' in request.args else None,
+                "age_max": int(request.args['age_max']) if 'age_max' in request.args else None
+            }
+        except ValueError:
+            return jsonify({"error": "limit, offset, age_min и age_max должны быть целыми числами"}), 400
+        if not 1 <= limit <= CLIENTS_MAX_PAGE_SIZE or offset < 0:
+            return jsonify({"error": f"limit должен быть от 1 до {CLIENTS_MAX_PAGE_SIZE}, offset - неотрицательным"}), 400
+        # Страница с фильтрами может требовать просмотра порядка до offset, поэтому глубина ограничена
+        active_filters = {name: value for name, value in filters.items() if value is not None}
+        if active_filters and offset > PRODUCT_TOP_MAX_OFFSET:
+            return jsonify({"error": f"С фильтрами offset не больше {PRODUCT_TOP_MAX_OFFSET}"}), 400
+        
+        # Позиции строк из готового порядка продукта: без сортировки и без прохода по всем клиентам
+        rows, has_more = ranking.page(product, offset, limit, filters)
+        part = snapshot.merged.iloc[rows]
+        benefits = part[f'benefit_{product}'].to_numpy(dtype=np.float64)
+        recommended = (snapshot.index.ranked[rows] == snapshot.index.products.index(product)).any(axis=1)
+        clients = [
+            {**record, "rank": offset + number + 1, "benefit_kzt_per_month": float(benefit), "recommended": bool(is_recommended)}
+            for number, (record, benefit, is_recommended) in enumerate(zip(_client_records(part, 0, len(part)), benefits, recommended))
+        ]
+        
+        return jsonify({
+            "product": product,
+            "version": snapshot.version,
+            "filters": active_filters,
+            "clients": clients,
+            "offset": offset,
+            "limit": limit,
+            # Без фильтров число клиентов с положительной выгодой известно сразу, с фильтрами - нет
+            "total_count": None if active_filters else len(ranking.orders[product]),
+            "next_offset": offset + len(clients) if has_more else None
+        })
+        
+    except Exception as e:
+        logger.error(f"Ошибка при получении топа клиентов по продукту: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+# Поля профиля /score, без которых формулы выгоды молча считают по нулям; возраст и баланс - числа
+SCORE_REQUIRED_FIELDS = ('client_code', 'age', 'status', 'avg_monthly_balance_KZT')
+SCORE_NUMERIC_FIELDS = ('age', 'avg_monthly_balance_KZT')
+
+
+@app.route('/score', methods=['POST'])
+def score_client():
+    """Скоринг одного клиента по профилю и тратам без обработанного датасета (новый клиент или what-if)"""
+    
+    try:
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict) or not isinstance(payload.get('client'), dict):
+            return jsonify({"error": "Ожидается JSON с профилем клиента в поле client"}), 400
+        transactions, transfers = payload.get('transactions', []), payload.get('transfers', [])
+        monthly = payload.get('monthly', {})
+        if not all(isinstance(records, list) and all(isinstance(record, dict) for record in records)
+                   for records in (transactions, transfers)) or not isinstance(monthly, dict):
+            return jsonify({"error": "transactions и transfers - списки объектов, monthly - объект"}), 400
+        client = payload['client']
+        missing = [name for name in SCORE_REQUIRED_FIELDS if client.get(name) is None]
+        if missing:
+            return jsonify({"error": f"В профиле клиента нет обязательных полей: {', '.join(missing)}"}), 400
+        invalid = [name for name in SCORE_NUMERIC_FIELDS
+                   if isinstance(client[name], bool) or not isinstance(client[name], (int, float))]
+        if invalid:
+            return jsonify({"error": f"Поля профиля клиента должны быть числами: {', '.join(invalid)}"}), 400
+        
+        # Признаки и выгоды считаются построчными формулами сервиса по словарю, без DataFrame
+        try:
+            features = ml_service.client_features(client, transactions, transfers, monthly)
+            benefits = ml_service.client_benefits(features)
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({"error": f"Некорректные данные клиента: {str(e)}"}), 400
+        
+        products = list(ml_service.benefit_formulas)
+        ranked = ml_service.top_products(benefits)
+        return jsonify({
+            "client_code": features.get('client_code'),
+            "client_name": features.get('name', 'Неизвестно'),
+            "benefits": {product: float(benefit) for product, benefit in zip(products, benefits)},
+            "recommendations": [
+                {"product": products[product], "benefit_kzt_per_month": float(benefits[product])} for product in ranked
+            ],
+            "push_notification": ml_service.generate_push_notification(features, products[ranked[0]]) if ranked else None,
+            "metrics": {
+                column: features[column]
+                for column in [*MONTHLY_METRIC_COLUMNS, *ml_service.flag_rules, *(f'top_category_{rank}' for rank in range(1, TOP_K + 1))]
+                if column in features
+            }
+        })
+        
+    except Exception as e:
+        logger.error(f"Ошибка при скоринге клиента: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/push-notifications', methods=['POST'])
 def generate_push_notifications():
     """Генерация персонализированных пуш-уведомлений для всех клиентов"""
-    global merged_data
+    global current_snapshot
     
     try:
-        if merged_data is None:
+        snapshot = current_snapshot
+        if snapshot is None:
             return jsonify({"error": "Данные не обработаны. Сначала выполните /process"}), 400
+        store = snapshot.notifications
         
-        notifications = []
-        
-        for _, client_row in merged_data.iterrows():
-            client_code = client_row['client_code']
-            top4_products = client_row['top4_products']
-            
-            if top4_products:
-                # Берем лучший продукт (первый в списке)
-                best_product = top4_products[0]
-                
-                # Генерируем пуш-уведомление
-                client_data = client_row.to_dict()
-                push_notification = ml_service.generate_push_notification(client_data, best_product)
-                
-                notifications.append({
-                    "client_code": int(client_code),
-                    "product": best_product,
-                    "push_notification": push_notification
-                })
-        
-        logger.info(f"Сгенерированы пуш-уведомления для {len(notifications)} клиентов")
+        # Лучший продукт (первый в списке) и уведомление для каждого клиента с рекомендациями,
+        # сгенерированные один раз для текущей версии данных
+        notifications = store.records()
         
         return jsonify({
             "message": f"Сгенерированы пуш-уведомления для {len(notifications)} клиентов",
@@ -1079,45 +4677,88 @@ def generate_push_notifications():
         logger.error(f"Ошибка при генерации пуш-уведомлений: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# Форматы выгрузки /export/csv: MIME-тип и расширение файла
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrow')
+}
+EXPORT_FILENAME = 'banking_recommendations'
+
+
+class _ChunkSink:
+    """Файлоподобный приемник для писателей pyarrow: генератор забирает накопленные байты после каждого куска"""
+    
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+    
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def tell(self) -> int:
+        return self.position
+    
+    def drain(self) -> bytes:
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def _export_arrow_chunks(store: NotificationStore, export_format: str):
+    """Parquet (группа строк на кусок) или Arrow IPC stream (батч на кусок) из хранилища уведомлений"""
+    schema = store.arrow_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema) if export_format == 'parquet' else pa.ipc.new_stream(sink, schema)
+    
+    try:
+        for table in store.arrow_chunks():
+            writer.write_table(table)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
 @app.route('/export/csv', methods=['GET'])
 def export_csv():
-    """Экспорт результатов в CSV формате"""
-    global merged_data
+    """Потоковая выгрузка результатов файлом: CSV (?compression=gzip), Parquet или Arrow (?format=parquet|arrow)"""
+    global current_snapshot
     
     try:
-        if merged_data is None:
+        snapshot = current_snapshot
+        if snapshot is None:
             return jsonify({"error": "Данные не обработаны. Сначала выполните /process"}), 400
+        store = snapshot.notifications
         
-        # Подготавливаем данные для экспорта
-        export_data = []
+        export_format = request.args.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return jsonify({"error": f"Неизвестный формат: {export_format}. Доступны: {', '.join(EXPORT_FORMATS)}"}), 400
         
-        for _, client_row in merged_data.iterrows():
-            client_code = client_row['client_code']
-            top4_products = client_row['top4_products']
-            
-            if top4_products:
-                # Берем лучший продукт
-                best_product = top4_products[0]
-                
-                # Генерируем пуш-уведомление
-                client_data = client_row.to_dict()
-                push_notification = ml_service.generate_push_notification(client_data, best_product)
-                
-                export_data.append({
-                    "client_code": int(client_code),
-                    "product": best_product,
-                    "push_notification": push_notification
-                })
+        compression = request.args.get('compression')
+        if compression not in (None, 'gzip') or (compression and export_format != 'csv'):
+            return jsonify({"error": "Сжатие поддерживается только для CSV: compression=gzip"}), 400
         
-        # Создаем CSV
-        df_export = pd.DataFrame(export_data)
-        csv_content = df_export.to_csv(index=False)
+        if export_format != 'csv' and pa is None:
+            return jsonify({"error": f"Формат {export_format} требует установленного pyarrow"}), 501
         
-        return jsonify({
-            "message": f"Подготовлены данные для экспорта {len(export_data)} записей",
-            "csv_content": csv_content,
-            "sample": export_data[:5] if export_data else []
-        })
+        mimetype, extension = EXPORT_FORMATS[export_format]
+        if export_format == 'csv':
+            chunks = store.csv_chunks(compressed=compression == 'gzip')
+            if compression == 'gzip':
+                mimetype, extension = 'application/gzip', 'csv.gz'
+        else:
+            chunks = _export_arrow_chunks(store, export_format)
+        
+        response = Response(chunks, mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename="{EXPORT_FILENAME}.{extension}"'
+        return response
         
     except Exception as e:
         logger.error(f"Ошибка при экспорте: {str(e)}")
@@ -1126,31 +4767,21 @@ def export_csv():
 @app.route('/stats', methods=['GET'])
 def get_stats():
     """Получение статистики по обработанным данным"""
-    global merged_data
+    global current_snapshot
     
     try:
-        if merged_data is None:
+        snapshot = current_snapshot
+        if snapshot is None:
             return jsonify({"error": "Данные не обработаны"}), 400
         
-        # Статистика по продуктам
-        product_stats = {}
-        for _, client_row in merged_data.iterrows():
-            top4_products = client_row['top4_products']
-            if top4_products:
-                best_product = top4_products[0]
-                product_stats[best_product] = product_stats.get(best_product, 0) + 1
-        
-        return jsonify({
-            "total_clients": len(merged_data),
-            "clients_with_recommendations": len([row for _, row in merged_data.iterrows() if row['top4_products']]),
-            "product_distribution": product_stats,
-            "data_columns": list(merged_data.columns)
-        })
+        # Статистика посчитана при /process
+        return jsonify(snapshot.stats)
         
     except Exception as e:
         logger.error(f"Ошибка при получении статистики: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 if __name__ == "__main__":
+    warm_start()
     port = int(os.environ.get("PORT", 5000)) 
     app.run(debug=False, host="0.0.0.0", port=port)
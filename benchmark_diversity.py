@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк масштабирования назначения продуктов по квотам (_apply_global_diversity)
+
+Сравнивает векторный движок назначения с прежним построчным алгоритмом
+на синтетических матрицах выгод и проверяет, что распределение совпадает.
+
+Запуск:
+    python benchmark_diversity.py                 # 1k, 10k, 100k, 1M клиентов
+    python benchmark_diversity.py 5000 200000     # свои размеры
+"""
+
+import sys
+import time
+import logging
+
+import numpy as np
+import pandas as pd
+
+from app import BankingMLService
+
+# Построчный алгоритм квадратичен - на больших размерах его не запускаем
+ROWWISE_LIMIT = 5000
+
+
+def make_benefits(service, n_clients, seed=42):
+    """Синтетическая таблица выгод: ~40% нулей, как у реальных клиентов"""
+    rng = np.random.default_rng(seed)
+    products = list(service.benefit_formulas)
+    benefits = rng.gamma(1.0, 20000.0, (n_clients, len(products)))
+    benefits[rng.random(benefits.shape) < 0.4] = 0
+    df = pd.DataFrame(benefits, columns=[f'benefit_{product}' for product in products])
+    df.insert(0, 'client_code', np.arange(n_clients))
+    return df
+
+
+def run(service, method, df):
+    """Время назначения и результат"""
+    benefit_columns = [col for col in df.columns if col.startswith('benefit_')]
+    started = time.perf_counter()
+    result = method(df.copy(), benefit_columns, service.product_groups, service.target_distribution)
+    return time.perf_counter() - started, result['top4_products']
+
+
+def main():
+    logging.disable(logging.INFO)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000, 1000000]
+    service = BankingMLService()
+
+    print("📈 Масштабирование назначения продуктов по квотам")
+    print("=" * 60)
+    print(f"{'клиентов':>10} | {'векторный, с':>13} | {'построчный, с':>14} | совпадает")
+    print("-" * 60)
+
+    for n_clients in sizes:
+        df = make_benefits(service, n_clients)
+        vectorized_time, vectorized_result = run(service, service._apply_global_diversity, df)
+
+        if n_clients <= ROWWISE_LIMIT:
+            rowwise_time, rowwise_result = run(service, service._apply_global_diversity_rowwise, df)
+            same = "✅" if list(vectorized_result) == list(rowwise_result) else "❌"
+            rowwise_text = f"{rowwise_time:14.3f}"
+        else:
+            same, rowwise_text = "—", f"{'—':>14}"
+
+        print(f"{n_clients:>10} | {vectorized_time:13.3f} | {rowwise_text} | {same}")
+
+
+if __name__ == "__main__":
+    main()
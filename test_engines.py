@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Проверки движков расчета на тестовых CSV из репозитория (без запущенного сервера): python -m pytest -q test_engines.py
+"""
+
+import os
+import logging
+import dataclasses
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+logging.disable(logging.CRITICAL)
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Наборы тестовых данных: test_clients.csv, test_transactions.csv, ... и их *_realistic варианты
+DATASETS = ('', '_realistic')
+
+
+def read_dataset(suffix: str):
+    """Клиенты, транзакции и переводы набора"""
+    return tuple(pd.read_csv(os.path.join(DATA_DIR, f'test_{kind}{suffix}.csv'))
+                 for kind in ('clients', 'transactions', 'transfers'))
+
+
+@pytest.fixture(scope='module')
+def service():
+    return app.BankingMLService()
+
+
+@pytest.fixture(scope='module', params=DATASETS)
+def features(request, service):
+    """Таблица признаков клиентов набора, как на стадии merge"""
+    clients, transactions, transfers = read_dataset(request.param)
+    transaction_metrics = service.transaction_metrics(transactions)
+    transfer_metrics = service.transfer_metrics(transfers)
+    flags = service.collect_flag_codes(transaction_metrics, transfer_metrics)
+    return service.merge_features(clients, transaction_metrics, transfer_metrics, flags)
+
+
+def test_vectorized_benefits_match_rowwise(service, features):
+    vectorized = service.compute_benefits(features, 'vectorized')
+    rowwise = service.compute_benefits(features, 'rowwise')
+    pd.testing.assert_frame_equal(vectorized, rowwise)
+    assert (vectorized.to_numpy() > 0).any()
+
+
+@pytest.fixture(scope='module')
+def benefits(service, features):
+    return service.compute_benefits(features)
+
+
+@pytest.mark.parametrize('step', [None, 5000.0])
+def test_quota_assignment_matches_rowwise(service, features, benefits, step):
+    """Векторное назначение по квотам дает те же рекомендации, что построчный жадный алгоритм
+    
+    step - округление выгод, чтобы проверить порядок при равных выгодах.
+    """
+    if step is not None:
+        benefits = (benefits / step).round() * step
+    columns = list(benefits.columns)
+    frame = pd.concat([features[['client_code']], benefits], axis=1)
+    vectorized = service._apply_global_diversity(
+        frame.copy(), columns, service.product_groups, service.target_distribution)
+    rowwise = service._apply_global_diversity_rowwise(
+        frame.copy(), columns, service.product_groups, service.target_distribution)
+    assert vectorized['top4_products'].tolist() == rowwise['top4_products'].tolist()
+    pd.testing.assert_series_equal(vectorized['assigned_product'], rowwise['assigned_product'])
+
+
+def test_update_benefit_pairs_matches_full_sort(service, benefits):
+    """Пары выгод после пересчета части строк совпадают с полной сортировкой benefit_pairs"""
+    values = benefits.to_numpy(dtype=float)
+    pairs = service.benefit_pairs(values)
+    positions = np.arange(0, len(values), 7)
+    
+    updated = values.copy()
+    rng = np.random.default_rng(21)
+    updated[positions] *= rng.uniform(0.5, 2.0, size=(len(positions), values.shape[1]))
+    updated[positions[::2], 0] = 0
+    # Равные выгоды с уже стоящими в порядке парами проверяют вставку при равенстве
+    updated[positions[1::2], 1] = pairs[2][:len(positions[1::2])]
+    
+    result = service.update_benefit_pairs(pairs, updated, positions)
+    for actual, expected in zip(result, service.benefit_pairs(updated)):
+        np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('suffix', DATASETS)
+def test_append_run_matches_cold_run(service, suffix):
+    """Расчет после дозагрузки (mode=append) совпадает с полным расчетом тех же данных с нуля"""
+    clients, transactions, transfers = read_dataset(suffix)
+    sources = {kind: {"sha256": f'{kind}{suffix}', "mode": 'frame'} for kind in ('clients', 'transactions', 'transfers')}
+    # Порция дозагрузки - операции нескольких клиентов
+    delta_clients = clients['client_code'].iloc[::9]
+    is_delta = transactions['client_code'].isin(delta_clients)
+    inputs = app.UploadedInputs(
+        clients, service.aggregate('transactions', transactions[~is_delta]),
+        service.aggregate('transfers', transfers), sources)
+    
+    pipeline = app.StagedPipeline(service)
+    pipeline.run(inputs)
+    combined = inputs.transactions.appended(
+        service.aggregate('transactions', transactions[is_delta]), app._source_fingerprint(sources['transactions']))
+    appended = dataclasses.replace(inputs, transactions=combined, sources={
+        **sources, 'transactions': {"sha256": f'transactions{suffix}+delta', "mode": 'append'}})
+    merged, report = pipeline.run(appended)
+    # Дозагружены только транзакции: агрегаты переводов не пересчитываются
+    assert report['transaction_aggregation'] == 'incremental' and report['ranking'] == 'incremental'
+    assert report['transfer_aggregation'] == 'reused'
+    
+    cold, _ = app.StagedPipeline(service).run(appended)
+    pd.testing.assert_frame_equal(merged, cold)
@@ -109,7 +109,7 @@ def test_improved_ml_logic():
     
     # 3. Обрабатываем данные
     print("\n⚙️ Обработка данных...")
-    response = requests.post(f"{base_url}/process")
+    response = requests.post(f"{base_url}/process?wait=1")
     if response.status_code == 200:
         print(f"✅ Обработка: {response.json().get('message', 'Ошибка')}")
     else:
@@ -111,7 +111,7 @@ def process_data():
     """Обработка данных"""
     print("\n⚙️ Обработка данных...")
     try:
-        response = requests.post(f"{BASE_URL}/process")
+        response = requests.post(f"{BASE_URL}/process?wait=1")
         if response.status_code == 200:
             print("✅ Данные обработаны")
             result = response.json()
@@ -166,15 +166,17 @@ def export_csv():
     """Экспорт результатов"""
     print("\n📄 Экспорт результатов...")
     try:
-        response = requests.get(f"{BASE_URL}/export/csv")
+        response = requests.get(f"{BASE_URL}/export/csv", stream=True)
         if response.status_code == 200:
             print("✅ Результаты экспортированы")
-            result = response.json()
-            print(f"   Экспортировано записей: {len(result['sample'])}")
             
-            # Сохраняем CSV файл
-            with open('results.csv', 'w', encoding='utf-8') as f:
-                f.write(result['csv_content'])
+            # Сохраняем CSV файл потоком, по мере получения
+            with open('results.csv', 'wb') as f:
+                for chunk in response.iter_content(chunk_size=65536):
+                    f.write(chunk)
+            
+            with open('results.csv', encoding='utf-8') as f:
+                print(f"   Экспортировано записей: {sum(1 for _ in f) - 1}")
             print("   📁 Файл сохранен как 'results.csv'")
         else:
             print(f"❌ Ошибка экспорта: {response.text}")
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""
+Точка входа WSGI для production-запуска в несколько процессов
+
+Каждый воркер - отдельный процесс со своей памятью, поэтому обработанные данные
+хранятся в общем каталоге SHARED_DATA_DIR: /process пишет туда колоночный снимок,
+а все воркеры открывают его через mmap только для чтения и подхватывают новые версии
+без перезапуска (проверка манифеста не чаще раза в SNAPSHOT_POLL_SECONDS).
+
+Запуск:
+    SHARED_DATA_DIR=/var/lib/banking-ml gunicorn -w 4 --threads 4 -b 0.0.0.0:8080 wsgi:app
+"""
+
+from app import app, logger, shared_store, warm_start
+
+if shared_store is None:
+    logger.warning("SHARED_DATA_DIR не задан: каждый воркер будет хранить данные только в своей памяти")
+
+warm_start()